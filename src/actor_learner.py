@@ -0,0 +1,502 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+import io
+import json
+import multiprocessing
+import pickle
+import struct
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+import gymnasium
+import numpy as np
+import torch
+import yaml
+import zmq
+import fire
+from stable_baselines3 import PPO
+from stable_baselines3.common.buffers import RolloutBuffer
+from stable_baselines3.common.logger import configure
+from stable_baselines3.common.policies import ActorCriticCnnPolicy
+from stable_baselines3.common.utils import obs_as_tensor
+from stable_baselines3.common.vec_env import VecEnv
+
+from checkpoint import AsyncCheckpointCallback, latest_checkpoint, resume
+from game_env import create_env
+from gb_emulator import GBEmulator
+from games.pokemon_red import PokemonRedReward
+from metrics import RateLimitedPrinter
+from synthetic_emulator import SyntheticEmulator
+from vec_env import BatchedGameEnv
+
+# Actors push multipart messages [kind, JSON header, *arrays] to the learner,
+# the header listing the name, dtype and shape of every array
+HELLO = b"hello"
+ROLLOUT = b"rollout"
+BYE = b"bye"
+
+# Weights message: policy version and discount, then the torch.save'd policy
+# state dict. Single part so that the actors' SUB sockets can conflate them
+WEIGHTS = struct.Struct("<qd")
+
+EMULATORS = {"gb": GBEmulator, "synthetic": SyntheticEmulator}
+
+
+def send_message(socket, kind: bytes, header: Dict[str, Any], arrays=()):
+  header = {
+    **header,
+    "arrays": [(name, array.dtype.str, array.shape) for name, array in arrays],
+  }
+  frames = [kind, json.dumps(header).encode()]
+  frames += [np.ascontiguousarray(array) for _, array in arrays]
+  socket.send_multipart(frames)
+
+
+def recv_message(socket) -> Tuple[bytes, Dict[str, Any], Dict[str, np.ndarray]]:
+  kind, header, *frames = socket.recv_multipart()
+  header = json.loads(header)
+  arrays = {
+    name: np.frombuffer(frame, dtype=dtype).reshape(shape)
+    for (name, dtype, shape), frame in zip(header.pop("arrays"), frames)
+  }
+  return kind, header, arrays
+
+
+class Actor(object):
+  """
+  Collects rollouts of actor_steps steps from env with its copy of the policy
+  and pushes them to the learner at learner_trajectory_address, picking up the
+  newest weights published at learner_weights_address between rollouts.
+
+  A rollout carries the version of the weights it was collected with, so the
+  learner can tell its policy lag. Sending waits while actor_queue rollouts
+  are already queued on each side, the actor's and the learner's, which keeps
+  actors from running ahead of the learner, and an actor that can't send for
+  actor_timeout_s takes the learner for gone and stops.
+  """
+
+  def __init__(self, config, actor_id, env: VecEnv):
+    self.actor_id = actor_id
+    self.env = env
+    self.n_steps = config.get("actor_steps", 512)
+    self.timeout_ms = int(config.get("actor_timeout_s", 60) * 1000)
+    self.policy = ActorCriticCnnPolicy(
+      env.observation_space, env.action_space, lr_schedule=lambda _: 0.0
+    )
+    self.policy.set_training_mode(False)
+    self.version = -1
+    self.gamma = 0.99
+
+    context = zmq.Context.instance()
+    self.push = context.socket(zmq.PUSH)
+    self.push.setsockopt(zmq.SNDHWM, config.get("actor_queue", 2))
+    self.push.setsockopt(zmq.SNDTIMEO, self.timeout_ms)
+    self.push.setsockopt(zmq.LINGER, 0)
+    self.push.connect(config["learner_trajectory_address"])
+    self.sub = context.socket(zmq.SUB)
+    # only the newest weights are kept, must be set before connecting
+    self.sub.setsockopt(zmq.CONFLATE, 1)
+    self.sub.setsockopt(zmq.SUBSCRIBE, b"")
+    self.sub.connect(config["learner_weights_address"])
+
+    n_envs = env.num_envs
+    shape = (self.n_steps, n_envs)
+    self.obs = np.zeros(shape + env.observation_space.shape, dtype=np.uint8)
+    self.actions = np.zeros(shape, dtype=np.int64)
+    self.rewards = np.zeros(shape, dtype=np.float32)
+    self.episode_starts = np.zeros(shape, dtype=np.float32)
+    self.values = np.zeros(shape, dtype=np.float32)
+    self.log_probs = np.zeros(shape, dtype=np.float32)
+    self.last_obs = None
+    self.last_episode_starts = np.ones(n_envs, dtype=np.float32)
+
+  def sync_weights(self, timeout_ms=0) -> bool:
+    """
+    Load the newest published weights, waiting up to timeout_ms for them.
+    """
+    if not self.sub.poll(timeout_ms):
+      return False
+    message = self.sub.recv()
+    self.version, self.gamma = WEIGHTS.unpack_from(message)
+    state = torch.load(io.BytesIO(memoryview(message)[WEIGHTS.size :]))
+    self.policy.load_state_dict(state)
+    return True
+
+  def rollout(self) -> List[float]:
+    """
+    Fill the rollout arrays as PPO.collect_rollouts does, and return the final
+    rewards of the episodes that ended.
+    """
+    episode_rewards = []
+    if self.last_obs is None:
+      self.last_obs = self.env.reset()
+    for step in range(self.n_steps):
+      with torch.no_grad():
+        actions, values, log_probs = self.policy(obs_as_tensor(self.last_obs, "cpu"))
+      actions = actions.numpy()
+      obs, rewards, dones, infos = self.env.step(actions)
+      for i, (done, info) in enumerate(zip(dones, infos)):
+        if not done:
+          continue
+        if not info.get("worker_respawned", False):
+          episode_rewards.append(info["reward"])
+        # bootstrap episodes cut by the step limit, as PPO does
+        if info.get("TimeLimit.truncated", False):
+          terminal_obs = self.policy.obs_to_tensor(info["terminal_observation"])[0]
+          with torch.no_grad():
+            terminal_value = self.policy.predict_values(terminal_obs)[0]
+          rewards[i] += self.gamma * terminal_value.item()
+      self.obs[step] = self.last_obs
+      self.actions[step] = actions
+      self.rewards[step] = rewards
+      self.episode_starts[step] = self.last_episode_starts
+      self.values[step] = values.flatten().numpy()
+      self.log_probs[step] = log_probs.numpy()
+      self.last_obs = obs
+      self.last_episode_starts = dones.astype(np.float32)
+    return episode_rewards
+
+  def run(self, max_rollouts: Optional[int] = None):
+    spaces = pickle.dumps((self.env.observation_space, self.env.action_space))
+    send_message(
+      self.push,
+      HELLO,
+      {"actor": self.actor_id, "envs": self.env.num_envs},
+      [("spaces", np.frombuffer(spaces, dtype=np.uint8))],
+    )
+    if not self.sync_weights(self.timeout_ms):
+      raise TimeoutError(f"actor {self.actor_id} got no weights from the learner")
+    rollouts = 0
+    try:
+      while max_rollouts is None or rollouts < max_rollouts:
+        self.sync_weights()
+        beg = time.perf_counter()
+        episode_rewards = self.rollout()
+        elapsed = time.perf_counter() - beg
+        with torch.no_grad():
+          last_values = self.policy.predict_values(obs_as_tensor(self.last_obs, "cpu"))
+        header = {
+          "actor": self.actor_id,
+          "version": self.version,
+          "steps_per_s": self.actions.size / elapsed,
+          "episode_rewards": episode_rewards,
+        }
+        arrays = [
+          ("obs", self.obs),
+          ("actions", self.actions),
+          ("rewards", self.rewards),
+          ("episode_starts", self.episode_starts),
+          ("values", self.values),
+          ("log_probs", self.log_probs),
+          ("last_values", last_values.flatten().numpy()),
+          ("last_dones", self.last_episode_starts),
+        ]
+        try:
+          send_message(self.push, ROLLOUT, header, arrays)
+        except zmq.Again:
+          print(f"actor {self.actor_id}: learner gone, stopping")
+          return
+        rollouts += 1
+    finally:
+      try:
+        send_message(self.push, BYE, {"actor": self.actor_id})
+      except zmq.Again:
+        pass
+      self.push.close()
+      self.sub.close()
+      self.env.close()
+
+
+class SpacesEnv(gymnasium.Env):
+  """
+  Carries the spaces the actors reported, to build the learner's model with.
+  The learner never steps it.
+  """
+
+  def __init__(self, observation_space, action_space):
+    self.observation_space = observation_space
+    self.action_space = action_space
+
+  def reset(self, seed=None, options=None):
+    raise NotImplementedError("The learner's env is not stepped")
+
+  def step(self, action):
+    raise NotImplementedError("The learner's env is not stepped")
+
+
+@dataclass
+class ActorStats:
+  envs: int
+  last_seen: float = field(default_factory=time.monotonic)
+  rollouts: int = 0
+  steps: int = 0
+  # rollouts dropped for a policy lag above max_policy_lag
+  dropped: int = 0
+  steps_per_s: float = 0.0
+  lag: int = 0
+  missing: bool = False
+
+
+class Learner(object):
+  """
+  Trains PPO on the rollouts of remote Actors. Once rollouts covering at least
+  learner_batch_envs envs have arrived, from whichever actors, they are joined
+  along the env axis into one rollout buffer for a PPO update, and the new
+  weights are published. The weights are also republished every
+  weights_interval_s, for actors that joined since.
+
+  Rollouts collected with weights more than max_policy_lag updates old are
+  dropped. An actor not heard from for actor_timeout_s is reported missing and
+  the learner carries on with the others.
+  """
+
+  def __init__(self, config, session_path: Path, resume_from=None):
+    self.config = config
+    self.session_path = Path(session_path)
+    self.resume_from = resume_from
+    self.batch_envs = config.get("learner_batch_envs", 16)
+    self.max_policy_lag = config.get("max_policy_lag", 2)
+    self.weights_interval_s = config.get("weights_interval_s", 10.0)
+    self.actor_timeout_s = config.get("actor_timeout_s", 60)
+    self.checkpoint_every = config.get("learner_checkpoint_every", 10)
+    self.printer = RateLimitedPrinter(config.get("print_interval_s", 5.0))
+
+    context = zmq.Context.instance()
+    self.pull = context.socket(zmq.PULL)
+    # the queues are per actor, so an actor has about twice actor_queue
+    # rollouts in flight while the learner trains
+    self.pull.setsockopt(zmq.RCVHWM, config.get("actor_queue", 2))
+    self.pull.bind(config["learner_trajectory_address"])
+    self.pub = context.socket(zmq.PUB)
+    self.pub.bind(config["learner_weights_address"])
+
+    self.model: Optional[PPO] = None
+    self.checkpoint_callback: Optional[AsyncCheckpointCallback] = None
+    self.actors: Dict[Any, ActorStats] = {}
+    self.pending: List[Dict[str, np.ndarray]] = []
+    self.version = 0
+    self.last_publish = -float("inf")
+
+  def build_model(self, spaces: np.ndarray):
+    observation_space, action_space = pickle.loads(spaces.tobytes())
+    n_steps = self.config.get("actor_steps", 512)
+    self.model = PPO(
+      "CnnPolicy",
+      SpacesEnv(observation_space, action_space),
+      verbose=1,
+      n_steps=n_steps,
+      batch_size=512,
+      n_epochs=1,
+      gamma=0.999,
+    )
+    self.model.set_logger(configure(str(self.session_path), ["stdout", "csv"]))
+    checkpoint_dir = self.session_path / Path("checkpoints")
+    self.checkpoint_callback = AsyncCheckpointCallback(
+      save_freq=self.checkpoint_every,
+      directory=checkpoint_dir,
+      keep_last=self.config.get("checkpoint_keep_last", 3),
+      keep_best=self.config.get("checkpoint_keep_best", 2),
+      verbose=1,
+    )
+    self.checkpoint_callback.init_callback(self.model)
+    if self.resume_from is not None:
+      checkpoint = latest_checkpoint(Path(self.resume_from) / Path("checkpoints"))
+      if checkpoint is not None:
+        print(f"loading checkpoint {checkpoint}")
+        resume(self.model, checkpoint)
+    self.rollout_buffer = None
+
+  def publish(self):
+    buffer = io.BytesIO()
+    buffer.write(WEIGHTS.pack(self.version, self.model.gamma))
+    torch.save({k: v.cpu() for k, v in self.model.policy.state_dict().items()}, buffer)
+    self.pub.send(buffer.getbuffer())
+    self.last_publish = time.monotonic()
+
+  def receive(self, kind: bytes, header, arrays):
+    actor = header["actor"]
+    if kind == HELLO:
+      if self.model is None:
+        self.build_model(arrays["spaces"])
+      self.actors[actor] = ActorStats(header["envs"])
+      print(f"actor {actor} joined with {header['envs']} envs")
+      # the new actor waits for weights
+      self.publish()
+      return
+    stats = self.actors.get(actor)
+    if stats is None:
+      # a message from before a learner restart, the actor said hello to the
+      # previous learner
+      return
+    if kind == BYE:
+      print(f"actor {actor} left")
+      del self.actors[actor]
+      return
+    assert kind == ROLLOUT, f"Invalid message {kind}"
+    stats.last_seen = time.monotonic()
+    if stats.missing:
+      print(f"actor {actor} is back")
+      stats.missing = False
+    stats.lag = self.version - header["version"]
+    stats.steps_per_s = header["steps_per_s"]
+    if stats.lag > self.max_policy_lag:
+      stats.dropped += 1
+      return
+    stats.rollouts += 1
+    stats.steps += arrays["rewards"].size
+    self.checkpoint_callback.rewards.extend(header["episode_rewards"])
+    self.pending.append(arrays)
+
+  def check_missing(self):
+    now = time.monotonic()
+    for actor, stats in self.actors.items():
+      if not stats.missing and now - stats.last_seen > self.actor_timeout_s:
+        print(f"actor {actor} missing for {now - stats.last_seen:.0f}s")
+        stats.missing = True
+
+  def update(self, total_timesteps: int):
+    """
+    One PPO update on the pending rollouts.
+    """
+    rollout = {
+      name: np.concatenate([arrays[name] for arrays in self.pending], axis=1)
+      for name in self.pending[0]
+      if name not in ("last_values", "last_dones")
+    }
+    for name in ("last_values", "last_dones"):
+      rollout[name] = np.concatenate([arrays[name] for arrays in self.pending])
+    self.pending = []
+    model = self.model
+    n_steps, n_envs = rollout["rewards"].shape
+    if self.rollout_buffer is None or self.rollout_buffer.n_envs != n_envs:
+      self.rollout_buffer = RolloutBuffer(
+        n_steps,
+        model.observation_space,
+        model.action_space,
+        device=model.device,
+        gamma=model.gamma,
+        gae_lambda=model.gae_lambda,
+        n_envs=n_envs,
+      )
+    buffer = self.rollout_buffer
+    buffer.reset()
+    buffer.observations[:] = rollout["obs"]
+    buffer.actions[:] = rollout["actions"].reshape(buffer.actions.shape)
+    for name in ("rewards", "episode_starts", "values", "log_probs"):
+      getattr(buffer, name)[:] = rollout[name]
+    buffer.pos, buffer.full = n_steps, True
+    buffer.compute_returns_and_advantage(
+      torch.as_tensor(rollout["last_values"]), rollout["last_dones"]
+    )
+    model.rollout_buffer = buffer
+    model.num_timesteps += n_steps * n_envs
+    model._update_current_progress_remaining(model.num_timesteps, total_timesteps)
+    model.train()
+    self.version += 1
+    self.publish()
+    if self.version % self.checkpoint_every == 0:
+      self.checkpoint_callback.save()
+
+  def report(self) -> str:
+    now = time.monotonic()
+    lines = [f"policy version {self.version}  steps {self.model.num_timesteps}"]
+    for actor, stats in sorted(self.actors.items()):
+      status = "missing" if stats.missing else "ok"
+      lines.append(
+        f"  actor {actor}: {stats.steps_per_s:9.1f} steps/s  lag {stats.lag}"
+        f"  rollouts {stats.rollouts}  dropped {stats.dropped}"
+        f"  seen {now - stats.last_seen:.0f}s ago  {status}"
+      )
+      self.model.logger.record(f"actors/{actor}/steps_per_s", stats.steps_per_s)
+      self.model.logger.record(f"actors/{actor}/policy_lag", stats.lag)
+      self.model.logger.record(f"actors/{actor}/dropped", stats.dropped)
+    self.model.logger.record(
+      "actors/steps_per_s",
+      sum(stats.steps_per_s for stats in self.actors.values() if not stats.missing),
+    )
+    self.model.logger.record(
+      "actors/missing", sum(stats.missing for stats in self.actors.values())
+    )
+    self.model.logger.dump(self.model.num_timesteps)
+    return "\n".join(lines)
+
+  def run(self, total_timesteps: int):
+    print(f"learner waiting for actors on {self.config['learner_trajectory_address']}")
+    try:
+      while self.model is None or self.model.num_timesteps < total_timesteps:
+        if self.pull.poll(100):
+          self.receive(*recv_message(self.pull))
+        if self.model is None:
+          continue
+        self.check_missing()
+        pending_envs = sum(arrays["rewards"].shape[1] for arrays in self.pending)
+        if pending_envs >= self.batch_envs:
+          self.update(total_timesteps)
+        if time.monotonic() - self.last_publish >= self.weights_interval_s:
+          self.publish()
+        self.printer.print(self.report)
+    finally:
+      if self.checkpoint_callback is not None:
+        self.checkpoint_callback.close()
+      self.pull.close()
+      self.pub.close()
+
+
+def load_config(config, session_path=None):
+  with open(config, "r") as f:
+    env_config = yaml.load(f, Loader=yaml.FullLoader)
+  if session_path is None:
+    session_path = f"session_{str(uuid.uuid4())[:8]}"
+  env_config["session_path"] = Path(session_path)
+  return env_config
+
+
+def actor(config, actor_id=0, emulator="gb", max_rollouts=None, session_path=None):
+  """
+  Run actor_envs envs in this process and send their rollouts to the learner.
+  """
+  env_config = load_config(config, session_path)
+  env_config["num_envs"] = env_config.get("actor_envs", 4)
+  emulator_type = EMULATORS[emulator]
+  env = BatchedGameEnv(
+    [
+      lambda: create_env(env_config, PokemonRedReward, emulator_type)
+      for _ in range(env_config.get("actor_envs", 4))
+    ]
+  )
+  # image observations are transposed for the CNN as PPO does
+  env = PPO._wrap_env(env, verbose=0)
+  Actor(env_config, actor_id, env).run(max_rollouts)
+
+
+def learner(config, total_timesteps=10_000_000, resume_from=None):
+  """
+  Train on rollouts from actors. resume_from is a session directory to continue
+  from its latest checkpoint.
+  """
+  env_config = load_config(config, resume_from)
+  Learner(env_config, env_config["session_path"], resume_from).run(total_timesteps)
+
+
+def local(config, num_actors=2, total_timesteps=100_000, emulator="synthetic"):
+  """
+  A learner and num_actors actor processes on this machine, by default on
+  SyntheticEmulator so no ROM is needed.
+  """
+  context = multiprocessing.get_context("spawn")
+  actors = [
+    context.Process(target=actor, args=(config, i, emulator), daemon=True)
+    for i in range(num_actors)
+  ]
+  for process in actors:
+    process.start()
+  try:
+    learner(config, total_timesteps)
+  finally:
+    for process in actors:
+      process.terminate()
+      process.join()
+
+
+if __name__ == "__main__":
+  fire.Fire({"actor": actor, "learner": learner, "local": local})
@@ -0,0 +1,87 @@
+from pathlib import Path
+import queue
+import threading
+import traceback
+from typing import Union
+import numpy as np
+from PIL import Image
+
+
+class ArtifactWriter(object):
+  """
+  Writes images from a background thread so the env never waits on encoding or
+  disk. Images are copied when submitted and queued, at most max_queue at a
+  time. When the queue is full, full_policy "drop" discards droppable images
+  and "block" waits for room; images submitted with droppable=False always wait.
+  An image that fails to be written is reported and counted in failed.
+  """
+
+  def __init__(self, max_queue=64, full_policy="drop", jpeg_quality=90):
+    assert full_policy in ("drop", "block"), "Invalid artifact_full_policy"
+    self.full_policy = full_policy
+    self.jpeg_quality = jpeg_quality
+    self.queue = queue.Queue(maxsize=max_queue)
+    self.written = 0
+    self.dropped = 0
+    self.failed = 0
+    self.thread = None
+
+  def submit(self, path, image: Union[np.ndarray, bytes], droppable=True) -> bool:
+    """
+    Queue image to be written to path, return False if it was dropped. bytes
+    are written as they are.
+    """
+    if self.thread is None:
+      # Started on first use, so the writer can be built before forking
+      self.thread = threading.Thread(target=self.run, daemon=True)
+      self.thread.start()
+    if not isinstance(image, bytes):
+      image = np.array(image, dtype=np.uint8)
+    item = (Path(path), image)
+    if droppable and self.full_policy == "drop":
+      try:
+        self.queue.put_nowait(item)
+      except queue.Full:
+        self.dropped += 1
+        return False
+    else:
+      self.queue.put(item)
+    return True
+
+  def run(self):
+    while True:
+      item = self.queue.get()
+      try:
+        if item is None:
+          return
+        self.write(*item)
+      except Exception:
+        self.failed += 1
+        print(f"failed to write {item[0]}")
+        traceback.print_exc()
+      finally:
+        self.queue.task_done()
+
+  def write(self, path: Path, image: Union[np.ndarray, bytes]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(image, bytes):
+      path.write_bytes(image)
+    else:
+      Image.fromarray(image).save(path, quality=self.jpeg_quality)
+    self.written += 1
+
+  def queue_depth(self) -> int:
+    return self.queue.qsize()
+
+  def flush(self):
+    """
+    Wait until every queued image is written.
+    """
+    if self.thread is not None:
+      self.queue.join()
+
+  def close(self):
+    if self.thread is not None:
+      self.queue.put(None)
+      self.thread.join()
+      self.thread = None
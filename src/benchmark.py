@@ -0,0 +1,609 @@
+from functools import partial
+from pathlib import Path
+import json
+import multiprocessing
+import os
+import math
+import platform
+import signal
+import subprocess
+import time
+import tracemalloc
+import einops
+import numpy as np
+import yaml
+import zmq
+import fire
+from stable_baselines3.common.vec_env import SubprocVecEnv
+
+from artifact_writer import ArtifactWriter
+from emulator import Emulator
+from game_env import create_env
+from game_state import GameStateManager
+from gb_emulator import GBEmulator
+from games.pokemon_red import PokemonRedReward
+from novelty import NOVELTY_BACKENDS
+from observation import Observation
+from novelty_server import start_novelty_server
+from profiler import StageHistograms
+from synthetic_emulator import SyntheticEmulator
+from vec_env import GroupedSubprocVecEnv
+import visual_util
+from worker_template import WorkerTemplate, take_game_state, warm_game_states
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+def load_env_config(config):
+  with open(config, "r") as f:
+    return yaml.load(f, Loader=yaml.FullLoader)
+
+
+def time_per_step(fn, steps):
+  fn()  # warm up
+  beg = time.perf_counter()
+  for _ in range(steps):
+    fn()
+  return (time.perf_counter() - beg) / steps
+
+
+def report(name, before, after):
+  print(
+    f"{name:32s} before: {before * 1e6:9.1f} us/step"
+    f"  after: {after * 1e6:9.1f} us/step  speedup: {before / after:5.1f}x"
+  )
+
+
+def legacy_state_update(game_state_manager: GameStateManager):
+  """
+  The per-address reader GameStateManager.update used before the read plan.
+  """
+  emulator = game_state_manager.emulator
+  values = {}
+  for state in game_state_manager.states.values():
+    if isinstance(state.addr, int):
+      values[state.name] = emulator.read_memory(state.addr, state.size, state.type)
+    else:
+      values[state.name] = [
+        emulator.read_memory(addr, state.size, state.type) for addr in state.addr
+      ]
+  return values
+
+
+def game_state(config, steps=2000):
+  """
+  Per-step cost of GameStateManager.update, per-address reads vs the read plan.
+  """
+  env_config = load_env_config(config)
+  emulator = GBEmulator(env_config)
+  emulator.reset()
+  game_state_manager = GameStateManager(emulator)
+  game_state_manager.load_config(env_config["game_state"])
+
+  game_state_manager.update()
+  expected = legacy_state_update(game_state_manager)
+  for name, value in expected.items():
+    got = game_state_manager.get(name)
+    got = got if isinstance(got, int) else got.tolist()
+    assert got == value, f"{name}: {got} != {value}"
+
+  before = time_per_step(lambda: legacy_state_update(game_state_manager), steps)
+  after = time_per_step(game_state_manager.update, steps)
+  report("GameStateManager.update", before, after)
+
+
+def downscale(steps=2000):
+  """
+  Per-step cost of downscaling the screen, five skimage resizes per step before
+  vs one block average shared through the emulator's frame history.
+  """
+  frame = np.random.default_rng(0).integers(0, 256, (144, 160, 3), dtype=np.uint8)
+  shape = Emulator.downscaled_shape
+  before = time_per_step(
+    lambda: [visual_util.compress(frame, shape) for _ in range(5)], steps
+  )
+  after = time_per_step(lambda: visual_util.block_downscale(frame, shape), steps)
+  report("frame downscale", before, after)
+
+
+def reset(config, resets=500):
+  """
+  Reset latency, reading the init_state file each time before vs restoring the
+  savestate held in memory by the state pool.
+  """
+  env_config = load_env_config(config)
+  emulator = GBEmulator(env_config)
+  before = time_per_step(lambda: emulator.load_state(emulator.init_state), resets)
+  after = time_per_step(emulator.reset, resets)
+  report("GBEmulator.reset", before, after)
+
+
+def snapshot(config, snapshots=2000):
+  """
+  In-memory snapshots per second, as taken and restored by the CellArchive.
+  """
+  env_config = load_env_config(config)
+  emulator = GBEmulator(env_config)
+  emulator.reset()
+  state = emulator.save_snapshot()
+  save = time_per_step(emulator.save_snapshot, snapshots)
+  restore = time_per_step(lambda: emulator.restore_snapshot(state), snapshots)
+  print(
+    f"{len(state)} byte snapshots  save: {1 / save:9.1f}/s"
+    f"  restore: {1 / restore:9.1f}/s"
+  )
+
+
+def legacy_obs_mem(obs: Observation):
+  """
+  Observation.create_obs_mem before the preallocated buffer, with the
+  placeholder bar values it used.
+  """
+  w = obs.output_shape[1]
+  h = obs.memory_height
+
+  def make_reward_channel(r_val):
+    col_steps = obs.col_steps
+    max_r_val = (w - 1) * h * col_steps
+    r_val = min(r_val, max_r_val)
+    row = math.floor(r_val / (h * col_steps))
+    memory = np.zeros(shape=(h, w), dtype=np.uint8)
+    memory[:, :row] = 255
+    row_covered = row * h * col_steps
+    col = math.floor((r_val - row_covered) / col_steps)
+    memory[:col, row] = 255
+    col_covered = col * col_steps
+    last_pixel = math.floor(r_val - row_covered - col_covered)
+    memory[col, row] = last_pixel * (255 // col_steps)
+    return memory
+
+  level, hp, explore = 1, 2, 3
+  full_memory = np.stack(
+    (make_reward_channel(level), make_reward_channel(hp), make_reward_channel(explore)),
+    axis=-1,
+  )
+  compressed_frames = obs.emulator.get_last_n_downscaled_frames(obs.frame_stacks)
+  pad = np.zeros(shape=(obs.mem_padding, obs.output_shape[1], 3), dtype=np.uint8)
+  return np.concatenate(
+    (
+      full_memory,
+      pad,
+      einops.rearrange(obs.recent_memory, "(w h) c -> h w c", h=h),
+      pad,
+      einops.rearrange(compressed_frames, "f h w c -> (f h) w c"),
+    ),
+    axis=0,
+  )
+
+
+def bytes_allocated_per_call(fn, calls):
+  """
+  Mean peak of memory traced by tracemalloc during fn above what was in use
+  before it, i.e. the temporaries and results fn allocates.
+  """
+  fn()  # warm up
+  tracemalloc.start()
+  total = 0
+  for _ in range(calls):
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    fn()
+    total += tracemalloc.get_traced_memory()[1] - current
+  tracemalloc.stop()
+  return total / calls
+
+
+def observation(config, steps=2000):
+  """
+  Per-step cost and allocations of Observation.create_obs_mem, concatenating
+  fresh arrays before vs updating the preallocated buffer.
+  """
+  env_config = load_env_config(config)
+  env_config["session_path"] = f"/tmp/gamebrain_bench_{os.getpid()}"
+  env = make_bench_env(env_config)()
+  for action in range(10):
+    env.step(action % env.emulator.action_len())
+  before = time_per_step(lambda: legacy_obs_mem(env.obs), steps)
+  after = time_per_step(env.obs.create_obs_mem, steps)
+  report("Observation.create_obs_mem", before, after)
+  for name, fn in (
+    ("before", lambda: legacy_obs_mem(env.obs)),
+    ("after", env.obs.create_obs_mem),
+  ):
+    print(
+      f"{name:6s} bytes allocated per step: {bytes_allocated_per_call(fn, 200):9.0f}"
+    )
+
+
+def run_actions(emulator: GBEmulator, actions):
+  """
+  Run actions from the init state, return the WRAM and screen after each one and
+  the elapsed time.
+  """
+  emulator.reset()
+  ram, frames = [], []
+  beg = time.perf_counter()
+  for action in actions:
+    emulator.run_action(action)
+    ram.append(emulator.read_block(0xC000, 0x2000))
+    frames.append(emulator.current_frame())
+  return ram, frames, time.perf_counter() - beg
+
+
+def render(config, steps=1000, seed=0):
+  """
+  Check that render_last_frame_only leaves RAM and the final frames unchanged
+  and compare steps/sec with and without it.
+  """
+  env_config = load_env_config(config)
+  env_config["headless"] = True
+  actions = np.random.default_rng(seed).integers(0, 6, steps)
+  results = {}
+  for render_last_frame_only in (False, True):
+    env_config["render_last_frame_only"] = render_last_frame_only
+    emulator = GBEmulator(env_config)
+    results[render_last_frame_only] = run_actions(emulator, actions)
+    emulator.pyboy.stop(save=False)
+
+  (ram_full, frames_full, t_full), (ram_last, frames_last, t_last) = (
+    results[False],
+    results[True],
+  )
+  for step in range(steps):
+    assert np.array_equal(ram_full[step], ram_last[step]), f"RAM differs at {step}"
+    assert np.array_equal(
+      frames_full[step], frames_last[step]
+    ), f"Frame differs at {step}"
+  print(f"RAM and frames identical over {steps} steps")
+  print(
+    f"render every frame: {steps / t_full:8.1f} steps/s"
+    f"  render last frame only: {steps / t_last:8.1f} steps/s"
+    f"  speedup: {t_full / t_last:5.2f}x"
+  )
+
+
+def novelty(config, steps=2000, seed=0, out=None):
+  """
+  Per-step cost, memory and novelty count curve of every novelty backend over
+  the same random action sequence. Curves are written to out as JSON if given.
+  """
+  env_config = load_env_config(config)
+  emulator = GBEmulator(env_config)
+  game_state_manager = GameStateManager(emulator)
+  game_state_manager.load_config(env_config["game_state"])
+  actions = np.random.default_rng(seed).integers(0, emulator.action_len(), steps)
+  curves = {}
+  for name, backend_type in NOVELTY_BACKENDS.items():
+    backend = backend_type(
+      game_state_manager,
+      similar_frame_dist=env_config["sim_frame_dist"],
+      novelty_dim=env_config.get("novelty_dim", 64),
+    )
+    emulator.reset()
+    curve = []
+    elapsed = 0.0
+    for action in actions:
+      emulator.run_action(action)
+      game_state_manager.update()
+      beg = time.perf_counter()
+      backend.update()
+      elapsed += time.perf_counter() - beg
+      curve.append(backend.count())
+    curves[name] = curve
+    print(
+      f"{name:12s} {elapsed / steps * 1e6:9.1f} us/step"
+      f"  memory: {backend.memory_bytes() / 2**20:8.1f} MB"
+      f"  novel: {curve[len(curve) // 4]:6d} {curve[len(curve) // 2]:6d} {curve[-1]:6d}"
+      " (1/4, 1/2, end)"
+    )
+  if out is not None:
+    with open(out, "w") as f:
+      json.dump(curves, f)
+
+
+def novelty_client(address, worker, steps, dim, results):
+  screens = np.random.default_rng(0).random((steps, dim), dtype=np.float32) * 100
+  order = np.random.default_rng(worker).integers(0, steps, steps)
+  socket = zmq.Context.instance().socket(zmq.DEALER)
+  socket.connect(address)
+  beg = time.perf_counter()
+  for i in order:
+    socket.send(screens[i].tobytes())
+    socket.recv()
+  results.put(time.perf_counter() - beg)
+
+
+def novelty_server(workers=(1, 4, 16, 64), steps=1000, dim=64, sim_frame_dist=100.0):
+  """
+  Throughput and round-trip latency of the shared novelty server with N workers
+  sending overlapping frames. Needs no ROM.
+  """
+  for num_workers in workers:
+    address = f"ipc:///tmp/gamebrain_bench_{os.getpid()}"
+    server = start_novelty_server(
+      {"novelty_server": address, "novelty_dim": dim, "sim_frame_dist": sim_frame_dist}
+    )
+    results = multiprocessing.Queue()
+    clients = [
+      multiprocessing.Process(
+        target=novelty_client, args=(address, worker, steps, dim, results)
+      )
+      for worker in range(num_workers)
+    ]
+    beg = time.perf_counter()
+    for client in clients:
+      client.start()
+    elapsed = [results.get() for _ in clients]
+    total = time.perf_counter() - beg
+    for client in clients:
+      client.join()
+    server.terminate()
+    print(
+      f"{num_workers:3d} workers  {num_workers * steps / total:9.0f} queries/s"
+      f"  round trip: {np.mean(elapsed) / steps * 1e6:8.1f} us"
+    )
+
+
+def artifacts(images=200, out=None):
+  """
+  Env-side cost of saving a screenshot, synchronous plt.imsave before vs
+  ArtifactWriter.submit, and the writer's throughput.
+  """
+  import matplotlib.pyplot as plt
+
+  out = out or f"/tmp/gamebrain_bench_{os.getpid()}"
+  os.makedirs(out, exist_ok=True)
+  frame = np.random.default_rng(0).integers(0, 256, (144, 160, 3), dtype=np.uint8)
+  before = time_per_step(lambda: plt.imsave(f"{out}/plt.jpeg", frame), images)
+  writer = ArtifactWriter(max_queue=images + 1)
+  after = time_per_step(lambda: writer.submit(f"{out}/writer.jpeg", frame), images)
+  beg = time.perf_counter()
+  writer.flush()
+  drain = time.perf_counter() - beg
+  writer.close()
+  report("screenshot", before, after)
+  print(f"writer drained {writer.written} images, {drain:.3f}s after the last submit")
+
+
+def make_bench_env(env_config, emulator_type=GBEmulator):
+  return lambda: create_env(env_config, PokemonRedReward, emulator_type)
+
+
+def make_vec_env(kind, env_fn, num_envs, envs_per_process=1):
+  """
+  num_envs envs of env_fn with pickled observations (subproc) or shared
+  memory (shared).
+  """
+  if kind == "subproc":
+    return SubprocVecEnv([env_fn for _ in range(num_envs)])
+  assert kind == "shared", "Invalid vector env"
+  return GroupedSubprocVecEnv(
+    [
+      [env_fn for _ in range(beg, min(beg + envs_per_process, num_envs))]
+      for beg in range(0, num_envs, envs_per_process)
+    ]
+  )
+
+
+def vec_env_steps_per_s(venv, actions):
+  venv.reset()
+  beg = time.perf_counter()
+  for step_actions in actions:
+    venv.step(step_actions)
+  elapsed = time.perf_counter() - beg
+  venv.close()
+  return actions.size / elapsed
+
+
+def vec_env(config, num_envs=8, envs_per_process=1, steps=500, seed=0):
+  """
+  Vector env steps/sec with pickled observations (SubprocVecEnv) vs shared
+  memory (GroupedSubprocVecEnv).
+  """
+  env_config = load_env_config(config)
+  env_config["session_path"] = f"/tmp/gamebrain_bench_{os.getpid()}"
+  actions = np.random.default_rng(seed).integers(0, 6, (steps, num_envs))
+  for kind in ("subproc", "shared"):
+    venv = make_vec_env(kind, make_bench_env(env_config), num_envs, envs_per_process)
+    print(f"{kind:8s} {vec_env_steps_per_s(venv, actions):9.1f} env steps/s")
+
+
+def spawn(config, num_envs=20, envs_per_process=1):
+  """
+  Time until num_envs envs are ready to step when every worker starts from
+  scratch vs when they are forked from a WorkerTemplate, and to replace a killed
+  worker in both cases.
+  """
+  env_config = load_env_config(config)
+  env_config["session_path"] = f"/tmp/gamebrain_bench_{os.getpid()}"
+
+  def env_fn():
+    return create_env(
+      env_config,
+      PokemonRedReward,
+      GBEmulator,
+      take_game_state(env_config, GBEmulator),
+    )
+
+  groups = [
+    [env_fn for _ in range(beg, min(beg + envs_per_process, num_envs))]
+    for beg in range(0, num_envs, envs_per_process)
+  ]
+  actions = np.zeros(num_envs, dtype=np.int64)
+  for name in ("cold", "template"):
+    template = None
+    if name == "template":
+      template = WorkerTemplate(
+        partial(warm_game_states, env_config, GBEmulator, envs_per_process)
+      )
+      print(f"template ready in {template.startup_s:.2f}s")
+    venv = GroupedSubprocVecEnv(groups, template=template)
+    venv.reset()
+    os.kill(venv.pids[0], signal.SIGKILL)
+    venv.step(actions)
+    print(
+      f"{name:8s} startup: {venv.startup_s:6.2f}s"
+      f"  respawn: {venv.respawn_times[0]:6.2f}s"
+    )
+    venv.close()
+    if template is not None:
+      template.close()
+
+
+def suite_config(config, steps):
+  """
+  Env config for the suite: config, or the repo's own one when None, with
+  everything that writes to disk or prints turned off.
+  """
+  env_config = load_env_config(config or REPO / "game_config" / "config.yml")
+  if config is None:
+    env_config["game_state"] = str(REPO / "game_config" / "game_state.yml")
+  env_config.update(
+    session_path=f"/tmp/gamebrain_bench_{os.getpid()}",
+    headless=True,
+    # no episode ends while a stage is timed
+    max_steps=2 * steps,
+    print_rewards=False,
+    save_final_state=False,
+    save_metrics=False,
+    save_video=False,
+    record_trajectories=False,
+    record_ram_traces=False,
+    harvest_final_states=False,
+    novelty_server=None,
+    profile_steps=False,
+  )
+  return env_config
+
+
+def stage_latencies(env_config, emulator_type, steps, seed):
+  """
+  Latency summary of GameEnv.step as a whole and of its stages one by one over
+  the same random actions.
+  """
+  env = create_env(env_config, PokemonRedReward, emulator_type)
+  explore = next(
+    item for item, _ in env.reward_manager.reward_items if item.name == "explore"
+  )
+  actions = np.random.default_rng(seed).integers(0, env.emulator.action_len(), steps)
+  histograms = StageHistograms()
+
+  def timed(stage, fn, *args):
+    beg = time.perf_counter_ns()
+    fn(*args)
+    histograms.add(stage, time.perf_counter_ns() - beg)
+
+  for action in actions:
+    timed("GameEnv.step", env.step, action)
+  env.reset()
+  for action in actions:
+    timed("Emulator.run_action", env.emulator.run_action, action)
+    timed("GameStateManager.update", env.game_state_manager.update)
+    timed("ExplorationReward.update", explore.update)
+    timed("Observation.create_obs_mem", env.obs.create_obs_mem)
+  env.close()
+  return histograms.summary()
+
+
+def git_commit():
+  try:
+    return subprocess.run(
+      ["git", "rev-parse", "HEAD"],
+      cwd=REPO,
+      capture_output=True,
+      text=True,
+      check=True,
+    ).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def suite(
+  out="benchmark.json",
+  config=None,
+  steps=1000,
+  workers=(1, 4, 20, 64),
+  vec_steps=200,
+  vec_envs=("subproc", "shared"),
+  synthetic_cost_us=0.0,
+  seed=0,
+):
+  """
+  Stage latencies and vector env steps/sec at each number of workers, written to
+  out as JSON to compare commits. Runs on SyntheticEmulator, so no ROM is
+  needed, and also on the ROM of config when it is given and present.
+  synthetic_cost_us is the emulation cost the synthetic backend simulates.
+  """
+  env_config = suite_config(config, steps)
+  backends = {
+    "synthetic": (
+      {**env_config, "synthetic_cost_us": synthetic_cost_us},
+      SyntheticEmulator,
+    )
+  }
+  results = {
+    "commit": git_commit(),
+    "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    "host": platform.node(),
+    "cpus": os.cpu_count(),
+    "python": platform.python_version(),
+    "params": {
+      "steps": steps,
+      "vec_steps": vec_steps,
+      "synthetic_cost_us": synthetic_cost_us,
+      "seed": seed,
+    },
+    "backends": {},
+  }
+  if config is not None:
+    missing = [
+      key for key in ("gb_path", "init_state") if not Path(env_config[key]).exists()
+    ]
+    if missing:
+      results["backends"]["rom"] = {"skipped": f"missing {', '.join(missing)}"}
+    else:
+      backends["rom"] = (env_config, GBEmulator)
+
+  for name, (backend_config, emulator_type) in backends.items():
+    stages = stage_latencies(backend_config, emulator_type, steps, seed)
+    for stage, stats in stages.items():
+      print(
+        f"{name:9s} {stage:28s} mean: {stats['mean_us']:9.1f} us"
+        f"  p50: {stats['p50_us']:9.1f} us  p99: {stats['p99_us']:9.1f} us"
+      )
+    throughput = {}
+    for kind in vec_envs:
+      throughput[kind] = {}
+      for num_envs in workers:
+        actions = np.random.default_rng(seed).integers(0, 6, (vec_steps, num_envs))
+        venv = make_vec_env(
+          kind, make_bench_env(backend_config, emulator_type), num_envs
+        )
+        steps_per_s = vec_env_steps_per_s(venv, actions)
+        throughput[kind][str(num_envs)] = steps_per_s
+        print(
+          f"{name:9s} {kind:8s} {num_envs:3d} workers {steps_per_s:9.1f} env steps/s"
+        )
+    results["backends"][name] = {"stages": stages, "vec_env_steps_per_s": throughput}
+
+  with open(out, "w") as f:
+    json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+  fire.Fire(
+    {
+      "game_state": game_state,
+      "downscale": downscale,
+      "render": render,
+      "observation": observation,
+      "reset": reset,
+      "snapshot": snapshot,
+      "novelty": novelty,
+      "novelty_server": novelty_server,
+      "artifacts": artifacts,
+      "vec_env": vec_env,
+      "spawn": spawn,
+      "suite": suite,
+    }
+  )
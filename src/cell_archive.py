@@ -0,0 +1,159 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple
+import numpy as np
+
+from emulator import Emulator
+from game_state import GameStateManager
+
+
+@dataclass
+class Cell:
+  id: int
+  # Score and episode step of the visit the snapshot was taken at
+  score: float
+  steps: int
+  # None while spilled to path
+  snapshot: Optional[bytes]
+  path: Optional[Path] = None
+  visits: int = 1
+  chosen: int = 0
+
+
+class CellArchive(object):
+  """
+  Go-Explore style archive of emulator snapshots, one per cell, a cell being the
+  values of cell_fields in the game state. A cell keeps the snapshot of its best
+  visit: the highest score, then the fewest steps since the start of the game,
+  counting the steps of the cell an episode started from. A snapshot is only
+  taken when the env enters a cell, not while it stays in it.
+
+  choose() picks the start of a reset: with probability reset_prob a cell, with
+  weight 1 / sqrt(1 + visits + chosen) so that rarely seen cells are preferred.
+  Snapshots beyond max_memory_mb, the budget of this archive alone, are spilled
+  to directory, least recently used first, and read back when their cell is
+  chosen.
+  """
+
+  def __init__(
+    self,
+    emulator: Emulator,
+    game_state_manager: GameStateManager,
+    directory,
+    cell_fields: Sequence[str] = ("map_id", "x", "y", "badges"),
+    reset_prob=0.5,
+    max_memory_mb=256,
+    seed=None,
+  ):
+    self.emulator = emulator
+    self.game_state_manager = game_state_manager
+    self.directory = Path(directory)
+    self.cell_fields = tuple(cell_fields)
+    self.reset_prob = reset_prob
+    self.max_memory = max_memory_mb * 1024 * 1024
+    self.rng = np.random.default_rng(seed)
+    self.cells: Dict[tuple, Cell] = {}
+    # keys of the cells whose snapshot is in memory, least recently used first
+    self.in_memory: "OrderedDict[tuple, None]" = OrderedDict()
+    self.memory = 0
+    self.spilled = 0
+    self.last_key = None
+
+  def __len__(self):
+    return len(self.cells)
+
+  def key(self) -> tuple:
+    values = (self.game_state_manager.get(name) for name in self.cell_fields)
+    return tuple(v if isinstance(v, int) else tuple(v.tolist()) for v in values)
+
+  def start_episode(self):
+    self.last_key = None
+
+  def update(self, score: float, steps: int):
+    """
+    Record the current step of the env, after its game state update. steps
+    count from the start of the game, not of the episode.
+    """
+    key = self.key()
+    if key == self.last_key:
+      return
+    self.last_key = key
+    cell = self.cells.get(key)
+    if cell is None:
+      self.cells[key] = Cell(len(self.cells), score, steps, None)
+      self.store(key, self.emulator.save_snapshot())
+      return
+    cell.visits += 1
+    if score > cell.score or (score == cell.score and steps < cell.steps):
+      cell.score, cell.steps = score, steps
+      self.store(key, self.emulator.save_snapshot())
+
+  def store(self, key, snapshot: bytes):
+    cell = self.cells[key]
+    if cell.snapshot is not None:
+      self.memory -= len(cell.snapshot)
+    elif cell.path is not None:
+      cell.path.unlink()
+      cell.path = None
+      self.spilled -= 1
+    cell.snapshot = snapshot
+    self.memory += len(snapshot)
+    self.in_memory[key] = None
+    self.in_memory.move_to_end(key)
+    while self.memory > self.max_memory and len(self.in_memory) > 1:
+      self.spill(next(iter(self.in_memory)))
+
+  def spill(self, key):
+    cell = self.cells[key]
+    self.directory.mkdir(parents=True, exist_ok=True)
+    cell.path = self.directory / Path(f"cell_{cell.id}.state")
+    with open(cell.path, "wb") as f:
+      f.write(cell.snapshot)
+    self.memory -= len(cell.snapshot)
+    cell.snapshot = None
+    del self.in_memory[key]
+    self.spilled += 1
+
+  def choose(self) -> Optional[Tuple[str, bytes, int]]:
+    """
+    Name, snapshot and steps of the cell to start the next episode from, or
+    None to start as usual.
+    """
+    if not self.cells or self.rng.random() >= self.reset_prob:
+      return None
+    keys = list(self.cells)
+    weights = np.array(
+      [1 / np.sqrt(1 + cell.visits + cell.chosen) for cell in self.cells.values()]
+    )
+    key = keys[self.rng.choice(len(keys), p=weights / weights.sum())]
+    cell = self.cells[key]
+    cell.chosen += 1
+    if cell.snapshot is None:
+      with open(cell.path, "rb") as f:
+        self.store(key, f.read())
+    else:
+      self.in_memory.move_to_end(key)
+    return f"cell {key}", cell.snapshot, cell.steps
+
+  def state(self) -> Dict[tuple, tuple]:
+    """
+    Every cell with its snapshot, spilled ones read back, for a checkpoint.
+    """
+    state = {}
+    for key, cell in self.cells.items():
+      snapshot = cell.snapshot
+      if snapshot is None:
+        with open(cell.path, "rb") as f:
+          snapshot = f.read()
+      state[key] = (cell.score, cell.steps, cell.visits, cell.chosen, snapshot)
+    return state
+
+  def load_state(self, state: Dict[tuple, tuple]):
+    """
+    Fill an empty archive with the cells of state().
+    """
+    assert not self.cells, "Cells are only loaded into an empty archive"
+    for key, (score, steps, visits, chosen, snapshot) in state.items():
+      self.cells[key] = Cell(len(self.cells), score, steps, None, None, visits, chosen)
+      self.store(key, snapshot)
@@ -0,0 +1,216 @@
+from collections import deque
+from pathlib import Path
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from typing import Any, Dict, Optional
+import numpy as np
+import torch
+from stable_baselines3.common.base_class import BaseAlgorithm
+from stable_baselines3.common.callbacks import BaseCallback
+from stable_baselines3.common.vec_env import VecEnv
+
+INDEX = "checkpoints.json"
+
+
+def to_cpu(value):
+  """
+  Copy of value with every tensor in it cloned to the CPU.
+  """
+  if isinstance(value, torch.Tensor):
+    return value.detach().to("cpu", copy=True)
+  if isinstance(value, dict):
+    return {k: to_cpu(v) for k, v in value.items()}
+  if isinstance(value, (list, tuple)):
+    return type(value)(to_cpu(v) for v in value)
+  return value
+
+
+def load_index(directory) -> Dict[str, Dict[str, Any]]:
+  """
+  {file name: {"steps", "reward"}} of the checkpoints kept in directory.
+  """
+  path = Path(directory) / Path(INDEX)
+  if not path.exists():
+    return {}
+  with open(path, "r") as f:
+    return json.load(f)
+
+
+def latest_checkpoint(directory) -> Optional[Path]:
+  index = load_index(directory)
+  if not index:
+    return None
+  name = max(index, key=lambda name: index[name]["steps"])
+  return Path(directory) / Path(name)
+
+
+def latest_session(root=".") -> Optional[Path]:
+  """
+  The most recently checkpointed session_* directory under root.
+  """
+  indexes = list(Path(root).glob(f"session_*/checkpoints/{INDEX}"))
+  if not indexes:
+    return None
+  return max(indexes, key=lambda path: path.stat().st_mtime).parent.parent
+
+
+class CheckpointWriter(object):
+  """
+  Writes checkpoints to directory from a background thread, then deletes all
+  but the keep_last newest ones and the keep_best ones with the highest
+  reward. Submitting waits when max_queue checkpoints are already pending, a
+  checkpoint is never dropped. A checkpoint that fails to be written is
+  reported and counted in failed, and the writer goes on with the next one.
+  """
+
+  def __init__(self, directory, keep_last=3, keep_best=2, max_queue=2):
+    self.directory = Path(directory)
+    self.keep_last = keep_last
+    self.keep_best = keep_best
+    self.index = load_index(self.directory)
+    self.queue = queue.Queue(maxsize=max_queue)
+    self.thread = None
+    self.failed = 0
+
+  def submit(self, checkpoint: Dict[str, Any]):
+    if self.thread is None:
+      self.thread = threading.Thread(target=self.run, daemon=True)
+      self.thread.start()
+    self.queue.put(checkpoint)
+
+  def run(self):
+    while True:
+      checkpoint = self.queue.get()
+      try:
+        if checkpoint is None:
+          return
+        self.write(checkpoint)
+      except Exception:
+        self.failed += 1
+        print(f"failed to write checkpoint at {checkpoint['num_timesteps']} steps")
+        traceback.print_exc()
+      finally:
+        self.queue.task_done()
+
+  def write(self, checkpoint: Dict[str, Any]):
+    self.directory.mkdir(parents=True, exist_ok=True)
+    name = f"checkpoint_{checkpoint['num_timesteps']}.pt"
+    path = self.directory / Path(name)
+    # written aside then renamed, so a crash never leaves half a checkpoint
+    torch.save(checkpoint, path.with_suffix(".tmp"))
+    os.replace(path.with_suffix(".tmp"), path)
+    self.index[name] = {
+      "steps": checkpoint["num_timesteps"],
+      "reward": checkpoint["reward"],
+    }
+    self.retain()
+    index_path = self.directory / Path(INDEX)
+    with open(index_path.with_suffix(".tmp"), "w") as f:
+      json.dump(self.index, f, indent=2)
+    os.replace(index_path.with_suffix(".tmp"), index_path)
+
+  def retain(self):
+    keep = set()
+    if self.keep_last > 0:
+      by_steps = sorted(self.index, key=lambda name: self.index[name]["steps"])
+      keep.update(by_steps[-self.keep_last :])
+    rewarded = [name for name in self.index if self.index[name]["reward"] is not None]
+    if self.keep_best > 0:
+      by_reward = sorted(rewarded, key=lambda name: self.index[name]["reward"])
+      keep.update(by_reward[-self.keep_best :])
+    for name in list(self.index):
+      if name not in keep:
+        (self.directory / Path(name)).unlink(missing_ok=True)
+        del self.index[name]
+
+  def flush(self):
+    """
+    Wait until every submitted checkpoint is written.
+    """
+    if self.thread is not None:
+      self.queue.join()
+
+  def close(self):
+    if self.thread is not None:
+      self.queue.put(None)
+      self.thread.join()
+      self.thread = None
+
+
+class AsyncCheckpointCallback(BaseCallback):
+  """
+  Every save_freq calls, copies the policy, the optimizer state and with
+  save_archives the envs' cell archives to memory, and leaves serializing and
+  writing them to a CheckpointWriter. The reward of a checkpoint is the mean
+  final reward of the last reward_window episodes. Novelty backends are not
+  saved: they are cleared at every reset, and a resumed env starts a new
+  episode anyway.
+  """
+
+  def __init__(
+    self,
+    save_freq: int,
+    directory,
+    keep_last=3,
+    keep_best=2,
+    save_archives=False,
+    reward_window=100,
+    verbose=0,
+  ):
+    super().__init__(verbose)
+    self.save_freq = save_freq
+    self.writer = CheckpointWriter(directory, keep_last, keep_best)
+    self.save_archives = save_archives
+    self.rewards = deque(maxlen=reward_window)
+
+  def _on_step(self) -> bool:
+    for info, done in zip(self.locals["infos"], self.locals["dones"]):
+      if done and not info.get("worker_respawned", False):
+        self.rewards.append(info["reward"])
+    if self.n_calls % self.save_freq == 0:
+      self.save()
+    return True
+
+  def save(self):
+    beg = time.perf_counter()
+    checkpoint = {
+      "num_timesteps": self.model.num_timesteps,
+      "n_updates": self.model._n_updates,
+      "reward": float(np.mean(self.rewards)) if self.rewards else None,
+      "policy": to_cpu(self.model.policy.state_dict()),
+      "optimizer": to_cpu(self.model.policy.optimizer.state_dict()),
+      "archives": None,
+    }
+    if self.save_archives:
+      checkpoint["archives"] = self.training_env.env_method("archive_state")
+    self.writer.submit(checkpoint)
+    if self.verbose > 0:
+      print(
+        f"checkpoint at {self.model.num_timesteps} steps,"
+        f" training paused {time.perf_counter() - beg:.3f}s"
+      )
+
+  def _on_training_end(self):
+    self.writer.flush()
+
+  def close(self):
+    self.writer.close()
+
+
+def resume(model: BaseAlgorithm, path, env: Optional[VecEnv] = None):
+  """
+  Load a checkpoint of AsyncCheckpointCallback into model, and its cell
+  archives into env when it has them.
+  """
+  checkpoint = torch.load(path, map_location=model.device)
+  model.policy.load_state_dict(checkpoint["policy"])
+  model.policy.optimizer.load_state_dict(checkpoint["optimizer"])
+  model.num_timesteps = checkpoint["num_timesteps"]
+  model._n_updates = checkpoint["n_updates"]
+  if env is not None and checkpoint["archives"] is not None:
+    for i, archive in enumerate(checkpoint["archives"]):
+      env.env_method("load_archive_state", archive, indices=[i])
@@ -1,9 +1,19 @@
 from abc import ABC, abstractmethod
+from typing import Callable, Optional
 import numpy as np
 import enum
 
 
 class Emulator(ABC):
+  # Shape of the frames returned by the downscaled frame accessors and the
+  # visual_util.downscale method producing them
+  downscaled_shape = (36, 40, 3)
+  downscale_method = "block"
+  # Name of the state the last reset started from
+  start_state = None
+  # Game frames one action takes
+  frames_per_action = 1
+
   @abstractmethod
   def action_len(self) -> int:
     pass
@@ -24,16 +34,85 @@ class Emulator(ABC):
     pass
 
   @abstractmethod
+  def emulate(self, action: int):
+    """
+    Advance the game by one action without recording the new frame.
+    """
+    pass
+
+  @abstractmethod
+  def emulate_idle(self):
+    """
+    Advance the game by as many frames as one action without pressing anything.
+    """
+    pass
+
+  @abstractmethod
+  def record_frame(self, downscaled=None):
+    """
+    Push the current frame into the frame histories. downscaled is the current
+    frame already downscaled to downscaled_shape, e.g. as part of a batch, and is
+    computed when not given.
+    """
+    pass
+
   def run_action(self, action: int):
+    self.emulate(action)
+    self.record_frame()
+
+  def fast_forward(
+    self, is_idle: Callable[[], bool], action: Optional[int], max_actions: int
+  ):
+    """
+    Emulate action, or no input when None, while is_idle() holds, at most
+    max_actions times, without recording the frames in between. Return how many
+    actions ran.
+    """
+    count = 0
+    while count < max_actions and is_idle():
+      if action is None:
+        self.emulate_idle()
+      else:
+        self.emulate(action)
+      count += 1
+    return count
+
+  @abstractmethod
+  def get_last_n_frames(self, n=3, out=None) -> np.ndarray:
+    """
+    Return the most recent n frames as a numpy array, newest first. n is at most
+    the configured history depth. Without out this may be a read-only view that
+    is only valid until the next run_action, with out the frames are copied into
+    the preallocated array.
+    """
+    pass
+
+  @abstractmethod
+  def current_downscaled_frame(self) -> np.ndarray:
+    """
+    Return the current frame downscaled to downscaled_shape. It is computed
+    once per run_action and shared by every consumer.
+    """
     pass
 
   @abstractmethod
-  def get_last_n_frames(self, n=3) -> np.ndarray:
+  def get_last_n_downscaled_frames(self, n=3, out=None) -> np.ndarray:
     """
-    Return the most recent n frames as a numpy array
+    Same as get_last_n_frames for the downscaled frames.
     """
     pass
 
+  @abstractmethod
+  def save_snapshot(self) -> bytes:
+    """
+    Return the complete emulator state, which restore_snapshot returns to.
+    """
+    pass
+
+  @abstractmethod
+  def restore_snapshot(self, snapshot: bytes):
+    pass
+
   @abstractmethod
   def read_one_byte(self, address) -> int:
     """
@@ -41,6 +120,17 @@ class Emulator(ABC):
     """
     pass
 
+  def read_block(self, address, size) -> np.ndarray:
+    """
+    Read size consecutive bytes starting at address as a uint8 array.
+    Backends with direct memory access should override this.
+    """
+    return np.fromiter(
+      (self.read_one_byte(address + i) for i in range(size)),
+      dtype=np.uint8,
+      count=size,
+    )
+
   def read_memory(self, address, size, type="hex"):
     """
     Read a value from memory as hex.
@@ -69,7 +159,7 @@ class Emulator(ABC):
     """
     result = 0
     for i in range(size):
-      value = self.read_memory(address, 1)
+      value = self.read_memory(address + i, 1)
       to_dec = 10 * ((value >> 4) & 0x0F) + (value & 0x0F)
       result += to_dec * (100**i)
     return result
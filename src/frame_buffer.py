@@ -0,0 +1,41 @@
+from typing import Optional, Tuple
+import numpy as np
+
+
+class FrameRing(object):
+  """
+  Fixed-depth frame history, newest first.
+
+  Every frame is written twice, at pos and pos + depth of a buffer that holds
+  2 * depth frames. The newest n frames are then always the contiguous slice
+  buffer[pos : pos + n], so they can be returned in order as a view.
+  """
+
+  def __init__(self, depth: int, shape: Tuple[int, ...], dtype=np.uint8):
+    assert depth > 0, "Invalid depth"
+    self.depth = depth
+    self.buffer = np.zeros((2 * depth,) + tuple(shape), dtype=dtype)
+    self.pos = 0
+
+  def push(self, frame: np.ndarray):
+    self.pos = (self.pos - 1) % self.depth
+    self.buffer[self.pos] = frame
+    self.buffer[self.pos + self.depth] = frame
+
+  def latest(self, n: Optional[int] = None, out: Optional[np.ndarray] = None):
+    """
+    Return the newest n frames. Without out this is a read-only view that is
+    only valid until the next push, with out the frames are copied into it.
+    """
+    n = self.depth if n is None else n
+    assert n <= self.depth, f"Only {self.depth} frames are kept"
+    view = self.buffer[self.pos : self.pos + n]
+    if out is not None:
+      np.copyto(out, view)
+      return out
+    view.flags.writeable = False
+    return view
+
+  def clear(self):
+    self.buffer.fill(0)
+    self.pos = 0
@@ -1,12 +1,15 @@
-from typing import Type
+from typing import Optional, Type
 import uuid
 from pathlib import Path
 
 
 from gymnasium import Env, spaces
+import numpy as np
 
+from cell_archive import CellArchive
 from emulator import Emulator
 from game_state import GameStateManager
+from profiler import NullProfiler, StageProfiler
 from progress_tracker import ProgressTracker
 from reward import RewardManager
 from observation import Observation
@@ -28,13 +31,52 @@ class GameEnv(Env):
     Path(config["session_path"]).mkdir(exist_ok=True)
     self.current_action = emulator.get_action(0)
     self.emulator = emulator
-    self.progress_tracker = ProgressTracker(config, self.emulator)
+    self.progress_tracker = ProgressTracker(config, self.emulator, game_state_manager)
+    self.session_path = config["session_path"]
+    # Per-stage step timings, see profiler.py
+    self.profiler = (
+      StageProfiler() if config.get("profile_steps", False) else NullProfiler()
+    )
     self.game_state_manager = game_state_manager
     self.reward_manager = reward_manager
-    self.obs = Observation(self.emulator, self.reward_manager)
+    # Spec file of the rewards, which a vector env may evaluate for all its envs
+    self.reward_spec = config.get("reward_spec")
+    self.obs = Observation(self.emulator, self.reward_manager, config)
+    # Resets may return to a cell reached in an earlier episode, see CellArchive.
+    # archive_max_memory_mb is shared by the num_envs envs of the session
+    self.archive = None
+    self.start_steps = 0
+    if config.get("cell_archive", False):
+      self.archive = CellArchive(
+        self.emulator,
+        self.game_state_manager,
+        Path(self.session_path) / Path("archive") / Path(self.instance_id),
+        cell_fields=config.get("archive_cell_fields", ("map_id", "x", "y", "badges")),
+        reset_prob=config.get("archive_reset_prob", 0.5),
+        max_memory_mb=config.get("archive_max_memory_mb", 1024)
+        / config.get("num_envs", 1),
+        seed=config.get("seed"),
+      )
     self.reset_count = 0
     self.current_reward = 0.0
     self.step_limit_reach = False
+    self.reward_drops = 0
+    # Steps where the input doesn't matter are fast-forwarded inside the step
+    # before them. "ram" detects them with the idle predicates of
+    # game_state.yml and skips them with idle_action, null for no input. Any
+    # button is safe there since the game ignores the joypad. "frame" skips
+    # without input while the screen stays the same across an action, "any"
+    # does both. A static screen is also a menu waiting for a choice, so the
+    # frame skip never presses a button.
+    self.idle_skip = config.get("idle_skip")
+    assert self.idle_skip in (None, "ram", "frame", "any"), "Invalid idle_skip"
+    self.idle_action = config.get("idle_action")
+    self.idle_max_actions = config.get("idle_max_actions", 32)
+    self.idle_actions = 0
+    self.idle_pressed = 0
+    self.idle_frame = None
+    if self.idle_skip in ("frame", "any"):
+      self.idle_frame = self.emulator.current_frame().copy()
 
     # Set this in SOME subclasses
     self.metadata = {"render.modes": []}
@@ -54,60 +96,179 @@ class GameEnv(Env):
       "reward": self.current_reward,
       "step_limit_reach": self.step_limit_reach,
       "reward_components": self.reward_manager.get_reward_components(),
+      "reward_evals_skipped": self.reward_manager.skipped_evaluations,
       "action": self.current_action.name.ljust(10),
+      "action_id": self.current_action.value,
+      "reward_drops": self.reward_drops,
+      "idle_actions": self.idle_actions,
+      "idle_pressed": self.idle_pressed,
+      "skipped_frames": self.idle_actions * self.emulator.frames_per_action,
+      "artifact_queue_depth": self.progress_tracker.writer.queue_depth(),
+      "artifacts_dropped": self.progress_tracker.writer.dropped,
+      "artifacts_failed": self.progress_tracker.writer.failed,
+      "archive_cells": len(self.archive) if self.archive is not None else 0,
     }
 
-  def reset(self, seed=None):
+  def archive_state(self):
+    return self.archive.state() if self.archive is not None else None
+
+  def load_archive_state(self, state):
+    if self.archive is not None and state is not None:
+      self.archive.load_state(state)
+
+  def reset(self, seed=None, obs_out=None):
     self.seed = seed
-    self.emulator.reset()
+    cell = self.archive.choose() if self.archive is not None else None
+    # steps of the game before the episode, for the archive's step counts
+    self.start_steps = 0
+    if cell is None:
+      self.emulator.reset()
+    else:
+      self.emulator.start_state, snapshot, self.start_steps = cell
+      self.emulator.restore_snapshot(snapshot)
     self.reward_manager.reset()
+    self.idle_actions = 0
+    self.idle_pressed = 0
 
     self.step_count = 0
     self.reset_count += 1
     self.current_reward = 0.0
+    if cell is not None:
+      # Only what the episode adds to the cell is rewarded
+      self.current_reward = self.reward_manager.update(self.game_state_manager.update())
+    if self.archive is not None:
+      self.archive.start_episode()
     self.step_limit_reach = False
-    return self.obs.create_obs_mem(), self.info()
+    info = self.info()
+    self.progress_tracker.start_episode(info)
+    return self.obs.create_obs_mem(out=obs_out), info
+
+  def close(self):
+    self.progress_tracker.close()
+    self.profiler.dump(
+      Path(self.session_path) / Path("profile") / Path(f"{self.instance_id}.json")
+    )
 
   def render(self):
     return self.emulator.current_frame()
 
-  def step(self, action):
+  def emulate(self, action):
+    """
+    Emulate action, then fast-forward the idle steps that follow it, without
+    recording the frame.
+    """
     self.current_action = self.emulator.get_action(action)
-    self.emulator.run_action(action)
-    self.game_state_manager.update()
+    if self.idle_frame is not None:
+      np.copyto(self.idle_frame, self.emulator.current_frame())
+    self.emulator.emulate(action)
+    self.idle_actions = 0
+    if self.idle_skip in ("ram", "any"):
+      self.idle_actions = self.emulator.fast_forward(
+        self.game_state_manager.is_idle, self.idle_action, self.idle_max_actions
+      )
+    self.idle_pressed = self.idle_actions if self.idle_action is not None else 0
+    if self.idle_skip in ("frame", "any"):
+      self.idle_actions += self.skip_static_frames(
+        self.idle_max_actions - self.idle_actions
+      )
+
+  def skip_static_frames(self, max_actions: int) -> int:
+    """
+    Emulate without input while the screen is the same as in idle_frame, the
+    one before the step's actions, at most max_actions times. A step whose
+    actions changed the screen costs nothing more.
+    """
+    count = 0
+    while count < max_actions and np.array_equal(
+      self.emulator.current_frame(), self.idle_frame
+    ):
+      self.emulator.emulate_idle()
+      count += 1
+    return count
+
+  def step(self, action):
+    self.profiler.start()
+    self.emulate(action)
+    self.emulator.record_frame()
+    self.profiler.lap("emulate")
+    changed_fields = self.game_state_manager.update()
+    self.profiler.lap("game_state")
+    return self.finish_step(changed_fields)
+
+  def finish_step(self, changed_fields, obs_out=None, scores=None):
+    """
+    Everything in a step after emulation and the game state update, which a
+    vector env may have done for a batch of envs, along with the reward scores
+    given. The observation is written to obs_out if given.
+    """
     old_reward = self.current_reward
-    self.current_reward = self.reward_manager.update()
+    self.current_reward = self.reward_manager.update(changed_fields, scores)
     if self.current_reward - old_reward < 0:
-      print(f"Reward drop from {old_reward} to {self.current_reward}!")
+      self.reward_drops += 1
+    self.profiler.lap("reward")
+    if self.archive is not None:
+      self.archive.update(self.current_reward, self.start_steps + self.step_count)
+      self.profiler.lap("archive")
 
-    obs_memory = self.obs.create_obs_mem()
+    obs_memory = self.obs.create_obs_mem(out=obs_out)
+    self.profiler.lap("observation")
 
     self.step_limit_reach = self.step_count >= self.max_steps
+    info = self.info()
+    self.profiler.lap("info")
     self.progress_tracker.save_step(
-      self.info(),
+      info,
     )
+    self.profiler.lap("save_step")
 
     if self.step_limit_reach:
       self.progress_tracker.save_finished_state(
         obs_memory,
         self.info(),
       )
+      self.profiler.lap("save_finished_state")
 
     self.step_count += 1
 
+    info = self.info()
+    self.profiler.lap("info")
+    if self.step_limit_reach:
+      profile = self.profiler.end_episode()
+      if profile is not None:
+        info["profile"] = profile
+
     return (
       obs_memory,
       self.current_reward - old_reward,
       False,
       self.step_limit_reach,
-      self.info(),
+      info,
     )
 
 
-def create_env(config, reward_type: Type[RewardManager], emulator: Type[Emulator]):
+def create_game_state(config, emulator: Type[Emulator]) -> GameStateManager:
+  """
+  The emulator and its compiled game states, the slow part of create_env.
+  """
   emulator = emulator(config)
   game_state_manager = GameStateManager(emulator)
   game_state_manager.load_config(config["game_state"])
+  return game_state_manager
+
+
+def create_env(
+  config,
+  reward_type: Type[RewardManager],
+  emulator: Type[Emulator],
+  game_state_manager: Optional[GameStateManager] = None,
+):
+  """
+  game_state_manager is a prebuilt create_game_state(config, emulator), e.g. by
+  a WorkerTemplate.
+  """
+  if game_state_manager is None:
+    game_state_manager = create_game_state(config, emulator)
+  emulator = game_state_manager.emulator
   game_state_manager.update()
   reward_manager = reward_type((0, 15000), config, game_state_manager)
   return GameEnv(emulator, game_state_manager, reward_manager, config)
@@ -1,6 +1,7 @@
 from dataclasses import dataclass
-from typing import Dict, List, Union
-from gb_emulator import GBEmulator
+from typing import Dict, FrozenSet, List, Optional, Union
+from emulator import Emulator
+import numpy as np
 import yaml
 
 
@@ -12,12 +13,152 @@ class GameState:
   size: int = 1
   type: str = "hex"
 
+  def addr_list(self) -> List[int]:
+    return [self.addr] if isinstance(self.addr, int) else self.addr
+
+
+@dataclass
+class IdlePredicate:
+  """
+  Holds when the value of a single address state equals eq, differs from ne or
+  has any of the given bits set. Steps where one holds are fast-forwarded,
+  see GameEnv.
+  """
+
+  state: str
+  eq: Optional[int] = None
+  ne: Optional[int] = None
+  bits: Optional[int] = None
+
+  def holds(self, value: int) -> bool:
+    return (
+      (self.eq is not None and value == self.eq)
+      or (self.ne is not None and value != self.ne)
+      or (self.bits is not None and value & self.bits != 0)
+    )
+
+
+class StatePlan(object):
+  """
+  Read plan compiled from a list of GameState.
+
+  All bytes the states need are merged into a few contiguous memory ranges that
+  are copied into one uint8 buffer per update. Every state is then decoded from
+  the buffer with vectorized gathers into one int64 value vector, where a single
+  address state takes one entry and a list state one entry per address.
+  """
+
+  def __init__(self, states: List[GameState], max_gap: int = 8):
+    addrs = sorted(
+      {
+        addr + i
+        for state in states
+        for addr in state.addr_list()
+        for i in range(state.size)
+      }
+    )
+    # Merge addresses into ranges, reading a few unused bytes is cheaper than
+    # starting another block read
+    self.ranges: List[List[int]] = []
+    for addr in addrs:
+      if self.ranges and addr - sum(self.ranges[-1]) <= max_gap:
+        self.ranges[-1][1] = addr - self.ranges[-1][0] + 1
+      else:
+        self.ranges.append([addr, 1])
+
+    offsets = {}
+    buffer_size = 0
+    for beg, size in self.ranges:
+      for i in range(size):
+        offsets[beg + i] = buffer_size + i
+      buffer_size += size
+    self.buffer = np.zeros(buffer_size, dtype=np.uint8)
+
+    self.slices: Dict[str, slice] = {}
+    groups: Dict[tuple, list] = {}
+    num_values = 0
+    for state in states:
+      addr_list = state.addr_list()
+      self.slices[state.name] = slice(num_values, num_values + len(addr_list))
+      for addr in addr_list:
+        gather = [offsets[addr + i] for i in range(state.size)]
+        groups.setdefault((state.type, state.size), []).append((num_values, gather))
+        num_values += 1
+    self.values = np.zeros(num_values, dtype=np.int64)
+
+    # One gather per (type, size): dest entries, byte offsets and byte weights
+    self.groups = []
+    for (type, size), entries in groups.items():
+      if type == "hex":
+        weights = 256 ** np.arange(size, dtype=np.int64)
+      else:
+        assert type == "dec", "Invalid type"
+        weights = 100 ** np.arange(size, dtype=np.int64)
+      dest = np.array([entry for entry, _ in entries], dtype=np.intp)
+      gather = np.array([offsets for _, offsets in entries], dtype=np.intp)
+      self.groups.append((type, dest, gather, weights))
+
+    self.names = [s.name for s in states]
+    self.starts = np.array([self.slices[name].start for name in self.names])
+    self.scalar_names = [s.name for s in states if isinstance(s.addr, int)]
+    self.scalar_index = np.array(
+      [self.slices[name].start for name in self.scalar_names], dtype=np.intp
+    )
+    self.list_names = [s.name for s in states if not isinstance(s.addr, int)]
+
+  def read(self, emulator: Emulator, out: Optional[np.ndarray] = None):
+    out = self.buffer if out is None else out
+    pos = 0
+    for beg, size in self.ranges:
+      out[pos : pos + size] = emulator.read_block(beg, size)
+      pos += size
+    return out
+
+  def decode(self, buffer: np.ndarray, out: Optional[np.ndarray] = None):
+    """
+    Decode raw buffers of shape (..., len(self.buffer)) into values of shape
+    (..., len(self.values)).
+    """
+    if out is None:
+      out = np.empty(buffer.shape[:-1] + self.values.shape, dtype=np.int64)
+    for type, dest, gather, weights in self.groups:
+      raw = buffer[..., gather]
+      if type == "dec":
+        raw = 10 * (raw >> 4) + (raw & 0x0F)
+      if len(weights) == 1:
+        out[..., dest] = raw[..., 0]
+      else:
+        out[..., dest] = raw.astype(np.int64) @ weights
+    return out
+
+  def update(self, emulator: Emulator) -> np.ndarray:
+    return self.decode(self.read(emulator), out=self.values)
+
+  def unpack(self, values: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Split values of shape (..., len(self.values)) by state, a single address
+    state into shape (...) and a list state into (..., len(addr)).
+    """
+    fields = {name: values[..., self.slices[name]] for name in self.list_names}
+    for name, index in zip(self.scalar_names, self.scalar_index):
+      fields[name] = values[..., index]
+    return fields
+
+  def view(self, name) -> np.ndarray:
+    view = self.values[self.slices[name]]
+    view.flags.writeable = False
+    return view
+
 
 class GameStateManager(object):
-  def __init__(self, emulator: GBEmulator):
+  def __init__(self, emulator: Emulator):
     self.emulator = emulator
     self.states: Dict[str, GameState] = {}
-    self.state_values: Dict[str, Union[int, List[int]]] = {}
+    self.state_values: Dict[str, Union[int, np.ndarray]] = {}
+    self.plan: Optional[StatePlan] = None
+    self.prev_values: Optional[np.ndarray] = None
+    self.changed: FrozenSet[str] = frozenset()
+    self.idle_predicates: List[IdlePredicate] = []
 
   def add_state(
     self,
@@ -29,6 +170,7 @@ class GameStateManager(object):
     type: str = "hex",
   ):
     self.states[name] = GameState(name, description, addr, size, type)
+    self.plan = None
 
   def load_config(self, config_file: str):
     with open(config_file, "r") as f:
@@ -38,18 +180,63 @@ class GameStateManager(object):
           beg, end = state["addr"].split("-")
           state["addr"] = list(range(int(beg, 16), int(end, 16) + 1))
         self.add_state(**state)
+      for predicate in config.get("idle", []):
+        predicate = IdlePredicate(**predicate)
+        assert isinstance(
+          self.states[predicate.state].addr, int
+        ), "Idle predicates take single address states"
+        self.idle_predicates.append(predicate)
+    self.compile()
 
-  def update(self):
-    for state in self.states.values():
-      if isinstance(state.addr, int):
-        self.state_values[state.name] = self.emulator.read_memory(
-          state.addr, state.size
-        )
-      else:
-        self.state_values[state.name] = [
-          self.emulator.read_memory(addr, state.size) for addr in state.addr
-        ]
+  def compile(self):
+    self.plan = StatePlan(list(self.states.values()))
+    # List states are read-only views into the plan's value vector, they are
+    # refreshed in place by every update
+    for name in self.plan.list_names:
+      self.state_values[name] = self.plan.view(name)
+    self.prev_values = None
+
+  def update(self, values: Optional[np.ndarray] = None) -> FrozenSet[str]:
+    """
+    Read all states and return the names of the states whose value changed since
+    the previous update. Every state counts as changed on the first update.
+    values are the decoded states when they were already read, e.g. as part of
+    a batch.
+    """
+    if self.plan is None:
+      self.compile()
+    if values is None:
+      values = self.plan.update(self.emulator)
+    else:
+      self.plan.values[:] = values
+      values = self.plan.values
+    scalars = values[self.plan.scalar_index].tolist()
+    self.state_values.update(zip(self.plan.scalar_names, scalars))
     self.value_valid = True
 
-  def get(self, name) -> int:
+    if self.prev_values is None:
+      self.prev_values = values.copy()
+      self.changed = frozenset(self.plan.names)
+    else:
+      diff = values != self.prev_values
+      if diff.any():
+        field_diff = np.logical_or.reduceat(diff, self.plan.starts)
+        self.changed = frozenset(self.plan.names[i] for i in np.flatnonzero(field_diff))
+        self.prev_values[:] = values
+      else:
+        self.changed = frozenset()
+    return self.changed
+
+  def get(self, name) -> Union[int, np.ndarray]:
     return self.state_values[name]
+
+  def is_idle(self) -> bool:
+    """
+    Whether an idle predicate holds for the current memory. The states are read
+    directly, not from the last update.
+    """
+    for predicate in self.idle_predicates:
+      state = self.states[predicate.state]
+      if predicate.holds(self.emulator.read_memory(state.addr, state.size, state.type)):
+        return True
+    return False
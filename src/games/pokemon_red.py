@@ -1,13 +1,20 @@
-from reward import RewardManager, SingleReward
+from reward import POPCOUNT_TABLE, RewardManager, SingleReward, popcount
 from game_state import GameStateManager
+from reward_spec import add_spec_rewards
 from typing import Tuple
+import numpy as np
 
 
-def bit_count(bits):
-  return bin(bits).count("1")
+def running_max(values: np.ndarray) -> np.ndarray:
+  """
+  Maximum of values so far and 0 at each step, as a float array.
+  """
+  return np.maximum.accumulate(np.maximum(values, 0)).astype(np.float64)
 
 
 class EventReward(SingleReward):
+  fields = ("event_flags",)
+
   def __init__(self, name: str, game_state_manager: GameStateManager):
     super().__init__(name, game_state_manager)
     self.max_event_rew = 0
@@ -22,17 +29,22 @@ class EventReward(SingleReward):
     # museum_ticket = (0xD754, 0)
     base_event_flags = 13
     return max(
-      sum([bit_count(flag) for flag in self.game_state_manager.get("event_flags")])
-      - base_event_flags,
+      popcount(self.game_state_manager.get("event_flags")) - base_event_flags,
       # - int(self.read_bit(museum_ticket[0], museum_ticket[1])),
       0,
     )
 
+  def calculate_trace(self, fields):
+    base_event_flags = 13
+    return running_max(POPCOUNT_TABLE[fields["event_flags"]].sum(-1) - base_event_flags)
+
   def reset(self):
     self.max_event_rew = 0
 
 
 class HealthReward(SingleReward):
+  fields = ("party_current_hp", "party_max_hp", "party_size")
+
   def __init__(self, name: str, game_state_manager: GameStateManager):
     super().__init__(name, game_state_manager)
     self.last_health = 0
@@ -57,11 +69,23 @@ class HealthReward(SingleReward):
     return self.total_healing_rew
 
   def read_hp_fraction(self):
-    hp_sum = sum(self.game_state_manager.get("party_current_hp"))
-    max_hp_sum = sum(self.game_state_manager.get("party_max_hp"))
+    hp_sum = int(self.game_state_manager.get("party_current_hp").sum())
+    max_hp_sum = int(self.game_state_manager.get("party_max_hp").sum())
     max_hp_sum = max(max_hp_sum, 1)
     return hp_sum / max_hp_sum
 
+  def calculate_trace(self, fields):
+    health = fields["party_current_hp"].sum(-1) / np.maximum(
+      fields["party_max_hp"].sum(-1), 1
+    )
+    last_health = np.concatenate(([0.0], health[:-1]))
+    party_size = fields["party_size"]
+    last_party_size = np.concatenate(([0], party_size[:-1]))
+    healed = (
+      (health > last_health) & (party_size == last_party_size) & (last_health > 0)
+    )
+    return np.cumsum(np.where(healed, (health - last_health) * 4, 0.0))
+
   def reset(self):
     self.last_health = 0
     self.died_count = 0
@@ -70,22 +94,34 @@ class HealthReward(SingleReward):
 
 
 class BadgeReward(SingleReward):
+  fields = ("badges",)
+
   def calculate(self) -> float:
-    return bit_count(self.game_state_manager.get("badges"))
+    return popcount(self.game_state_manager.get("badges"))
+
+  def calculate_trace(self, fields):
+    return POPCOUNT_TABLE[fields["badges"]].astype(np.float64)
 
 
 class MaxOpLevelReward(SingleReward):
+  fields = ("opponent_levels",)
+
   def __init__(self, name: str, game_state_manager: GameStateManager):
     super().__init__(name, game_state_manager)
     self.max_opponent_level = 0
 
   def calculate(self) -> float:
-    opponent_level = max(self.game_state_manager.get("opponent_levels")) - 5
+    opponent_level = int(self.game_state_manager.get("opponent_levels").max()) - 5
     self.max_opponent_level = max(self.max_opponent_level, opponent_level)
     return self.max_opponent_level * 0.2
 
+  def calculate_trace(self, fields):
+    return running_max(fields["opponent_levels"].max(-1) - 5) * 0.2
+
 
 class LevelSumReward(SingleReward):
+  fields = ("party_levels",)
+
   def __init__(self, name: str, game_state_manager: GameStateManager):
     super().__init__(name, game_state_manager)
     self.max_level_rew = 0
@@ -102,10 +138,21 @@ class LevelSumReward(SingleReward):
     self.max_level_rew = max(self.max_level_rew, scaled)
     return self.max_level_rew
 
+  def calculate_trace(self, fields):
+    explore_thresh = 22
+    scale_factor = 4
+    level_sum = np.maximum(np.maximum(fields["party_levels"] - 2, 0).sum(-1) - 4, 0)
+    scaled = np.where(
+      level_sum < explore_thresh,
+      level_sum,
+      (level_sum - explore_thresh) / scale_factor + explore_thresh,
+    )
+    return running_max(scaled)
+
   def get_levels_sum(self):
     levels = self.game_state_manager.get("party_levels")
-    poke_levels = [max(level - 2, 0) for level in levels]
-    return max(sum(poke_levels) - 4, 0)  # subtract starting pokemon level
+    poke_levels = np.maximum(levels - 2, 0)
+    return max(int(poke_levels.sum()) - 4, 0)  # subtract starting pokemon level
 
   def reset(self):
     self.max_level_rew = 0
@@ -117,6 +164,10 @@ class PokemonRedReward(RewardManager):
     self, range: Tuple[float, float], config, game_state_manager: GameStateManager
   ):
     super().__init__(range, config, game_state_manager)
+    # The same rewards declared in a spec file, see game_config/rewards.yml
+    if config.get("reward_spec") is not None:
+      add_spec_rewards(self, config["reward_spec"])
+      return
     self.add_reward(EventReward, "event")
     self.add_reward(HealthReward, "heal")
     self.add_reward(BadgeReward, "badge")
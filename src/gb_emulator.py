@@ -1,8 +1,12 @@
 from pyboy import PyBoy
 from pyboy.utils import WindowEvent
 import enum
+import io
 import numpy as np
 from emulator import Emulator
+from frame_buffer import FrameRing
+from state_pool import StatePool
+import visual_util
 
 
 class GBAction(enum.Enum):
@@ -49,13 +53,30 @@ class GBEmulator(Emulator):
       hide_window=True,
     )
     self.init_state = config["init_state"]
+    # Resets start from a state sampled from the pool, kept in memory
+    self.state_pool = StatePool(config.get("state_pool_size", 64), config.get("seed"))
+    self.state_pool.add_file(self.init_state, config.get("init_state_weight", 1.0))
+    if config.get("init_state_dir") is not None:
+      self.state_pool.load_dir(
+        config["init_state_dir"], config.get("init_state_weights")
+      )
     self.act_freq = config["action_freq"]
+    self.frames_per_action = self.act_freq
+    # Only the last frame of an action is ever read, so skip drawing the others.
+    # Drawing is kept on with a window, where every frame is shown.
+    self.render_last_frame_only = (
+      config.get("render_last_frame_only", False) and config["headless"]
+    )
     if not config["headless"]:
       print("Here")
       self.pyboy.set_emulation_speed(6)
-    self.save_n_frames = 3  # Make it a config
+    self.save_n_frames = config.get("save_n_frames", 3)
     self._current_frame = None
-    self.last_n_frames = np.zeros((self.save_n_frames, 144, 160, 3), dtype=np.uint8)
+    self.frame_history = FrameRing(self.save_n_frames, (144, 160, 3))
+    # "block" is a fast 4x block average, "skimage" matches visual_util.compress
+    self.downscale_method = config.get("downscale", "block")
+    self._current_downscaled = None
+    self.downscaled_history = FrameRing(self.save_n_frames, self.downscaled_shape)
 
   def action_len(self) -> int:
     return len(GBAction)
@@ -65,7 +86,18 @@ class GBEmulator(Emulator):
       self.pyboy.load_state(f)
 
   def reset(self):
-    self.load_state(self.init_state)
+    self.start_state, state = self.state_pool.sample()
+    self.restore_snapshot(state)
+
+  def save_snapshot(self) -> bytes:
+    buffer = io.BytesIO()
+    self.pyboy.save_state(buffer)
+    return buffer.getvalue()
+
+  def restore_snapshot(self, snapshot: bytes):
+    self.pyboy.load_state(io.BytesIO(snapshot))
+    self._current_frame = None
+    self._current_downscaled = None
 
   def _get_screen_pixels(self):
     return self.pyboy.botsupport_manager().screen().screen_ndarray()
@@ -75,6 +107,13 @@ class GBEmulator(Emulator):
       self._current_frame = self._get_screen_pixels()
     return self._current_frame
 
+  def current_downscaled_frame(self):
+    if self._current_downscaled is None:
+      self._current_downscaled = visual_util.downscale(
+        self.current_frame(), self.downscaled_shape, self.downscale_method
+      )
+    return self._current_downscaled
+
   def tick(self, n=1):
     for _ in range(n):
       self.pyboy.tick()
@@ -82,20 +121,45 @@ class GBEmulator(Emulator):
   def get_action(self, action: int) -> enum.Enum:
     return GBAction(action)
 
-  def run_action(self, action: int):
+  def emulate(self, action: int):
     press, release = action_to_window_event(self.get_action(action))
     self.pyboy.send_input(press)
-    # disable rendering when we don't need it
-    # if not self.save_video and self.headless:
-    #    self.pyboy._rendering(False)
-    self.tick(self.act_freq)
+    self.run_action_frames()
     self.pyboy.send_input(release)
+
+  def emulate_idle(self):
+    self.run_action_frames()
+
+  def run_action_frames(self):
+    if self.render_last_frame_only:
+      self.pyboy._rendering(False)
+      self.tick(self.act_freq - 1)
+      self.pyboy._rendering(True)
+      self.tick()
+    else:
+      self.tick(self.act_freq)
     self._current_frame = self._get_screen_pixels()
-    self.last_n_frames = np.roll(self.last_n_frames, 1, axis=0)
-    self.last_n_frames[0] = self._current_frame
+    self._current_downscaled = None
+
+  def record_frame(self, downscaled=None):
+    self.frame_history.push(self.current_frame())
+    if downscaled is not None:
+      self._current_downscaled = downscaled
+    self.downscaled_history.push(self.current_downscaled_frame())
+
+  def get_last_n_frames(self, n=3, out=None):
+    return self.frame_history.latest(n, out)
 
-  def get_last_n_frames(self, n=3):
-    return self.last_n_frames[:n]
+  def get_last_n_downscaled_frames(self, n=3, out=None):
+    return self.downscaled_history.latest(n, out)
 
   def read_one_byte(self, address) -> int:
     return self.pyboy.get_memory_value(address)
+
+  def read_block(self, address, size) -> np.ndarray:
+    # PyBoy 1.x has no slice access to memory, so keep the per-byte loop in C
+    return np.fromiter(
+      map(self.pyboy.get_memory_value, range(address, address + size)),
+      dtype=np.uint8,
+      count=size,
+    )
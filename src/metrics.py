@@ -0,0 +1,75 @@
+from pathlib import Path
+import json
+import time
+from typing import Callable, Dict, Sequence
+import numpy as np
+
+
+class MetricsLog(object):
+  """
+  Per-worker step metrics. Rows are collected in a preallocated
+  (buffer_steps, len(columns)) float32 array and appended to path in bulk as
+  raw rows when it fills up or on flush. The column names are written once to
+  path with a .json suffix, see load_metrics.
+  """
+
+  def __init__(self, path, columns: Sequence[str], buffer_steps=1024):
+    self.path = Path(path)
+    self.columns = list(columns)
+    self.buffer = np.zeros((buffer_steps, len(self.columns)), dtype=np.float32)
+    self.rows = 0
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    with open(self.path.with_suffix(".json"), "w") as f:
+      json.dump({"columns": self.columns, "dtype": self.buffer.dtype.str}, f)
+    self.file = open(self.path, "ab")
+
+  def append(self, values: Sequence[float]):
+    self.buffer[self.rows] = values
+    self.rows += 1
+    if self.rows == len(self.buffer):
+      self.flush()
+
+  def flush(self):
+    if self.rows > 0:
+      self.file.write(self.buffer[: self.rows].tobytes())
+      self.file.flush()
+      self.rows = 0
+
+  def close(self):
+    self.flush()
+    self.file.close()
+
+
+def load_metrics(session_path) -> Dict[str, Dict[str, np.ndarray]]:
+  """
+  Load every metrics log of a session as {log name: {column: values}}. A row
+  cut short by a crash is ignored.
+  """
+  metrics = {}
+  for header_path in sorted(Path(session_path).glob("metrics/*.json")):
+    with open(header_path, "r") as f:
+      header = json.load(f)
+    columns = header["columns"]
+    data = np.fromfile(header_path.with_suffix(".bin"), dtype=header["dtype"])
+    data = data[: len(data) // len(columns) * len(columns)].reshape(-1, len(columns))
+    metrics[header_path.stem] = {name: data[:, i] for i, name in enumerate(columns)}
+  return metrics
+
+
+class RateLimitedPrinter(object):
+  """
+  Prints at most once every interval_s seconds, building the line only when it
+  is printed.
+  """
+
+  def __init__(self, interval_s=5.0):
+    self.interval_s = interval_s
+    self.last_print = -float("inf")
+
+  def due(self) -> bool:
+    return time.monotonic() - self.last_print >= self.interval_s
+
+  def print(self, make_line: Callable[[], str], force=False):
+    if force or self.due():
+      print(make_line(), flush=True)
+      self.last_print = time.monotonic()
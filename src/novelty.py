@@ -0,0 +1,289 @@
+from abc import ABC, abstractmethod
+from typing import Dict, Optional
+import hnswlib
+import numpy as np
+from game_state import GameStateManager
+
+
+class SparseProjection(object):
+  """
+  Very sparse random projection from in_dim to out_dim. Each output sums about
+  sqrt(in_dim) randomly signed inputs, scaled so squared L2 distances are
+  preserved in expectation. The same seed gives the same projection in every
+  process.
+  """
+
+  def __init__(self, in_dim: int, out_dim: int, seed: int = 0):
+    nonzero = max(int(np.sqrt(in_dim)), 1)
+    rng = np.random.default_rng(seed)
+    self.indices = rng.integers(0, in_dim, (out_dim, nonzero))
+    scale = np.sqrt(in_dim / (out_dim * nonzero))
+    self.weights = (rng.choice([-scale, scale], (out_dim, nonzero))).astype(np.float32)
+
+  def __call__(self, vec: np.ndarray) -> np.ndarray:
+    return (vec[..., self.indices] * self.weights).sum(axis=-1)
+
+  @property
+  def nbytes(self) -> int:
+    return self.indices.nbytes + self.weights.nbytes
+
+
+class GrowableIndex(object):
+  """
+  hnswlib L2 index that starts at initial_elements and doubles when full, up to
+  what fits in max_memory_mb. Once there, full_policy decides: "saturate" stops
+  storing, "evict" replaces the oldest stored vector.
+  """
+
+  def __init__(
+    self,
+    dim: int,
+    initial_elements=1024,
+    max_memory_mb=512,
+    full_policy="saturate",
+    M=16,
+  ):
+    assert full_policy in ("saturate", "evict"), "Invalid novelty_full_policy"
+    self.dim = dim
+    self.M = M
+    self.initial_elements = initial_elements
+    self.max_elements = max(int(max_memory_mb * 2**20 // self.element_bytes()), 1)
+    self.full_policy = full_policy
+    self.knn_index = None
+    self.clear()
+
+  def element_bytes(self) -> int:
+    # hnswlib per element: level 0 links (2 * M + 1 ints), vector, label, level,
+    # upper level pointer and lock
+    return (2 * self.M + 1) * 4 + self.dim * 4 + 8 + 4 + 8 + 40
+
+  def clear(self):
+    # hnswlib can't be cleared in place, and replacing deleted elements makes
+    # queries slow and inexact while most of the index is deleted. An unused
+    # index is kept, otherwise a new one starts at the capacity the index grew
+    # to before: its pages are only touched as elements are added.
+    if self.knn_index is None:
+      self.init_knn(min(self.initial_elements, self.max_elements))
+    elif self.knn_index.get_current_count() > 0:
+      self.init_knn(self.knn_index.get_max_elements())
+    self.next_label = 0
+    self.stored = 0
+    self.evicted = 0
+    self.saturated = False
+
+  def init_knn(self, max_elements):
+    # Declaring index
+    self.knn_index = hnswlib.Index(
+      space="l2", dim=self.dim
+    )  # possible options are l2, cosine or ip
+    self.knn_index.init_index(
+      max_elements=max_elements,
+      ef_construction=100,
+      M=self.M,
+      allow_replace_deleted=self.full_policy == "evict",
+    )
+
+  def nearest(self, vecs: np.ndarray) -> np.ndarray:
+    """
+    Squared distance from each of vecs (n, dim) to its nearest stored vector.
+    """
+    if self.stored == 0:
+      return np.full(len(vecs), np.inf, dtype=np.float32)
+    _, distances = self.knn_index.knn_query(vecs, k=1)
+    return distances[:, 0]
+
+  def make_room(self) -> bool:
+    capacity = self.knn_index.get_max_elements()
+    if self.stored < capacity:
+      return True
+    if capacity < self.max_elements:
+      self.knn_index.resize_index(min(2 * capacity, self.max_elements))
+      return True
+    if self.full_policy == "evict":
+      # labels are handed out in order, so the oldest stored one is known
+      self.knn_index.mark_deleted(self.next_label - self.stored)
+      self.stored -= 1
+      self.evicted += 1
+      return True
+    if not self.saturated:
+      print(f"Novelty index full at {capacity} vectors, no longer storing new ones")
+      self.saturated = True
+    return False
+
+  def add(self, vec: np.ndarray) -> bool:
+    """
+    Store one vector, return False if the index is saturated.
+    """
+    if not self.make_room():
+      return False
+    self.knn_index.add_items(
+      vec,
+      np.array([self.next_label]),
+      replace_deleted=self.full_policy == "evict",
+    )
+    self.next_label += 1
+    self.stored += 1
+    return True
+
+  def memory_bytes(self) -> int:
+    return self.element_bytes() * self.knn_index.get_max_elements()
+
+
+class NoveltyBackend(ABC):
+  """
+  Keeps the set of things seen in the current episode and tells whether the
+  current step adds something new to it.
+  """
+
+  # Game states update() depends on, see SingleReward.fields
+  fields = None
+
+  def __init__(self, game_state_manager: GameStateManager, **kwargs):
+    self.game_state_manager = game_state_manager
+
+  @abstractmethod
+  def update(self) -> bool:
+    """
+    Look at the current step, remember it if it is novel and return whether it was.
+    """
+    pass
+
+  @abstractmethod
+  def count(self) -> int:
+    """
+    Number of novel items found since the last reset.
+    """
+    pass
+
+  def count_trace(self, fields: Dict[str, np.ndarray]) -> Optional[np.ndarray]:
+    """
+    count() after each step of a whole episode, see SingleReward.calculate_trace.
+    None when the backend can only be replayed step by step.
+    """
+    return None
+
+  @abstractmethod
+  def reset(self):
+    pass
+
+  @abstractmethod
+  def memory_bytes(self) -> int:
+    """
+    Approximate memory held by the backend.
+    """
+    pass
+
+  def frame_vec(self) -> np.ndarray:
+    return (
+      self.game_state_manager.emulator.current_downscaled_frame()
+      .flatten()
+      .astype(np.float32)
+    )
+
+
+class HNSWNovelty(NoveltyBackend):
+  """
+  L2 nearest neighbour index over the downscaled screen. A frame is novel when
+  its squared distance to the nearest stored frame exceeds similar_frame_dist.
+  The index grows as needed, see GrowableIndex for the novelty_* settings.
+  """
+
+  def __init__(self, game_state_manager: GameStateManager, **kwargs):
+    super().__init__(game_state_manager, **kwargs)
+    self.similar_frame_dist = kwargs["similar_frame_dist"]
+    frame_dim = int(np.prod(game_state_manager.emulator.downscaled_shape))
+    self.vec_dim = self.embed(np.zeros(frame_dim, dtype=np.float32)).shape[-1]
+    self.index = GrowableIndex(
+      self.vec_dim,
+      initial_elements=kwargs.get("novelty_initial_elements", 1024),
+      max_memory_mb=kwargs.get("novelty_max_memory_mb", 512),
+      full_policy=kwargs.get("novelty_full_policy", "saturate"),
+    )
+    self.discovered = 0
+
+  def embed(self, frame_vec: np.ndarray) -> np.ndarray:
+    return frame_vec
+
+  def reset(self):
+    self.index.clear()
+    self.discovered = 0
+
+  def update(self) -> bool:
+    vec = self.embed(self.frame_vec())
+    # check for nearest frame and add if current
+    if self.index.nearest(vec[None])[0] <= self.similar_frame_dist:
+      return False
+    if not self.index.add(vec):
+      return False
+    self.discovered += 1
+    return True
+
+  def count(self) -> int:
+    return self.discovered
+
+  def memory_bytes(self) -> int:
+    return self.index.memory_bytes()
+
+
+class ProjectedHNSWNovelty(HNSWNovelty):
+  """
+  HNSWNovelty over a SparseProjection of the frame to novelty_dim dimensions,
+  so the same similar_frame_dist applies with a much smaller index.
+  """
+
+  def __init__(self, game_state_manager: GameStateManager, **kwargs):
+    frame_dim = int(np.prod(game_state_manager.emulator.downscaled_shape))
+    self.projection = SparseProjection(
+      frame_dim, kwargs.get("novelty_dim", 64), kwargs.get("novelty_seed", 0)
+    )
+    super().__init__(game_state_manager, **kwargs)
+
+  def embed(self, frame_vec: np.ndarray) -> np.ndarray:
+    return self.projection(frame_vec)
+
+  def memory_bytes(self) -> int:
+    return super().memory_bytes() + self.projection.nbytes
+
+
+class VisitedCellNovelty(NoveltyBackend):
+  """
+  Exact set of visited cells, a cell being the values of cell_fields in the game
+  state (the map and the player position by default).
+  """
+
+  def __init__(self, game_state_manager: GameStateManager, **kwargs):
+    super().__init__(game_state_manager, **kwargs)
+    self.cell_fields = tuple(kwargs.get("cell_fields", ("map_id", "x", "y")))
+    self.fields = self.cell_fields
+    self.reset()
+
+  def update(self) -> bool:
+    cell = tuple(self.game_state_manager.get(name) for name in self.cell_fields)
+    if cell in self.visited:
+      return False
+    self.visited.add(cell)
+    return True
+
+  def count(self) -> int:
+    return len(self.visited)
+
+  def count_trace(self, fields):
+    cells = np.stack([fields[name] for name in self.cell_fields], axis=-1)
+    _, first = np.unique(cells, axis=0, return_index=True)
+    new = np.zeros(len(cells), dtype=np.int64)
+    new[first] = 1
+    return np.cumsum(new)
+
+  def reset(self):
+    self.visited = set()
+
+  def memory_bytes(self) -> int:
+    # set slot plus a small int tuple per cell
+    return len(self.visited) * (8 * 2 + 40 + 8 * len(self.cell_fields))
+
+
+NOVELTY_BACKENDS = {
+  "hnsw": HNSWNovelty,
+  "projection": ProjectedHNSWNovelty,
+  "cell": VisitedCellNovelty,
+}
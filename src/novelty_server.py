@@ -0,0 +1,185 @@
+import multiprocessing
+import struct
+import time
+import numpy as np
+import zmq
+
+from game_state import GameStateManager
+from novelty import GrowableIndex, NoveltyBackend, SparseProjection
+
+# Reply to one query: whether the frame was new to the shared archive and the
+# archive size after it
+REPLY = struct.Struct("<?q")
+
+
+class NoveltyServer(object):
+  """
+  Session-wide novelty archive shared by all workers of one machine.
+
+  Workers send embedded frames to a ZeroMQ ROUTER socket. Every loop the server
+  drains all pending requests, answers them with one batched knn query and
+  stores the novel frames, so a request waits for at most one batch.
+  """
+
+  def __init__(
+    self, address: str, dim: int, similar_frame_dist: float, max_batch=256, **kwargs
+  ):
+    self.address = address
+    self.dim = dim
+    self.similar_frame_dist = similar_frame_dist
+    self.max_batch = max_batch
+    self.index = GrowableIndex(
+      dim,
+      initial_elements=kwargs.get("novelty_initial_elements", 1024),
+      max_memory_mb=kwargs.get("novelty_max_memory_mb", 512),
+      full_policy=kwargs.get("novelty_full_policy", "saturate"),
+    )
+    self.discovered = 0
+    self.requests = 0
+    self.batches = 0
+
+  def handle_batch(self, vecs: np.ndarray) -> np.ndarray:
+    novel = self.index.nearest(vecs) > self.similar_frame_dist
+    accepted = []
+    for i in np.flatnonzero(novel):
+      # the same new screen can arrive from several workers in one batch
+      if accepted:
+        dist = ((vecs[accepted] - vecs[i]) ** 2).sum(axis=1)
+        if (dist <= self.similar_frame_dist).any():
+          novel[i] = False
+          continue
+      if not self.index.add(vecs[i]):
+        novel[i] = False
+        continue
+      accepted.append(i)
+    self.discovered += len(accepted)
+    self.requests += len(vecs)
+    self.batches += 1
+    return novel
+
+  def serve(self):
+    socket = zmq.Context.instance().socket(zmq.ROUTER)
+    socket.bind(self.address)
+    vecs = np.empty((self.max_batch, self.dim), dtype=np.float32)
+    while True:
+      idents = [socket.recv_multipart()]
+      while len(idents) < self.max_batch:
+        try:
+          idents.append(socket.recv_multipart(zmq.NOBLOCK))
+        except zmq.Again:
+          break
+      for i, (_, payload) in enumerate(idents):
+        vecs[i] = np.frombuffer(payload, dtype=np.float32)
+      novel = self.handle_batch(vecs[: len(idents)])
+      for (ident, _), is_novel in zip(idents, novel):
+        socket.send_multipart([ident, REPLY.pack(bool(is_novel), self.discovered)])
+
+
+def run_novelty_server(address, dim, similar_frame_dist, **kwargs):
+  NoveltyServer(address, dim, similar_frame_dist, **kwargs).serve()
+
+
+def start_novelty_server(config) -> multiprocessing.Process:
+  """
+  Start the server for config["novelty_server"] in a daemon process.
+  """
+  novelty_kwargs = {k: v for k, v in config.items() if k.startswith("novelty_")}
+  server = multiprocessing.Process(
+    target=run_novelty_server,
+    args=(
+      config["novelty_server"],
+      config.get("novelty_dim", 64),
+      config["sim_frame_dist"],
+    ),
+    kwargs=novelty_kwargs,
+    daemon=True,
+  )
+  server.start()
+  return server
+
+
+class SharedNovelty(NoveltyBackend):
+  """
+  Client of a NoveltyServer at novelty_server. count() is the number of frames
+  this worker added to the shared archive in the current episode, global_count
+  the size of the whole archive.
+
+  The frame is sent without waiting and its answer is collected on the next
+  update, after the step has been emulated, so novelty is reported one step late
+  but the worker never waits on the server.
+
+  An answer that doesn't come within novelty_server_timeout_ms counts as a
+  miss: the frame is taken as not novel, the socket is dropped and the server is
+  left alone for novelty_server_retry_s before reconnecting.
+  """
+
+  def __init__(self, game_state_manager: GameStateManager, **kwargs):
+    super().__init__(game_state_manager, **kwargs)
+    frame_dim = int(np.prod(game_state_manager.emulator.downscaled_shape))
+    self.projection = SparseProjection(
+      frame_dim, kwargs.get("novelty_dim", 64), kwargs.get("novelty_seed", 0)
+    )
+    self.address = kwargs["novelty_server"]
+    self.timeout_ms = kwargs.get("novelty_server_timeout_ms", 10000)
+    self.retry_s = kwargs.get("novelty_server_retry_s", 10.0)
+    self.retry_at = 0.0
+    self.misses = 0
+    # Connected on first use, so the backend can be built before forking
+    self.socket = None
+    self.pending = False
+    self.discovered = 0
+    self.global_count = 0
+
+  def connect(self):
+    self.socket = zmq.Context.instance().socket(zmq.DEALER)
+    self.socket.setsockopt(zmq.RCVTIMEO, self.timeout_ms)
+    self.socket.setsockopt(zmq.SNDTIMEO, self.timeout_ms)
+    self.socket.setsockopt(zmq.LINGER, 0)
+    self.socket.connect(self.address)
+
+  def miss(self):
+    self.misses += 1
+    self.pending = False
+    # a late answer would be taken for the next frame's
+    self.socket.close()
+    self.socket = None
+    self.retry_at = time.monotonic() + self.retry_s
+    print(f"novelty server not answering, retrying in {self.retry_s}s")
+
+  def collect(self) -> bool:
+    if not self.pending:
+      return False
+    try:
+      novel, self.global_count = REPLY.unpack(self.socket.recv())
+    except zmq.Again:
+      self.miss()
+      return False
+    self.pending = False
+    return novel
+
+  def update(self) -> bool:
+    novel = self.collect()
+    self.discovered += novel
+    if self.socket is None:
+      if time.monotonic() < self.retry_at:
+        return novel
+      self.connect()
+    vec = self.projection(self.frame_vec()).astype(np.float32)
+    try:
+      self.socket.send(vec.tobytes())
+    except zmq.Again:
+      self.miss()
+      return novel
+    self.pending = True
+    return novel
+
+  def count(self) -> int:
+    return self.discovered
+
+  def reset(self):
+    # the answer for the last frame of the previous episode is not credited
+    self.collect()
+    self.discovered = 0
+
+  def memory_bytes(self) -> int:
+    return self.projection.nbytes
@@ -1,6 +1,5 @@
 from gb_emulator import GBEmulator
 from reward import RewardManager
-import visual_util
 import numpy as np
 import einops
 import math
@@ -9,12 +8,13 @@ from gymnasium import spaces
 
 
 class Observation(object):
-  def __init__(self, emutator: GBEmulator, reward: RewardManager):
+  def __init__(self, emutator: GBEmulator, reward: RewardManager, config=None):
+    config = config or {}
     self.emulator = emutator
     self.reward = reward
 
     self.frame_stacks = 3
-    self.output_shape = (36, 40, 3)
+    self.output_shape = self.emulator.downscaled_shape
     self.mem_padding = 2
     self.memory_height = 8
     self.col_steps = 16
@@ -25,68 +25,82 @@ class Observation(object):
       self.output_shape[1],
       self.output_shape[2],
     )
+    # Reward component drawn as a progress bar in each color channel, and the
+    # scale applied to it
+    self.memory_bars = list(
+      config.get(
+        "obs_memory_bars", {"level": 10.0, "heal": 10.0, "explore": 100.0}
+      ).items()
+    )
+    assert len(self.memory_bars) <= self.output_shape[2], "One bar per channel"
+    self.bar_values = [None] * len(self.memory_bars)
 
     self.recent_memory = np.zeros(
       (self.output_shape[1] * self.memory_height, 3), dtype=np.uint8
     )
 
+    self.use_buffer(np.zeros(self.output_full, dtype=np.uint8), in_place=False)
+    self.recent_memory_view[:] = self.create_recent_memory()
+
   def get_obs_space(self):
     return spaces.Box(low=0, high=255, shape=self.output_full, dtype=np.uint8)
 
-  def create_obs_mem(self):
-    cur_frame = self.emulator.current_frame()
-    recent_frames = self.emulator.get_last_n_frames(self.frame_stacks)
-    compressed_frames = np.stack(
-      [visual_util.compress(f, self.output_shape) for f in recent_frames]
-    )
-    cur_frame = visual_util.compress(cur_frame, self.output_shape)
-    pad = np.zeros(shape=(self.mem_padding, self.output_shape[1], 3), dtype=np.uint8)
-    cur_frame = np.concatenate(
-      (
-        self.create_exploration_memory(),  # This is for storing some states
-        pad,
-        self.create_recent_memory(),
-        pad,
-        einops.rearrange(compressed_frames, "f h w c -> (f h) w c"),
-      ),
-      axis=0,
+  def use_buffer(self, buffer: np.ndarray, in_place=True):
+    """
+    Assemble observations in buffer from now on, e.g. a vector env's slot. With
+    in_place create_obs_mem returns the buffer itself rather than a copy.
+    """
+    if hasattr(self, "buffer"):
+      np.copyto(buffer, self.buffer)
+    self.buffer = buffer
+    self.in_place = in_place
+    h, pad = self.memory_height, self.mem_padding
+    self.exploration_memory_view = buffer[:h]
+    self.recent_memory_view = buffer[h + pad : 2 * h + pad]
+    self.frames_view = buffer[2 * (h + pad) :].reshape(
+      (self.frame_stacks,) + self.output_shape
     )
-    return cur_frame
 
-  def create_exploration_memory(self):
-    w = self.output_shape[1]
-    h = self.memory_height
+  def create_obs_mem(self, out=None):
+    """
+    Update the observation buffer in place and return a copy of it, in out when
+    given. A buffer set by use_buffer is returned itself, it is overwritten by
+    the next call.
+    """
+    self.update_exploration_memory()
+    self.emulator.get_last_n_downscaled_frames(self.frame_stacks, out=self.frames_view)
+    if out is not None:
+      np.copyto(out, self.buffer)
+      return out
+    # SubprocVecEnv and DummyVecEnv keep the terminal observation across the
+    # reset that follows it
+    return self.buffer if self.in_place else self.buffer.copy()
 
-    def make_reward_channel(r_val):
-      col_steps = self.col_steps
-      max_r_val = (w - 1) * h * col_steps
-      # truncate progress bar. if hitting this
-      # you should scale down the reward in group_rewards!
-      r_val = min(r_val, max_r_val)
-      row = math.floor(r_val / (h * col_steps))
-      memory = np.zeros(shape=(h, w), dtype=np.uint8)
-      memory[:, :row] = 255
-      row_covered = row * h * col_steps
-      col = math.floor((r_val - row_covered) / col_steps)
-      memory[:col, row] = 255
-      col_covered = col * col_steps
-      last_pixel = math.floor(r_val - row_covered - col_covered)
-      memory[col, row] = last_pixel * (255 // col_steps)
-      return memory
-
-    level, hp, explore = 1, 2, 3
-    full_memory = np.stack(
-      (
-        make_reward_channel(level),
-        make_reward_channel(hp),
-        make_reward_channel(explore),
-      ),
-      axis=-1,
-    )
+  def update_exploration_memory(self):
+    components = self.reward.get_reward_components()
+    for channel, (name, scale) in enumerate(self.memory_bars):
+      r_val = components.get(name, 0.0) * scale
+      if r_val != self.bar_values[channel]:
+        self.draw_reward_bar(self.exploration_memory_view[..., channel], r_val)
+        self.bar_values[channel] = r_val
 
-    # if self.get_badges() > 0:
-    #    full_memory[:, -1, :] = 255
-    return full_memory
+  def draw_reward_bar(self, memory: np.ndarray, r_val: float):
+    """
+    Fill memory (h, w) column by column, col_steps of r_val per pixel, the last
+    pixel partially.
+    """
+    h, w = memory.shape
+    col_steps = self.col_steps
+    max_r_val = (w - 1) * h * col_steps
+    # truncate progress bar. if hitting this
+    # you should scale down the reward in obs_memory_bars!
+    r_val = min(max(r_val, 0), max_r_val)
+    filled = math.floor(r_val / col_steps)
+    last_pixel = math.floor(r_val - filled * col_steps)
+    memory[:] = 0
+    # the transpose walks the pixels column by column
+    memory.T.flat[:filled] = 255
+    memory.T.flat[filled] = last_pixel * (255 // col_steps)
 
   def create_recent_memory(self):
     result = einops.rearrange(
@@ -0,0 +1,120 @@
+from pathlib import Path
+import json
+import time
+from typing import Dict
+
+# Each octave of ns durations is split in SUB_BINS bins, so bin bounds are
+# within 2 ** (1 / SUB_BINS) of each other
+SUB_BITS = 2
+SUB_BINS = 2**SUB_BITS
+BINS = 64 * SUB_BINS
+
+
+def bin_index(ns: int) -> int:
+  if ns < 2 * SUB_BINS:
+    return ns
+  digits = ns.bit_length()
+  # the bits after the leading one pick the bin within the octave
+  sub = (ns >> (digits - SUB_BITS - 1)) & (SUB_BINS - 1)
+  return (digits - SUB_BITS) * SUB_BINS + sub
+
+
+def bin_upper_ns(index: int) -> int:
+  """
+  Smallest duration above the bin.
+  """
+  if index < 2 * SUB_BINS:
+    return index + 1
+  octave, sub = divmod(index, SUB_BINS)
+  return (SUB_BINS + sub + 1) << (octave - 1)
+
+
+class StageHistograms(object):
+  def __init__(self):
+    self.counts: Dict[str, list] = {}
+    self.totals: Dict[str, int] = {}
+
+  def add(self, stage: str, ns: int):
+    counts = self.counts.get(stage)
+    if counts is None:
+      counts = self.counts[stage] = [0] * BINS
+      self.totals[stage] = 0
+    counts[min(bin_index(ns), BINS - 1)] += 1
+    self.totals[stage] += ns
+
+  def clear(self):
+    self.counts.clear()
+    self.totals.clear()
+
+  def summary(self) -> Dict[str, Dict[str, float]]:
+    """
+    Count, mean and approximate percentiles per stage in microseconds. A
+    percentile is the upper bound of the bin it falls in.
+    """
+    result = {}
+    for stage, counts in self.counts.items():
+      count = sum(counts)
+      stats = {"count": count, "mean_us": self.totals[stage] / count / 1000}
+      for name, q in (("p50_us", 0.5), ("p99_us", 0.99), ("max_us", 1.0)):
+        seen = 0
+        for i, n in enumerate(counts):
+          seen += n
+          if seen >= q * count:
+            stats[name] = bin_upper_ns(i) / 1000
+            break
+      result[stage] = stats
+    return result
+
+
+class StageProfiler(object):
+  """
+  Times consecutive stages of a step: start() then lap(stage) after each stage
+  records the time since the previous call. Kept per episode and per session.
+  """
+
+  def __init__(self):
+    self.episode = StageHistograms()
+    self.session = StageHistograms()
+    self.last = 0
+
+  def start(self):
+    self.last = time.perf_counter_ns()
+
+  def lap(self, stage: str):
+    now = time.perf_counter_ns()
+    ns = now - self.last
+    self.episode.add(stage, ns)
+    self.session.add(stage, ns)
+    self.last = now
+
+  def end_episode(self) -> Dict[str, Dict[str, float]]:
+    summary = self.episode.summary()
+    self.episode.clear()
+    return summary
+
+  def dump(self, path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+      json.dump(
+        {"summary": self.session.summary(), "histograms": self.session.counts},
+        f,
+      )
+
+
+class NullProfiler(object):
+  """
+  Stand-in when profiling is off, every call returns at once.
+  """
+
+  def start(self):
+    pass
+
+  def lap(self, stage: str):
+    pass
+
+  def end_episode(self):
+    return None
+
+  def dump(self, path):
+    pass
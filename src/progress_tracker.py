@@ -1,17 +1,110 @@
 from pathlib import Path
-import matplotlib.pyplot as plt
+from typing import Optional
+import time
 
+from artifact_writer import ArtifactWriter
 from gb_emulator import GBEmulator
+from game_state import GameStateManager
+from metrics import MetricsLog, RateLimitedPrinter
+from ram_trace import RamTraceRecorder
+from trajectory import NO_INPUT, TrajectoryRecorder
+from video import VideoRecorder
 
 
 class ProgressTracker(object):
-  def __init__(self, config, emulator: GBEmulator):
+  def __init__(
+    self,
+    config,
+    emulator: GBEmulator,
+    game_state_manager: Optional[GameStateManager] = None,
+  ):
     self.emulator = emulator
     self.save_video = config["save_video"]
     self.print_rewards = config["print_rewards"]
     self.s_path = config["session_path"]
     self.save_final_state = config["save_final_state"]
+    # Final states join the emulator's pool of start states
+    self.harvest_final_states = config.get("harvest_final_states", False)
+    self.harvested_state_weight = config.get("harvested_state_weight", 1.0)
     self.all_runs = []
+    self.writer = ArtifactWriter(
+      max_queue=config.get("artifact_queue_size", 64),
+      full_policy=config.get("artifact_full_policy", "drop"),
+    )
+    self.save_metrics = config.get("save_metrics", True)
+    self.metrics_buffer_steps = config.get("metrics_buffer_steps", 1024)
+    # Created on the first step, when the reward components are known
+    self.metrics = None
+    self.printer = RateLimitedPrinter(config.get("print_interval_s", 5.0))
+    self.steps = 0
+    self.last_summary = (time.monotonic(), 0, 0)
+    self.recorder = None
+    self.idle_action = config.get("idle_action")
+    if config.get("record_trajectories", False):
+      self.recorder = TrajectoryRecorder(
+        self.s_path / Path("trajectories"),
+        emulator,
+        config,
+        checkpoint_every=config.get("trajectory_checkpoint_every", 1024),
+      )
+    self.ram_tracer = None
+    if config.get("record_ram_traces", False):
+      self.ram_tracer = RamTraceRecorder(
+        self.s_path / Path("ram_traces"),
+        emulator,
+        game_state_manager,
+        chunk_steps=config.get("ram_trace_chunk_steps", 1024),
+      )
+    # Episodes are encoded by the video_server process, see video.py
+    self.video = None
+    if self.save_video and config.get("video_server") is not None:
+      self.video = VideoRecorder(config, emulator.current_frame().shape)
+
+  def log_metrics(self, info):
+    if self.metrics is None:
+      self.metrics = MetricsLog(
+        self.s_path / Path("metrics") / Path(f"{info['instance_id']}.bin"),
+        ["reset_count", "step", "action", "reward", "reward_drops", "skipped_frames"]
+        + list(info["reward_components"]),
+        buffer_steps=self.metrics_buffer_steps,
+      )
+    self.metrics.append(
+      [
+        info["reset_count"],
+        info["step_count"],
+        info["action_id"],
+        info["reward"],
+        info["reward_drops"],
+        info["skipped_frames"],
+        *info["reward_components"].values(),
+      ]
+    )
+
+  def summary(self, info) -> str:
+    """
+    One line for the steps since the previous summary.
+    """
+    now = time.monotonic()
+    last_time, last_steps, last_drops = self.last_summary
+    self.last_summary = (now, self.steps, info["reward_drops"])
+    prog_string = (
+      f"{info['instance_id']} episode: {info['reset_count']}"
+      f" step: {info['step_count']:6d}"
+      f" steps/s: {(self.steps - last_steps) / max(now - last_time, 1e-9):7.1f}"
+      f" reward drops: {info['reward_drops'] - last_drops}"
+    )
+    for key, val in info["reward_components"].items():
+      prog_string += f" {key}: {val:5.2f}"
+    prog_string += f" sum: {info['reward']:5.2f}"
+    return prog_string
+
+  def start_episode(self, info):
+    if self.recorder is not None:
+      self.recorder.start_episode(f"{info['instance_id']}_{info['reset_count']}")
+    if self.ram_tracer is not None:
+      self.ram_tracer.start_episode(f"{info['instance_id']}_{info['reset_count']}")
+    if self.video is not None:
+      self.video.start_episode(info)
 
   def save_step(
     self,
@@ -19,18 +112,29 @@ class ProgressTracker(object):
   ):
     step_count = info["step_count"]
     instance_id = info["instance_id"]
-    total_reward = info["reward"]
-    progress_reward = info["reward_components"]
+
+    self.steps += 1
+    if self.recorder is not None:
+      # and the fast-forwarded actions, so the trajectory replays exactly. The
+      # first idle_pressed of them pressed idle_action, the others nothing
+      idle_pressed = info["idle_pressed"]
+      self.recorder.record(
+        [info["action_id"]]
+        + [self.idle_action] * idle_pressed
+        + [NO_INPUT] * (info["idle_actions"] - idle_pressed)
+      )
+    if self.ram_tracer is not None:
+      self.ram_tracer.record()
+    if self.video is not None:
+      self.video.add_frame(self.emulator.current_frame(), info)
+    if self.save_metrics:
+      self.log_metrics(info)
 
     if self.print_rewards:
-      prog_string = f"step: {step_count:6d} current action: {info['action']}"
-      for key, val in progress_reward.items():
-        prog_string += f" {key}: {val:5.2f}"
-      prog_string += f" sum: {total_reward:5.2f}"
-      print(f"\r{prog_string}", end="", flush=True)
+      self.printer.print(lambda: self.summary(info))
 
     if step_count % 50 == 0:
-      plt.imsave(
+      self.writer.submit(
         self.s_path / Path(f"curframe_{instance_id}.jpeg"),
         self.emulator.current_frame(),
       )
@@ -38,25 +142,51 @@ class ProgressTracker(object):
   def save_finished_state(self, obs_memory, info):
     reset_count = info["reset_count"]
     total_reward = info["reward"]
+    if self.metrics is not None:
+      self.metrics.flush()
+    if self.recorder is not None:
+      self.recorder.end_episode()
+    if self.ram_tracer is not None:
+      self.ram_tracer.end_episode()
+    if self.video is not None:
+      self.video.end_episode()
+    fs_path = self.s_path / Path("final_states")
+    if self.harvest_final_states:
+      # saved too, so a later run can start from them with init_state_dir
+      name = f"state_r{total_reward:.4f}_{info['instance_id']}_{reset_count}.state"
+      state = self.emulator.save_snapshot()
+      self.emulator.state_pool.harvest(name, state, self.harvested_state_weight)
+      self.writer.submit(fs_path / Path(name), state, droppable=False)
     if self.print_rewards:
-      print("", flush=True)
+      self.printer.print(lambda: self.summary(info), force=True)
       if self.save_final_state:
-        fs_path = self.s_path / Path("final_states")
-        fs_path.mkdir(exist_ok=True)
-        plt.imsave(
+        self.writer.submit(
           fs_path / Path(f"frame_r{total_reward:.4f}_{reset_count}_small.jpeg"),
           obs_memory,
+          droppable=False,
         )
-        plt.imsave(
+        self.writer.submit(
           fs_path / Path(f"frame_r{total_reward:.4f}_{reset_count}_full.jpeg"),
           self.emulator.current_frame(),
+          droppable=False,
         )
 
   def save_screenshot(self, name, instance_id, total_reward, reset_count):
     ss_dir = self.s_path / Path("screenshots")
-    ss_dir.mkdir(exist_ok=True)
-    plt.imsave(
+    self.writer.submit(
       ss_dir
       / Path(f"frame{instance_id}_r{total_reward:.4f}_{reset_count}_{name}.jpeg"),
       self.emulator.current_frame(),
+      droppable=False,
     )
+
+  def close(self):
+    self.writer.close()
+    if self.recorder is not None:
+      self.recorder.end_episode()
+    if self.ram_tracer is not None:
+      self.ram_tracer.end_episode()
+    if self.video is not None:
+      self.video.close()
+    if self.metrics is not None:
+      self.metrics.close()
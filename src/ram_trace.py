@@ -0,0 +1,285 @@
+from dataclasses import asdict
+from pathlib import Path
+from typing import Dict, Type
+import enum
+import json
+import struct
+import time
+import zlib
+import numpy as np
+import fire
+import yaml
+
+from emulator import Emulator
+from game_state import GameState, GameStateManager, StatePlan
+from reward import RewardManager
+from trajectory import RECORD
+
+# Same record framing as trajectory files: the JSON header, then chunks of
+# consecutive steps. Chunk: index of its first step and its number of steps, then
+# the int64 state values and the uint8 downscaled frames of those steps.
+CHUNK = struct.Struct("<qI")
+
+
+class RamTraceRecorder(object):
+  """
+  Records the GameStateManager state vector and the downscaled frame of every
+  step, one compressed file per episode, so rewards can be scored offline with
+  evaluate() without running the emulator.
+  """
+
+  def __init__(
+    self,
+    directory,
+    emulator: Emulator,
+    game_state_manager: GameStateManager,
+    chunk_steps=1024,
+  ):
+    self.directory = Path(directory)
+    self.emulator = emulator
+    self.game_state_manager = game_state_manager
+    self.chunk_steps = chunk_steps
+    self.file = None
+
+  def start_episode(self, name: str):
+    self.end_episode()
+    plan = self.game_state_manager.plan
+    if plan is None:
+      self.game_state_manager.compile()
+      plan = self.game_state_manager.plan
+    self.values = np.zeros((self.chunk_steps,) + plan.values.shape, dtype=np.int64)
+    self.frames = np.zeros(
+      (self.chunk_steps,) + tuple(self.emulator.downscaled_shape), dtype=np.uint8
+    )
+    self.directory.mkdir(parents=True, exist_ok=True)
+    self.file = open(self.directory / Path(f"{name}.rtrace"), "wb")
+    header = {
+      "states": [asdict(state) for state in self.game_state_manager.states.values()],
+      "downscaled_shape": list(self.emulator.downscaled_shape),
+    }
+    self.write_record(json.dumps(header).encode())
+    self.start = 0
+    self.steps = 0
+
+  def record(self):
+    """
+    Record the current step, after the game state update.
+    """
+    if self.file is None:
+      return
+    self.values[self.steps] = self.game_state_manager.plan.values
+    self.frames[self.steps] = self.emulator.current_downscaled_frame()
+    self.steps += 1
+    if self.steps == self.chunk_steps:
+      self.write_chunk()
+      self.start += self.steps
+      self.steps = 0
+
+  def write_chunk(self):
+    self.write_record(
+      CHUNK.pack(self.start, self.steps)
+      + self.values[: self.steps].tobytes()
+      + self.frames[: self.steps].tobytes()
+    )
+
+  def write_record(self, data: bytes):
+    data = zlib.compress(data, 1)
+    self.file.write(RECORD.pack(len(data)) + data)
+
+  def end_episode(self):
+    if self.file is None:
+      return
+    if self.steps > 0:
+      self.write_chunk()
+    self.file.close()
+    self.file = None
+
+
+class RamTrace(object):
+  """
+  A recorded episode: values of shape (steps, len(plan.values)) and frames of
+  shape (steps,) + downscaled_shape.
+  """
+
+  def __init__(self, path):
+    with open(path, "rb") as f:
+      data = f.read()
+    records = []
+    pos = 0
+    # a record cut short by a crash is ignored
+    while pos + RECORD.size <= len(data):
+      (size,) = RECORD.unpack_from(data, pos)
+      if pos + RECORD.size + size > len(data):
+        break
+      records.append(
+        zlib.decompress(data[pos + RECORD.size : pos + RECORD.size + size])
+      )
+      pos += RECORD.size + size
+    header = json.loads(records[0])
+    self.states = [GameState(**state) for state in header["states"]]
+    self.downscaled_shape = tuple(header["downscaled_shape"])
+    self.plan = StatePlan(self.states)
+    num_values = len(self.plan.values)
+    values = []
+    frames = []
+    for record in records[1:]:
+      _, steps = CHUNK.unpack_from(record)
+      values_end = CHUNK.size + steps * num_values * 8
+      values.append(
+        np.frombuffer(record[CHUNK.size : values_end], np.int64).reshape(steps, -1)
+      )
+      frames.append(
+        np.frombuffer(record[values_end:], np.uint8).reshape(
+          (steps,) + self.downscaled_shape
+        )
+      )
+    self.values = (
+      np.concatenate(values) if values else np.zeros((0, num_values), np.int64)
+    )
+    self.frames = (
+      np.concatenate(frames)
+      if frames
+      else np.zeros((0,) + self.downscaled_shape, np.uint8)
+    )
+
+  def __len__(self):
+    return len(self.values)
+
+  def fields(self) -> Dict[str, np.ndarray]:
+    return self.plan.unpack(self.values)
+
+
+class TraceAction(enum.Enum):
+  NEXT = 0
+
+
+class TraceEmulator(Emulator):
+  """
+  Plays a RamTrace back one step per action, for rewards that look at the
+  screen. Only the downscaled frames are recorded, current_frame() is their
+  nearest neighbour upscale. Memory is not recorded either, the game state is
+  fed to GameStateManager.update from the trace instead of being read.
+  """
+
+  def __init__(self, trace: RamTrace):
+    self.trace = trace
+    self.downscaled_shape = trace.downscaled_shape
+    self.step = -1
+
+  def action_len(self) -> int:
+    return len(TraceAction)
+
+  def get_action(self, action: int) -> enum.Enum:
+    return TraceAction(action)
+
+  def reset(self):
+    self.step = -1
+
+  def current_frame(self):
+    return self.current_downscaled_frame().repeat(4, axis=0).repeat(4, axis=1)
+
+  def current_downscaled_frame(self):
+    return self.trace.frames[max(self.step, 0)]
+
+  def emulate(self, action: int):
+    self.step += 1
+
+  def emulate_idle(self):
+    # fast-forwarded actions are part of the recorded step before them
+    pass
+
+  def record_frame(self, downscaled=None):
+    pass
+
+  def get_last_n_frames(self, n=3, out=None):
+    frames = self.get_last_n_downscaled_frames(n)
+    frames = frames.repeat(4, axis=1).repeat(4, axis=2)
+    if out is not None:
+      np.copyto(out, frames)
+      return out
+    return frames
+
+  def get_last_n_downscaled_frames(self, n=3, out=None):
+    steps = np.clip(np.arange(self.step, self.step - n, -1), 0, None)
+    frames = self.trace.frames[steps]
+    if out is not None:
+      np.copyto(out, frames)
+      return out
+    return frames
+
+  def save_snapshot(self) -> bytes:
+    return struct.pack("<q", self.step)
+
+  def restore_snapshot(self, snapshot: bytes):
+    (self.step,) = struct.unpack("<q", snapshot)
+
+  def read_one_byte(self, address) -> int:
+    raise NotImplementedError("A RAM trace only keeps the game state values")
+
+
+def evaluate(
+  trace: RamTrace, reward_type: Type[RewardManager], config
+) -> Dict[str, np.ndarray]:
+  """
+  Weighted score of every reward after each step of trace, as an env starting
+  from a reset would have computed them. Rewards with a calculate_trace are
+  evaluated over the whole episode at once, the others are replayed step by step.
+  """
+  emulator = TraceEmulator(trace)
+  game_state_manager = GameStateManager(emulator)
+  for state in trace.states:
+    game_state_manager.add_state(**asdict(state))
+  game_state_manager.compile()
+  # The shared archive is about other workers' live episodes, not this one
+  reward_manager = reward_type(
+    (0, 15000), {**config, "novelty_server": None}, game_state_manager
+  )
+  reward_manager.reset()
+
+  fields = trace.fields()
+  scores = {}
+  sequential = []
+  for reward_item, weight in reward_manager.reward_items:
+    item_scores = reward_item.calculate_trace(fields)
+    if item_scores is None:
+      sequential.append((reward_item, weight))
+      scores[reward_item.name] = np.zeros(len(trace))
+    else:
+      scores[reward_item.name] = (
+        reward_manager.reward_scale * weight * np.asarray(item_scores, dtype=np.float64)
+      )
+
+  if sequential:
+    reward_manager.reward_items = sequential
+    for step, values in enumerate(trace.values):
+      emulator.run_action(0)
+      reward_manager.update(game_state_manager.update(values))
+      for reward_item, _ in sequential:
+        scores[reward_item.name][step] = reward_manager.state_scores[reward_item.name]
+  return scores
+
+
+def score(trace, config):
+  """
+  Print the final score of every Pokemon Red reward over a recorded trace.
+  """
+  # the CLI scores Pokemon Red, the recorder is game agnostic
+  from games.pokemon_red import PokemonRedReward
+
+  with open(config, "r") as f:
+    env_config = yaml.load(f, Loader=yaml.FullLoader)
+  trace = RamTrace(trace)
+  beg = time.perf_counter()
+  scores = evaluate(trace, PokemonRedReward, env_config)
+  elapsed = time.perf_counter() - beg
+  for name, values in scores.items():
+    final = values[-1] if len(values) else 0.0
+    print(f"{name:16s} {final:9.2f}")
+  print(
+    f"{len(trace)} steps in {elapsed:.3f}s,"
+    f" {len(trace) / elapsed / 1000:.1f} steps/ms"
+  )
+
+
+if __name__ == "__main__":
+  fire.Fire({"score": score})
@@ -1,8 +1,7 @@
-from typing import Tuple
-import hnswlib
+from typing import AbstractSet, Dict, Optional, Tuple
 import numpy as np
 from game_state import GameStateManager
-from visual_util import compress
+from novelty import NOVELTY_BACKENDS
 from typing import Type
 from abc import ABC, abstractmethod
 
@@ -11,7 +10,22 @@ def bit_count(bits):
   return bin(bits).count("1")
 
 
+POPCOUNT_TABLE = np.array([bit_count(i) for i in range(256)], dtype=np.int64)
+
+
+def popcount(values) -> int:
+  """
+  Count the set bits of a byte or an array of bytes.
+  """
+  return int(POPCOUNT_TABLE[values].sum())
+
+
 class SingleReward(ABC):
+  # Names of the GameStateManager states calculate() reads. The reward is only
+  # recomputed when one of them changed. None means the reward depends on
+  # something else (e.g. the screen) and is recomputed on every step.
+  fields: Optional[Tuple[str, ...]] = None
+
   def __init__(self, name: str, game_state_manager: GameStateManager, **kwargs):
     self.name = name
     self.game_state_manager = game_state_manager
@@ -20,6 +34,16 @@ class SingleReward(ABC):
   def calculate(self) -> float:
     pass
 
+  def calculate_trace(self, fields: Dict[str, np.ndarray]) -> Optional[np.ndarray]:
+    """
+    Scores of a whole episode at once, for offline evaluation. fields are the
+    states of every step stacked along the first axis, see StatePlan.unpack, and
+    the result is what calculate() would return after each step starting from a
+    reset. The reward's own state is left alone. None means the reward has no
+    vectorized form and is replayed step by step.
+    """
+    return None
+
   def reset(self):
     pass
 
@@ -27,54 +51,35 @@ class SingleReward(ABC):
 class ExplorationReward(SingleReward):
   def __init__(self, name: str, game_state_manager: GameStateManager, **kwargs):
     super().__init__(name, game_state_manager, **kwargs)
-    self.similar_frame_dist = kwargs["similar_frame_dist"]
-    self.vec_dim = 4320
-    self.num_elements = 20000  # max
+    backend = kwargs.get("novelty_backend", "hnsw")
+    if isinstance(backend, str):
+      backend = NOVELTY_BACKENDS[backend]
+    self.novelty = backend(game_state_manager, **kwargs)
+    self.fields = self.novelty.fields
     self.explore_weight = 1
     self.base_explore = 0
     self.levels_satisfied = False
-    self.output_shape = (36, 40, 3)
-    self.reset()
 
   def calculate(self):
     self.update()
+    return self.score(self.novelty.count())
+
+  def calculate_trace(self, fields):
+    counts = self.novelty.count_trace(fields)
+    return None if counts is None else self.score(counts)
+
+  def score(self, cur_size):
     pre_rew = self.explore_weight * 0.005
     post_rew = self.explore_weight * 0.01
-    cur_size = self.knn_index.get_current_count()
     base = (self.base_explore if self.levels_satisfied else cur_size) * pre_rew
     post = (cur_size if self.levels_satisfied else 0) * post_rew
     return base + post
 
   def reset(self):
-    self.init_knn()
-
-  def init_knn(self):
-    # Declaring index
-    self.knn_index = hnswlib.Index(
-      space="l2", dim=self.vec_dim
-    )  # possible options are l2, cosine or ip
-    # Initing index - the maximum number of elements should be known beforehand
-    self.knn_index.init_index(max_elements=self.num_elements, ef_construction=100, M=16)
+    self.novelty.reset()
 
   def update(self):
-    frame_vec = (
-      compress(self.game_state_manager.emulator.current_frame(), self.output_shape)
-      .flatten()
-      .astype(np.float32)
-    )
-    if self.knn_index.get_current_count() == 0:
-      # if index is empty add current frame
-      self.knn_index.add_items(
-        frame_vec, np.array([self.knn_index.get_current_count()])
-      )
-    else:
-      # check for nearest frame and add if current
-      labels, distances = self.knn_index.knn_query(frame_vec, k=1)
-      if distances[0][0] > self.similar_frame_dist:
-        # print(f"distances[0][0] : {distances[0][0]} similar_frame_dist : {self.similar_frame_dist}")
-        self.knn_index.add_items(
-          frame_vec, np.array([self.knn_index.get_current_count()])
-        )
+    self.novelty.update()
 
 
 # class RewardWrapper(SingleReward):
@@ -109,11 +114,29 @@ class RewardManager(object):
     self._total_reward = 0
     self.similar_frame_dist = config["sim_frame_dist"]
     self.state_scores = {}
+    self.evaluations = 0
+    self.skipped_evaluations = 0
+    self._scores_valid = False
 
     self.reward_items = []
+    novelty_kwargs = {k: v for k, v in config.items() if k.startswith("novelty_")}
     self.add_reward(
-      ExplorationReward, "explore", similar_frame_dist=self.similar_frame_dist
+      ExplorationReward,
+      "explore",
+      similar_frame_dist=self.similar_frame_dist,
+      **novelty_kwargs,
     )
+    if config.get("novelty_server") is not None:
+      # Only import zmq when a shared archive is used
+      from novelty_server import SharedNovelty
+
+      novelty_kwargs["novelty_backend"] = SharedNovelty
+      self.add_reward(
+        ExplorationReward,
+        "global_explore",
+        similar_frame_dist=self.similar_frame_dist,
+        **novelty_kwargs,
+      )
 
   def add_reward(
     self, reward_type: Type[SingleReward], name: str, weight=1.0, **kwargs
@@ -121,11 +144,36 @@ class RewardManager(object):
     reward_item = reward_type(name, self.game_state_manager, **kwargs)
     self.reward_items.append((reward_item, weight))
 
-  def update(self):
+  def update(
+    self,
+    changed_fields: Optional[AbstractSet[str]] = None,
+    scores: Optional[Dict[str, float]] = None,
+  ):
+    """
+    Recompute the rewards whose fields are in changed_fields, the others keep
+    their cached score. changed_fields=None recomputes everything. scores are
+    weighted scores already computed elsewhere, e.g. by a RewardSpec for a batch
+    of envs, and replace the rewards of the same name.
+    """
     for reward_item, weight in self.reward_items:
+      if scores is not None and reward_item.name in scores:
+        self.state_scores[reward_item.name] = (
+          self.reward_scale * scores[reward_item.name]
+        )
+        continue
+      if (
+        self._scores_valid
+        and changed_fields is not None
+        and reward_item.fields is not None
+        and changed_fields.isdisjoint(reward_item.fields)
+      ):
+        self.skipped_evaluations += 1
+        continue
+      self.evaluations += 1
       self.state_scores[reward_item.name] = (
         self.reward_scale * reward_item.calculate() * weight
       )
+    self._scores_valid = True
     return self.total_reward
 
   @property
@@ -139,3 +187,4 @@ class RewardManager(object):
   def reset(self):
     for reward_item, _ in self.reward_items:
       reward_item.reset()
+    self._scores_valid = False
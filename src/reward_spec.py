@@ -0,0 +1,373 @@
+from abc import ABC, abstractmethod
+from functools import reduce
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+import numpy as np
+import yaml
+
+from game_state import GameStateManager, StatePlan
+from reward import POPCOUNT_TABLE, RewardManager, SingleReward
+
+# Expressions are single key mappings {op: args}, a state or value name, or a
+# number. args is one expression or a list of them. Every array has the batch
+# axis first: envs when stepping, time when evaluating a trace. A list state has
+# a second axis, that the reductions collapse.
+
+
+def _fold(ufunc):
+  return lambda *args: reduce(ufunc, args)
+
+
+def _clip(x, lo=None, hi=None):
+  if lo is not None:
+    x = np.maximum(x, lo)
+  if hi is not None:
+    x = np.minimum(x, hi)
+  return x
+
+
+ELEMENTWISE = {
+  "add": _fold(np.add),
+  "sub": np.subtract,
+  "mul": _fold(np.multiply),
+  "div": np.true_divide,
+  "maximum": _fold(np.maximum),
+  "minimum": _fold(np.minimum),
+  "gt": np.greater,
+  "ge": np.greater_equal,
+  "lt": np.less,
+  "le": np.less_equal,
+  "eq": np.equal,
+  "ne": np.not_equal,
+  "and": _fold(np.logical_and),
+  "or": _fold(np.logical_or),
+  "not": np.logical_not,
+  "where": np.where,
+  "clip": _clip,
+}
+
+REDUCTIONS = {"sum": np.sum, "max": np.max, "min": np.min}
+
+
+class Node(ABC):
+  # State names the node reads
+  fields: FrozenSet[str] = frozenset()
+  # Whether the node gives the same value again for the same inputs, which lets
+  # a reward skip the steps where none of its fields changed
+  stable = True
+
+  def __init__(self, args: Tuple["Node", ...] = ()):
+    self.args = args
+    if args:
+      self.fields = frozenset().union(*(arg.fields for arg in args))
+      self.stable = all(arg.stable for arg in args)
+
+  @abstractmethod
+  def evaluate(self, fields: Dict[str, np.ndarray], trace: bool) -> np.ndarray:
+    """
+    Value for every env after one step, or with trace for every step of one
+    episode starting from a reset.
+    """
+    pass
+
+  def reset(self, envs=None):
+    """
+    Forget the history of envs, all of them when None.
+    """
+    for arg in self.args:
+      arg.reset(envs)
+
+
+class Field(Node):
+  def __init__(self, name: str):
+    super().__init__()
+    self.name = name
+    self.fields = frozenset([name])
+
+  def evaluate(self, fields, trace):
+    return fields[self.name]
+
+
+class Const(Node):
+  def __init__(self, value):
+    super().__init__()
+    self.value = value
+
+  def evaluate(self, fields, trace):
+    return self.value
+
+
+class Elementwise(Node):
+  def __init__(self, fn, args, params=()):
+    super().__init__(args)
+    self.fn = fn
+    self.params = params
+
+  def evaluate(self, fields, trace):
+    return self.fn(*(arg.evaluate(fields, trace) for arg in self.args), *self.params)
+
+
+class Reduce(Node):
+  def __init__(self, fn, arg: Node):
+    super().__init__((arg,))
+    self.fn = fn
+
+  def evaluate(self, fields, trace):
+    x = self.args[0].evaluate(fields, trace)
+    return self.fn(x, axis=-1) if np.ndim(x) > 1 else x
+
+
+class Popcount(Node):
+  """
+  Set bits of a state, summed over the entries of a list state.
+  """
+
+  def evaluate(self, fields, trace):
+    x = np.asarray(self.args[0].evaluate(fields, trace))
+    count = POPCOUNT_TABLE[x & 0xFF]
+    x = x >> 8
+    while x.any():
+      count = count + POPCOUNT_TABLE[x & 0xFF]
+      x = x >> 8
+    return count.sum(axis=-1) if count.ndim > 1 else count
+
+
+class Piecewise(Node):
+  """
+  Continuous piecewise linear map: x below the first breakpoint, then the
+  slope of each [breakpoint, slope] from that breakpoint on.
+  """
+
+  def __init__(self, arg: Node, segments):
+    super().__init__((arg,))
+    self.segments = []
+    start = None
+    for breakpoint, slope in sorted(segments):
+      start = breakpoint if start is None else self.segment_value(breakpoint)
+      self.segments.append((breakpoint, start, slope))
+
+  def segment_value(self, x):
+    for breakpoint, start, slope in reversed(self.segments):
+      if x >= breakpoint:
+        return start + slope * (x - breakpoint)
+    return x
+
+  def evaluate(self, fields, trace):
+    x = self.args[0].evaluate(fields, trace)
+    out = x
+    for breakpoint, start, slope in self.segments:
+      out = np.where(x >= breakpoint, start + slope * (x - breakpoint), out)
+    return out
+
+
+class TimeNode(Node):
+  """
+  An operator over the steps of an episode, keeping per env state between
+  steps. The state starts at 0 on a reset.
+  """
+
+  def __init__(self, arg: Node):
+    super().__init__((arg,))
+    self.stable = False
+    self.state: Optional[np.ndarray] = None
+
+  def reset(self, envs=None):
+    super().reset(envs)
+    if envs is None:
+      self.state = None
+    elif self.state is not None:
+      self.state[envs] = 0
+
+  def evaluate(self, fields, trace):
+    x = np.asarray(self.args[0].evaluate(fields, trace))
+    if trace:
+      return self.over_time(x)
+    if self.state is None:
+      self.state = np.zeros(x.shape, dtype=np.result_type(x, np.float64))
+    return self.advance(x)
+
+  @abstractmethod
+  def over_time(self, x: np.ndarray) -> np.ndarray:
+    pass
+
+  @abstractmethod
+  def advance(self, x: np.ndarray) -> np.ndarray:
+    pass
+
+
+class RunningMax(TimeNode):
+  def __init__(self, arg: Node):
+    super().__init__(arg)
+    self.stable = arg.stable
+
+  def over_time(self, x):
+    return np.maximum.accumulate(np.maximum(x, 0), axis=0)
+
+  def advance(self, x):
+    np.maximum(self.state, x, out=self.state)
+    return self.state.copy()
+
+
+class Prev(TimeNode):
+  def over_time(self, x):
+    return np.concatenate((np.zeros_like(x[:1]), x[:-1]))
+
+  def advance(self, x):
+    prev = self.state.copy()
+    self.state[:] = x
+    return prev
+
+
+class Delta(Prev):
+  def over_time(self, x):
+    return x - super().over_time(x)
+
+  def advance(self, x):
+    return x - super().advance(x)
+
+
+class CumSum(TimeNode):
+  def over_time(self, x):
+    return np.cumsum(x, axis=0)
+
+  def advance(self, x):
+    self.state += x
+    return self.state.copy()
+
+
+TIME_OPS = {"running_max": RunningMax, "prev": Prev, "delta": Delta, "cumsum": CumSum}
+
+
+class Shared(Node):
+  """
+  A named value, evaluated once per evaluation of the reward however often it is
+  used.
+  """
+
+  def __init__(self, arg: Node):
+    super().__init__((arg,))
+    self.value = None
+
+  def evaluate(self, fields, trace):
+    if self.value is None:
+      self.value = self.args[0].evaluate(fields, trace)
+    return self.value
+
+
+def compile_expr(expr, values: Dict[str, Any], compiled: Dict[str, Node]) -> Node:
+  """
+  Compile expr. values are the named expressions of the spec, compiled into
+  compiled on first use so that every reference shares one node.
+  """
+  if isinstance(expr, (int, float)):
+    return Const(expr)
+  if isinstance(expr, str):
+    if expr not in values:
+      return Field(expr)
+    if expr not in compiled:
+      compiled[expr] = Shared(compile_expr(values[expr], values, compiled))
+    return compiled[expr]
+  assert isinstance(expr, dict) and len(expr) == 1, f"Invalid expression {expr}"
+  ((op, args),) = expr.items()
+  if op == "piecewise":
+    arg, segments = args
+    return Piecewise(compile_expr(arg, values, compiled), segments)
+  args = args if isinstance(args, list) else [args]
+  if op == "clip":
+    # the bounds are constants, null for no bound
+    arg, *bounds = args
+    return Elementwise(_clip, (compile_expr(arg, values, compiled),), bounds)
+  nodes = tuple(compile_expr(arg, values, compiled) for arg in args)
+  if op in ELEMENTWISE:
+    return Elementwise(ELEMENTWISE[op], nodes)
+  assert len(nodes) == 1, f"{op} takes one argument"
+  if op in REDUCTIONS:
+    return Reduce(REDUCTIONS[op], nodes[0])
+  if op == "popcount":
+    return Popcount(nodes)
+  assert op in TIME_OPS, f"Invalid operator {op}"
+  return TIME_OPS[op](nodes[0])
+
+
+class CompiledReward(object):
+  def __init__(self, name: str, expr, values: Dict[str, Any], weight=1.0):
+    self.name = name
+    self.weight = weight
+    compiled: Dict[str, Node] = {}
+    self.root = compile_expr(expr, values, compiled)
+    self.shared = list(compiled.values())
+
+  def evaluate(self, fields: Dict[str, np.ndarray], trace=False) -> np.ndarray:
+    for node in self.shared:
+      node.value = None
+    return np.asarray(self.root.evaluate(fields, trace), dtype=np.float64)
+
+  def reset(self, envs=None):
+    self.root.reset(envs)
+
+
+def load_reward_spec(config_file: str) -> List[CompiledReward]:
+  with open(config_file, "r") as f:
+    config = yaml.load(f, Loader=yaml.FullLoader)
+  values = config.get("values", {})
+  return [
+    CompiledReward(reward["name"], reward["expr"], values, reward.get("weight", 1.0))
+    for reward in config["rewards"]
+  ]
+
+
+class RewardSpec(object):
+  """
+  The rewards of a spec file evaluated for a batch of envs at once, from their
+  decoded state values of shape (envs, len(plan.values)), or over all the steps
+  of one episode with trace.
+  """
+
+  def __init__(self, config_file: str, plan: StatePlan):
+    self.plan = plan
+    self.rewards = load_reward_spec(config_file)
+    self.names = [reward.name for reward in self.rewards]
+
+  def evaluate(self, values: np.ndarray, trace=False) -> np.ndarray:
+    """
+    Weighted scores of shape (batch, len(self.names)).
+    """
+    fields = self.plan.unpack(values)
+    return np.stack(
+      [reward.weight * reward.evaluate(fields, trace) for reward in self.rewards],
+      axis=-1,
+    )
+
+  def reset(self, envs=None):
+    for reward in self.rewards:
+      reward.reset(envs)
+
+
+class SpecReward(SingleReward):
+  """
+  One reward of a spec file in a RewardManager, evaluated for its single env.
+  """
+
+  def __init__(
+    self, name: str, game_state_manager: GameStateManager, reward: CompiledReward
+  ):
+    super().__init__(name, game_state_manager)
+    self.reward = reward
+    self.fields = tuple(sorted(reward.root.fields)) if reward.root.stable else None
+
+  def calculate(self) -> float:
+    plan = self.game_state_manager.plan
+    return float(self.reward.evaluate(plan.unpack(plan.values[None]))[0])
+
+  def calculate_trace(self, fields):
+    return self.reward.evaluate(fields, trace=True)
+
+  def reset(self):
+    self.reward.reset()
+
+
+def add_spec_rewards(reward_manager: RewardManager, config_file: str):
+  """
+  Add every reward of a spec file to reward_manager.
+  """
+  for reward in load_reward_spec(config_file):
+    reward_manager.add_reward(SpecReward, reward.name, reward.weight, reward=reward)
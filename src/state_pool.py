@@ -0,0 +1,66 @@
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+import numpy as np
+
+
+@lru_cache(maxsize=None)
+def read_state(path: str) -> bytes:
+  """
+  Savestate bytes of path, read once per process.
+  """
+  with open(path, "rb") as f:
+    return f.read()
+
+
+class StatePool(object):
+  """
+  Start states for resets, sampled in proportion to their weights. Fixed
+  states come from files, harvested ones are added while training and only the
+  newest max_harvested of them are kept.
+  """
+
+  def __init__(self, max_harvested=64, seed=None):
+    self.fixed: Dict[str, Tuple[bytes, float]] = {}
+    self.harvested: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+    self.max_harvested = max_harvested
+    self.rng = np.random.default_rng(seed)
+    self.names = None
+
+  def add_file(self, path, weight=1.0):
+    path = str(Path(path).resolve())
+    self.add_state(path, read_state(path), weight)
+
+  def add_state(self, name: str, state: bytes, weight=1.0):
+    self.fixed[name] = (state, weight)
+    self.names = None
+
+  def load_dir(self, directory, weights: Optional[Dict[str, float]] = None):
+    """
+    Add every .state file of directory, weighted by weights[file name] or 1.
+    """
+    weights = weights or {}
+    for path in sorted(Path(directory).glob("*.state")):
+      self.add_file(path, weights.get(path.name, 1.0))
+
+  def harvest(self, name: str, state: bytes, weight=1.0):
+    self.harvested[name] = (state, weight)
+    while len(self.harvested) > self.max_harvested:
+      self.harvested.popitem(last=False)
+    self.names = None
+
+  def __len__(self):
+    return len(self.fixed) + len(self.harvested)
+
+  def sample(self) -> Tuple[str, bytes]:
+    if self.names is None:
+      states = {**self.fixed, **self.harvested}
+      self.names = list(states)
+      self.states = [state for state, _ in states.values()]
+      weights = np.array([weight for _, weight in states.values()], dtype=np.float64)
+      self.probs = weights / weights.sum()
+    if len(self.names) == 1:
+      return self.names[0], self.states[0]
+    i = self.rng.choice(len(self.names), p=self.probs)
+    return self.names[i], self.states[i]
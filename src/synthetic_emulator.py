@@ -0,0 +1,144 @@
+import enum
+import struct
+import time
+import numpy as np
+from emulator import Emulator
+from frame_buffer import FrameRing
+from state_pool import StatePool
+import visual_util
+
+
+class SyntheticAction(enum.Enum):
+  UP = 0
+  DOWN = 1
+  LEFT = 2
+  RIGHT = 3
+  A = 4
+  B = 5
+
+
+# Addresses the synthetic game keeps its player position in, the same as the
+# Pokemon Red ones of game_state.yml so position based novelty sees movement
+X_ADDR = 0xD362
+Y_ADDR = 0xD361
+MAP_ADDR = 0xD35E
+MAP_SIZE = 20
+TILE = 16
+BACKGROUND = 256
+
+MOVES = {
+  SyntheticAction.UP: (0, -1),
+  SyntheticAction.DOWN: (0, 1),
+  SyntheticAction.LEFT: (-1, 0),
+  SyntheticAction.RIGHT: (1, 0),
+}
+
+
+class SyntheticEmulator(Emulator):
+  """
+  ROM-free stand-in for GBEmulator, for benchmarks and tests. Frames and memory
+  are a deterministic function of synthetic_seed and the actions taken: the
+  arrows walk a player over a tiled background, wrapping into the next map at
+  the edges, and A/B write pseudo random bytes of work RAM. synthetic_cost_us
+  of busy work per action stands in for the cost of emulation.
+  """
+
+  def __init__(self, config):
+    self.seed = config.get("synthetic_seed", 0)
+    self.cost_s = config.get("synthetic_cost_us", 0.0) / 1e6
+    rng = np.random.default_rng(self.seed)
+    tiles = rng.integers(
+      0, 256, (BACKGROUND // TILE, BACKGROUND // TILE, 3), dtype=np.uint8
+    )
+    background = tiles.repeat(TILE, axis=0).repeat(TILE, axis=1)
+    # Tiled twice so any window of it is a plain slice
+    self.background = np.tile(background, (2, 2, 1))
+    self.memory = rng.integers(0, 256, 0x10000, dtype=np.uint8)
+    self.memory[[X_ADDR, Y_ADDR, MAP_ADDR]] = 0
+    self.lcg = self.seed
+    self.state_pool = StatePool(config.get("state_pool_size", 64), config.get("seed"))
+    self.state_pool.add_state("synthetic", self.save_snapshot())
+
+    self.save_n_frames = config.get("save_n_frames", 3)
+    self.frame_history = FrameRing(self.save_n_frames, (144, 160, 3))
+    self.downscale_method = config.get("downscale", "block")
+    self._current_frame = None
+    self._current_downscaled = None
+    self.downscaled_history = FrameRing(self.save_n_frames, self.downscaled_shape)
+
+  def action_len(self) -> int:
+    return len(SyntheticAction)
+
+  def get_action(self, action: int) -> enum.Enum:
+    return SyntheticAction(action)
+
+  def reset(self):
+    self.start_state, state = self.state_pool.sample()
+    self.restore_snapshot(state)
+
+  def save_snapshot(self) -> bytes:
+    return struct.pack("<Q", self.lcg) + self.memory.tobytes()
+
+  def restore_snapshot(self, snapshot: bytes):
+    (self.lcg,) = struct.unpack_from("<Q", snapshot)
+    self.memory[:] = np.frombuffer(snapshot, dtype=np.uint8, offset=8)
+    self._current_frame = None
+    self._current_downscaled = None
+
+  def current_frame(self):
+    if self._current_frame is None:
+      x, y, map_id = (int(self.memory[a]) for a in (X_ADDR, Y_ADDR, MAP_ADDR))
+      top = (y * TILE + map_id * 7 * TILE) % BACKGROUND
+      left = (x * TILE + map_id * 3 * TILE) % BACKGROUND
+      self._current_frame = self.background[top : top + 144, left : left + 160]
+    return self._current_frame
+
+  def current_downscaled_frame(self):
+    if self._current_downscaled is None:
+      self._current_downscaled = visual_util.downscale(
+        self.current_frame(), self.downscaled_shape, self.downscale_method
+      )
+    return self._current_downscaled
+
+  def emulate(self, action: int):
+    end = time.perf_counter() + self.cost_s
+    action = self.get_action(action)
+    if action in MOVES:
+      dx, dy = MOVES[action]
+      x = int(self.memory[X_ADDR]) + dx
+      y = int(self.memory[Y_ADDR]) + dy
+      if not (0 <= x < MAP_SIZE and 0 <= y < MAP_SIZE):
+        self.memory[MAP_ADDR] = (int(self.memory[MAP_ADDR]) + 1) % 256
+      self.memory[X_ADDR], self.memory[Y_ADDR] = x % MAP_SIZE, y % MAP_SIZE
+    else:
+      self.lcg = (self.lcg * 6364136223846793005 + 1442695040888963407) % 2**64
+      # one byte of work RAM, 0xC000-0xDFFF
+      self.memory[0xC000 + (self.lcg >> 51)] = (self.lcg >> 32) & 0xFF
+    while time.perf_counter() < end:
+      pass
+    self._current_frame = None
+    self._current_downscaled = None
+
+  def emulate_idle(self):
+    # nothing moves without input, only the time passes
+    end = time.perf_counter() + self.cost_s
+    while time.perf_counter() < end:
+      pass
+
+  def record_frame(self, downscaled=None):
+    self.frame_history.push(self.current_frame())
+    if downscaled is not None:
+      self._current_downscaled = downscaled
+    self.downscaled_history.push(self.current_downscaled_frame())
+
+  def get_last_n_frames(self, n=3, out=None):
+    return self.frame_history.latest(n, out)
+
+  def get_last_n_downscaled_frames(self, n=3, out=None):
+    return self.downscaled_history.latest(n, out)
+
+  def read_one_byte(self, address) -> int:
+    return int(self.memory[address])
+
+  def read_block(self, address, size) -> np.ndarray:
+    return self.memory[address : address + size].copy()
@@ -1,4 +1,4 @@
-from os.path import exists
+from functools import partial
 from pathlib import Path
 import uuid
 import yaml
@@ -7,9 +7,18 @@ from gb_emulator import GBEmulator
 from stable_baselines3 import PPO
 from stable_baselines3.common.vec_env import SubprocVecEnv
 from stable_baselines3.common.utils import set_random_seed
-from stable_baselines3.common.callbacks import CheckpointCallback
 
+from checkpoint import (
+  AsyncCheckpointCallback,
+  latest_checkpoint,
+  latest_session,
+  resume,
+)
 from games.pokemon_red import PokemonRedReward
+from novelty_server import start_novelty_server
+from video import start_video_encoder
+from vec_env import GroupedSubprocVecEnv
+from worker_template import WorkerTemplate, take_game_state, warm_game_states
 import fire
 
 
@@ -23,7 +32,12 @@ def make_env(rank, env_conf, seed=0):
   """
 
   def _init():
-    env = create_env(env_conf, PokemonRedReward, GBEmulator)
+    env = create_env(
+      env_conf,
+      PokemonRedReward,
+      GBEmulator,
+      take_game_state(env_conf, GBEmulator),
+    )
     env.reset(seed=(seed + rank))
     return env
 
@@ -31,54 +45,109 @@ def make_env(rank, env_conf, seed=0):
   return _init
 
 
-def train(config):
-  sess_path = Path(f"session_{str(uuid.uuid4())[:8]}")
+def warm_worker(env_conf, envs_per_process):
+  """
+  Runs once in the WorkerTemplate: import what the workers run and build the
+  emulators of one worker, which every forked worker gets a copy of.
+  """
+  import vec_env  # noqa: F401
+
+  # a window can't be shared by forked workers
+  if env_conf["headless"]:
+    warm_game_states(env_conf, GBEmulator, envs_per_process)
+
+
+def train(config, resume_from=None):
+  """
+  resume_from is a session directory to continue from its latest checkpoint, or
+  "latest" for the most recently checkpointed session.
+  """
+  if resume_from == "latest":
+    resume_from = latest_session()
+    assert resume_from is not None, "No session with checkpoints found"
+  if resume_from is not None:
+    sess_path = Path(resume_from)
+  else:
+    sess_path = Path(f"session_{str(uuid.uuid4())[:8]}")
   with open(config, "r") as f:
     env_config = yaml.load(f, Loader=yaml.FullLoader)
   env_config["session_path"] = sess_path
   ep_length = env_config["max_steps"]
+  if env_config.get("novelty_server") is not None:
+    start_novelty_server(env_config)
+  if env_config["save_video"]:
+    if env_config.get("video_server") is None:
+      env_config["video_server"] = f"ipc:///tmp/gamebrain_video_{sess_path.name}"
+    start_video_encoder(env_config)
 
   # Simple checking
   # env_checker.check_env(RedGymEnv(env_config))
 
   num_cpu = 20  # 64 #46  # Also sets the number of episodes per training iteration
+  # for the budgets shared by all envs, e.g. archive_max_memory_mb
+  env_config["num_envs"] = num_cpu
   # env = SubprocVecEnv([rand_env for i in range(num_cpu)])
-  env = SubprocVecEnv([make_env(i, env_config) for i in range(num_cpu)])
+  # "shared" exchanges observations through shared memory and steps
+  # envs_per_process envs together in each worker, see vec_env
+  envs_per_process = env_config.get("envs_per_process", 1)
+  template = None
+  if env_config.get("vec_env", "subproc") == "shared":
+    # The workers are forked ready to step from a warmed up template, see
+    # worker_template
+    if env_config.get("worker_template", False):
+      template = WorkerTemplate(partial(warm_worker, env_config, envs_per_process))
+      print(f"worker template ready in {template.startup_s:.2f}s")
+    env = GroupedSubprocVecEnv(
+      [
+        [
+          make_env(i, env_config)
+          for i in range(beg, min(beg + envs_per_process, num_cpu))
+        ]
+        for beg in range(0, num_cpu, envs_per_process)
+      ],
+      template=template,
+    )
+    print(f"{num_cpu} envs started in {env.startup_s:.2f}s")
+  else:
+    env = SubprocVecEnv([make_env(i, env_config) for i in range(num_cpu)])
   # env = make_env(0, env_config)()
 
-  checkpoint_callback = CheckpointCallback(
-    save_freq=ep_length, save_path=sess_path, name_prefix="poke"
+  # Checkpoints are copied to memory at save_freq and written in the background
+  checkpoint_dir = sess_path / Path("checkpoints")
+  checkpoint_callback = AsyncCheckpointCallback(
+    save_freq=ep_length,
+    directory=checkpoint_dir,
+    keep_last=env_config.get("checkpoint_keep_last", 3),
+    keep_best=env_config.get("checkpoint_keep_best", 2),
+    save_archives=env_config.get("checkpoint_archives", False),
+    verbose=1,
   )
   learn_steps = 5
-  file_name = (
-    "session_85b348fa/poke_983041_steps"  #'session_e41c9eff/poke_250871808_steps'
-  )
-
-  #'session_bfdca25a/poke_42532864_steps' #'session_d3033abb/poke_47579136_steps' #'session_a17cc1f5/poke_33546240_steps' #'session_e4bdca71/poke_8945664_steps' #'session_eb21989e/poke_40255488_steps' #'session_80f70ab4/poke_58982400_steps'
   print(f"\n current session: {sess_path}")
-  if exists(file_name + ".zip"):
-    print("\nloading checkpoint")
-    model = PPO.load(file_name, env=env)
-    model.n_steps = ep_length
-    model.n_envs = num_cpu
-    model.rollout_buffer.buffer_size = ep_length
-    model.rollout_buffer.n_envs = num_cpu
-    model.rollout_buffer.reset()
-  else:
-    model = PPO(
-      "CnnPolicy",
-      env,
-      verbose=1,
-      n_steps=ep_length,
-      batch_size=512,
-      n_epochs=1,
-      gamma=0.999,
-    )
+  model = PPO(
+    "CnnPolicy",
+    env,
+    verbose=1,
+    n_steps=ep_length,
+    batch_size=512,
+    n_epochs=1,
+    gamma=0.999,
+  )
+  checkpoint = latest_checkpoint(checkpoint_dir)
+  if checkpoint is not None:
+    print(f"\nloading checkpoint {checkpoint}")
+    resume(model, checkpoint, env)
 
   for i in range(learn_steps):
     model.learn(
-      total_timesteps=(ep_length) * num_cpu * 1000, callback=checkpoint_callback
+      total_timesteps=(ep_length) * num_cpu * 1000,
+      callback=checkpoint_callback,
+      reset_num_timesteps=False,
     )
+  checkpoint_callback.close()
+  env.close()
+  if template is not None:
+    template.close()
 
 
 if __name__ == "__main__":
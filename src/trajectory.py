@@ -0,0 +1,183 @@
+from pathlib import Path
+import hashlib
+import json
+import struct
+import zlib
+from typing import Sequence
+import numpy as np
+import fire
+import yaml
+from PIL import Image
+
+from emulator import Emulator
+from gb_emulator import GBEmulator
+
+# Every record of a trajectory file is its compressed length then zlib data. The
+# first record is the JSON header, every other one a chunk of consecutive steps.
+RECORD = struct.Struct("<I")
+# Chunk: index of its first step and length of the snapshot taken before that
+# step, then the snapshot and one uint8 action per step. An empty snapshot
+# stands for the init state named in the header.
+CHUNK = struct.Struct("<qI")
+# Action id of an action emulated without input, see Emulator.emulate_idle
+NO_INPUT = 255
+
+
+def file_sha1(path) -> str:
+  with open(path, "rb") as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+
+class TrajectoryRecorder(object):
+  """
+  Records episodes as their actions plus an emulator snapshot about every
+  checkpoint_every actions, one compressed file per episode. Any step can be
+  rebuilt from it with TrajectoryReader.
+  """
+
+  def __init__(self, directory, emulator: Emulator, config, checkpoint_every=1024):
+    self.directory = Path(directory)
+    self.emulator = emulator
+    self.checkpoint_every = checkpoint_every
+    self.init_state = str(Path(config["init_state"]).resolve())
+    self.init_state_sha1 = file_sha1(self.init_state)
+    self.action_freq = config["action_freq"]
+    self.actions = bytearray()
+    self.file = None
+
+  def start_episode(self, name: str):
+    self.end_episode()
+    self.directory.mkdir(parents=True, exist_ok=True)
+    self.file = open(self.directory / Path(f"{name}.traj"), "wb")
+    header = {
+      "init_state": self.init_state,
+      "init_state_sha1": self.init_state_sha1,
+      "action_freq": self.action_freq,
+      "checkpoint_every": self.checkpoint_every,
+    }
+    self.write_record(json.dumps(header).encode())
+    self.start = 0
+    self.actions.clear()
+    # the init state is only referenced, other start states are stored
+    self.snapshot = b""
+    if self.emulator.start_state != self.init_state:
+      self.snapshot = self.emulator.save_snapshot()
+
+  def record(self, actions: Sequence[int]):
+    """
+    Record the actions emulated by one env step. Snapshots are only taken
+    between env steps, so a chunk runs over checkpoint_every rather than
+    splitting a step.
+    """
+    if self.file is None:
+      return
+    self.actions.extend(actions)
+    if len(self.actions) >= self.checkpoint_every:
+      self.write_chunk()
+      self.start += len(self.actions)
+      self.actions.clear()
+      self.snapshot = self.emulator.save_snapshot()
+
+  def write_chunk(self):
+    self.write_record(
+      CHUNK.pack(self.start, len(self.snapshot)) + self.snapshot + bytes(self.actions)
+    )
+
+  def write_record(self, data: bytes):
+    data = zlib.compress(data, 1)
+    self.file.write(RECORD.pack(len(data)) + data)
+
+  def end_episode(self):
+    if self.file is None:
+      return
+    if self.actions:
+      self.write_chunk()
+    self.file.close()
+    self.file = None
+
+
+class TrajectoryReader(object):
+  def __init__(self, path):
+    with open(path, "rb") as f:
+      data = f.read()
+    records = []
+    pos = 0
+    # a record cut short by a crash is ignored
+    while pos + RECORD.size <= len(data):
+      (size,) = RECORD.unpack_from(data, pos)
+      if pos + RECORD.size + size > len(data):
+        break
+      records.append(
+        zlib.decompress(data[pos + RECORD.size : pos + RECORD.size + size])
+      )
+      pos += RECORD.size + size
+    self.header = json.loads(records[0])
+    self.starts = []
+    self.snapshots = []
+    actions = []
+    for record in records[1:]:
+      start, snapshot_len = CHUNK.unpack_from(record)
+      self.starts.append(start)
+      self.snapshots.append(record[CHUNK.size : CHUNK.size + snapshot_len])
+      actions.append(np.frombuffer(record[CHUNK.size + snapshot_len :], np.uint8))
+    self.actions = np.concatenate(actions) if actions else np.zeros(0, np.uint8)
+    self.init_state_checked = False
+
+  def __len__(self):
+    return len(self.actions)
+
+  def seek(self, emulator: Emulator, step: int):
+    """
+    Bring emulator to the state right after action step, from the nearest
+    snapshot before it.
+    """
+    assert 0 <= step < len(self), f"Trajectory has {len(self)} steps"
+    chunk = int(np.searchsorted(self.starts, step, side="right")) - 1
+    if self.snapshots[chunk]:
+      emulator.restore_snapshot(self.snapshots[chunk])
+    else:
+      init_state = self.header["init_state"]
+      if not self.init_state_checked:
+        assert (
+          file_sha1(init_state) == self.header["init_state_sha1"]
+        ), f"{init_state} changed since the trajectory was recorded"
+        self.init_state_checked = True
+      with open(init_state, "rb") as f:
+        emulator.restore_snapshot(f.read())
+    for action in self.actions[self.starts[chunk] : step + 1]:
+      if action == NO_INPUT:
+        emulator.emulate_idle()
+        emulator.record_frame()
+      else:
+        emulator.run_action(int(action))
+
+
+def replay_emulator(trajectory, config):
+  with open(config, "r") as f:
+    env_config = yaml.load(f, Loader=yaml.FullLoader)
+  reader = TrajectoryReader(trajectory)
+  env_config["action_freq"] = reader.header["action_freq"]
+  env_config["headless"] = True
+  return reader, GBEmulator(env_config)
+
+
+def frame(trajectory, config, step, out):
+  """
+  Save the screen after action step of a trajectory to out.
+  """
+  reader, emulator = replay_emulator(trajectory, config)
+  reader.seek(emulator, step)
+  Image.fromarray(emulator.current_frame()).save(out)
+
+
+def ram(trajectory, config, step, address=0xC000, size=0x2000):
+  """
+  Print memory from address after action step of a trajectory as hex.
+  """
+  reader, emulator = replay_emulator(trajectory, config)
+  reader.seek(emulator, step)
+  print(emulator.read_block(address, size).tobytes().hex())
+
+
+if __name__ == "__main__":
+  fire.Fire({"frame": frame, "ram": ram})
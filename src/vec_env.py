@@ -0,0 +1,448 @@
+from functools import partial
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from multiprocessing.connection import Listener
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from stable_baselines3.common.vec_env.base_vec_env import CloudpickleWrapper, VecEnv
+
+from game_env import GameEnv
+from reward_spec import RewardSpec
+import visual_util
+from worker_template import WorkerTemplate
+
+
+class BatchedGameEnv(VecEnv):
+  """
+  Steps N GameEnv in one process as a Stable-Baselines3 VecEnv.
+
+  Every emulator runs its action on its own, then the new screens are
+  downscaled and the game states decoded for all envs at once over a leading
+  env axis, and the observations are written in place into one (N, ...) buffer.
+  The rewards of a reward_spec file are evaluated for all envs at once by a
+  RewardSpec over the decoded states, the others per env by each RewardManager.
+  """
+
+  def __init__(self, env_fns: List[Callable[[], GameEnv]]):
+    self.envs = [env_fn() for env_fn in env_fns]
+    env = self.envs[0]
+    self.plan = env.game_state_manager.plan
+    for other in self.envs[1:]:
+      assert (
+        other.game_state_manager.plan.ranges == self.plan.ranges
+      ), "All envs need the same game states"
+    num_envs = len(self.envs)
+    frame = env.emulator.current_frame()
+    self.frames = np.zeros((num_envs,) + frame.shape, dtype=frame.dtype)
+    self.raw_states = np.zeros((num_envs,) + self.plan.buffer.shape, dtype=np.uint8)
+    self.state_values = np.zeros((num_envs,) + self.plan.values.shape, dtype=np.int64)
+    self.use_buffers(
+      np.zeros(
+        (num_envs,) + env.observation_space.shape, dtype=env.observation_space.dtype
+      ),
+      np.zeros(num_envs, dtype=np.float32),
+      np.zeros(num_envs, dtype=bool),
+    )
+    self.actions = None
+    # A reset from the cell archive scores its start state in the env's own
+    # rewards, which the batch would not see
+    self.reward_spec = None
+    if env.reward_spec is not None and all(e.archive is None for e in self.envs):
+      assert all(
+        e.reward_spec == env.reward_spec for e in self.envs
+      ), "All envs need the same reward spec"
+      self.reward_spec = RewardSpec(env.reward_spec, self.plan)
+    super().__init__(num_envs, env.observation_space, env.action_space)
+
+  def use_buffers(self, obs: np.ndarray, rewards: np.ndarray, dones: np.ndarray):
+    """
+    Write observations, rewards and done flags into these arrays from now on.
+    Every env assembles its observation directly in its row of obs.
+    """
+    self.obs = obs
+    self.rewards = rewards
+    self.dones = dones
+    for i, env in enumerate(self.envs):
+      env.obs.use_buffer(obs[i])
+
+  def reset(self):
+    for i, env in enumerate(self.envs):
+      _, self.reset_infos[i] = env.reset(seed=self._seeds[i])
+    if self.reward_spec is not None:
+      self.reward_spec.reset()
+    # Seeds are only used once
+    self._reset_seeds()
+    return self.obs.copy()
+
+  def step_async(self, actions: np.ndarray):
+    self.actions = actions
+
+  def step_wait(self):
+    infos = self.step_in_place()
+    # The buffers are rewritten by the next step, SB3 keeps the previous ones
+    return self.obs.copy(), self.rewards.copy(), self.dones.copy(), infos
+
+  def step_in_place(self) -> List[Dict[str, Any]]:
+    """
+    Step every env with the actions from step_async, write the results into
+    the obs, rewards and dones buffers and return the infos.
+    """
+    for i, (env, action) in enumerate(zip(self.envs, self.actions)):
+      env.emulate(action)
+      self.frames[i] = env.emulator.current_frame()
+
+    emulator = self.envs[0].emulator
+    downscaled = visual_util.downscale(
+      self.frames, emulator.downscaled_shape, emulator.downscale_method
+    )
+    for i, env in enumerate(self.envs):
+      env.emulator.record_frame(downscaled[i])
+      self.plan.read(env.emulator, out=self.raw_states[i])
+    self.plan.decode(self.raw_states, out=self.state_values)
+    scores = None
+    if self.reward_spec is not None:
+      scores = self.reward_spec.evaluate(self.state_values).tolist()
+
+    infos = []
+    for i, env in enumerate(self.envs):
+      changed_fields = env.game_state_manager.update(self.state_values[i])
+      # emulation, the game state and the spec rewards are done for the batch
+      env.profiler.start()
+      env_scores = None
+      if scores is not None:
+        env_scores = dict(zip(self.reward_spec.names, scores[i]))
+      obs, self.rewards[i], terminated, truncated, info = env.finish_step(
+        changed_fields, scores=env_scores
+      )
+      # convert to SB3 VecEnv api
+      self.dones[i] = terminated or truncated
+      info["TimeLimit.truncated"] = truncated and not terminated
+      if self.dones[i]:
+        info["terminal_observation"] = obs.copy()
+        _, self.reset_infos[i] = env.reset()
+        if self.reward_spec is not None:
+          self.reward_spec.reset([i])
+      infos.append(info)
+    return infos
+
+  def close(self):
+    for env in self.envs:
+      env.close()
+
+  def get_images(self) -> Sequence[Optional[np.ndarray]]:
+    return [env.render() for env in self.envs]
+
+  def get_attr(self, attr_name: str, indices=None) -> List[Any]:
+    return [getattr(self.envs[i], attr_name) for i in self._get_indices(indices)]
+
+  def set_attr(self, attr_name: str, value: Any, indices=None):
+    for i in self._get_indices(indices):
+      setattr(self.envs[i], attr_name, value)
+
+  def env_method(self, method_name: str, *method_args, indices=None, **method_kwargs):
+    return [
+      getattr(self.envs[i], method_name)(*method_args, **method_kwargs)
+      for i in self._get_indices(indices)
+    ]
+
+  def env_is_wrapped(self, wrapper_class, indices=None) -> List[bool]:
+    # Import here to avoid a circular import
+    from stable_baselines3.common.env_util import is_wrapped
+
+    return [is_wrapped(self.envs[i], wrapper_class) for i in self._get_indices(indices)]
+
+
+def attach_shared_array(spec) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+  """
+  Map the array described by spec (name, shape, dtype) created by
+  GroupedSubprocVecEnv, which unlinks it on close.
+  """
+  name, shape, dtype = spec
+  shm = shared_memory.SharedMemory(name=name)
+  return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _group_worker(remote, parent_remote, env_fns_wrapper: CloudpickleWrapper):
+  parent_remote.close()
+  _serve_group(remote, env_fns_wrapper.var)
+
+
+def _serve_group(remote, env_fns: List[Callable[[], GameEnv]]):
+  venv = BatchedGameEnv(env_fns)
+  shms = []
+  actions = None
+  all_infos = False
+  while True:
+    try:
+      cmd, data = remote.recv()
+    except EOFError:
+      break
+    if cmd == "step":
+      venv.step_async(actions)
+      infos = venv.step_in_place()
+      # only the infos of finished episodes cross the pipe by default
+      remote.send(
+        [(i, info) for i, info in enumerate(infos) if all_infos or venv.dones[i]]
+      )
+    elif cmd == "reset":
+      venv._seeds = data
+      venv.reset()
+      remote.send(venv.reset_infos)
+    elif cmd == "attach":
+      specs, group_slice, all_infos = data
+      shms, arrays = zip(*[attach_shared_array(spec) for spec in specs])
+      obs, rewards, dones, actions = [array[group_slice] for array in arrays]
+      venv.use_buffers(obs, rewards, dones)
+      remote.send(None)
+    elif cmd == "close":
+      venv.close()
+      remote.close()
+      break
+    elif cmd == "get_spaces":
+      remote.send((venv.observation_space, venv.action_space))
+    elif cmd == "render":
+      remote.send(venv.get_images())
+    elif cmd == "env_method":
+      method_name, indices, args, kwargs = data
+      remote.send(venv.env_method(method_name, *args, indices=indices, **kwargs))
+    elif cmd == "get_attr":
+      remote.send(venv.get_attr(*data))
+    elif cmd == "set_attr":
+      remote.send(venv.set_attr(*data))
+    elif cmd == "is_wrapped":
+      remote.send(venv.env_is_wrapped(*data))
+    else:
+      raise NotImplementedError(f"`{cmd}` is not implemented in the worker")
+  for shm in shms:
+    shm.close()
+
+
+class GroupedSubprocVecEnv(VecEnv):
+  """
+  Runs each group of env_fns as one BatchedGameEnv in its own subprocess.
+
+  Observations, rewards, done flags and actions live in shared memory arrays
+  that the workers read and write in place, so a step only sends a short
+  command to each group and gets back the infos of the episodes that ended.
+  With all_infos every step info is sent back as with SubprocVecEnv, otherwise
+  the other infos are empty and env_method("info") fetches them on demand.
+
+  With a template the workers are forked from it instead of started from
+  scratch. A worker that dies is replaced during step_wait, and its envs are
+  reported done with worker_respawned in their info.
+  """
+
+  def __init__(
+    self,
+    env_fn_groups: List[List[Callable[[], GameEnv]]],
+    start_method: Optional[str] = None,
+    all_infos: bool = False,
+    template: Optional[WorkerTemplate] = None,
+  ):
+    beg = time.perf_counter()
+    self.waiting = False
+    self.closed = False
+    self.env_fn_groups = env_fn_groups
+    self.all_infos = all_infos
+    self.template = template
+    self.respawn_times: List[float] = []
+    if template is None:
+      if start_method is None:
+        forkserver_available = "forkserver" in mp.get_all_start_methods()
+        start_method = "forkserver" if forkserver_available else "spawn"
+      self.ctx = mp.get_context(start_method)
+    else:
+      self.authkey = os.urandom(32)
+      self.listener = Listener(authkey=self.authkey)
+
+    # global env index -> (group, index in group)
+    self.locations = [
+      (group, i)
+      for group, env_fns in enumerate(env_fn_groups)
+      for i in range(len(env_fns))
+    ]
+    self.group_slices = []
+    first = 0
+    for env_fns in env_fn_groups:
+      self.group_slices.append(slice(first, first + len(env_fns)))
+      first += len(env_fns)
+
+    # a process for each worker started here, None for forked ones
+    self.remotes, self.processes, self.pids = [], [], []
+    for group in range(len(env_fn_groups)):
+      remote, process, pid = self._start_worker(group)
+      self.remotes.append(remote)
+      self.processes.append(process)
+      self.pids.append(pid)
+
+    self.remotes[0].send(("get_spaces", None))
+    observation_space, action_space = self.remotes[0].recv()
+    num_envs = len(self.locations)
+
+    # the spaces are only known once an env exists, so the arrays are created
+    # after the workers and attached by them
+    self.shms = []
+    self.specs = specs = []
+    for shape, dtype in (
+      ((num_envs,) + observation_space.shape, observation_space.dtype),
+      ((num_envs,), np.float32),
+      ((num_envs,), bool),
+      ((num_envs,) + action_space.shape, action_space.dtype),
+    ):
+      dtype = np.dtype(dtype)
+      size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+      shm = shared_memory.SharedMemory(create=True, size=size)
+      self.shms.append(shm)
+      specs.append((shm.name, shape, dtype))
+    self.obs, self.rewards, self.dones, self.actions = [
+      np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+      for shm, (_, shape, dtype) in zip(self.shms, specs)
+    ]
+    for remote, group_slice in zip(self.remotes, self.group_slices):
+      remote.send(("attach", (specs, group_slice, all_infos)))
+    for remote in self.remotes:
+      remote.recv()
+
+    super().__init__(num_envs, observation_space, action_space)
+    self.startup_s = time.perf_counter() - beg
+
+  def _start_worker(self, group: int):
+    """
+    Start the worker of group, return its connection, process and pid.
+    """
+    env_fns = self.env_fn_groups[group]
+    if self.template is not None:
+      pid = self.template.fork(
+        partial(_serve_group, env_fns=env_fns), self.listener.address, self.authkey
+      )
+      return self.listener.accept(), None, pid
+    remote, work_remote = self.ctx.Pipe()
+    args = (work_remote, remote, CloudpickleWrapper(env_fns))
+    # daemon=True: if the main process crashes, we should not cause things to hang
+    process = self.ctx.Process(target=_group_worker, args=args, daemon=True)
+    process.start()
+    work_remote.close()
+    return remote, process, process.pid
+
+  def respawn(self, group: int) -> List[Tuple[int, Dict[str, Any]]]:
+    """
+    Replace the dead worker of group and reset its envs. Return the reset infos
+    as (index in group, info).
+    """
+    beg = time.perf_counter()
+    self.remotes[group].close()
+    if self.processes[group] is not None:
+      self.processes[group].join()
+    remote, process, pid = self._start_worker(group)
+    self.remotes[group], self.processes[group], self.pids[group] = remote, process, pid
+    group_slice = self.group_slices[group]
+    remote.send(("attach", (self.specs, group_slice, self.all_infos)))
+    remote.recv()
+    remote.send(("reset", [None] * (group_slice.stop - group_slice.start)))
+    reset_infos = remote.recv()
+    self.rewards[group_slice] = 0.0
+    self.dones[group_slice] = True
+    self.respawn_times.append(time.perf_counter() - beg)
+    print(f"worker {group} respawned in {self.respawn_times[-1]:.2f}s")
+    return [
+      (i, {**info, "worker_respawned": True}) for i, info in enumerate(reset_infos)
+    ]
+
+  def step_async(self, actions: np.ndarray):
+    self.actions[:] = actions
+    for remote in self.remotes:
+      try:
+        remote.send(("step", None))
+      except (BrokenPipeError, ConnectionResetError):
+        # the worker is dead, step_wait replaces it
+        pass
+    self.waiting = True
+
+  def step_wait(self):
+    infos = [{} for _ in range(self.num_envs)]
+    for group, group_slice in enumerate(self.group_slices):
+      try:
+        results = self.remotes[group].recv()
+      except (EOFError, ConnectionResetError):
+        results = self.respawn(group)
+      for i, info in results:
+        infos[group_slice.start + i] = info
+    self.waiting = False
+    # The shared arrays are rewritten by the next step
+    return self.obs.copy(), self.rewards.copy(), self.dones.copy(), infos
+
+  def reset(self):
+    for remote, group_slice in zip(self.remotes, self.group_slices):
+      remote.send(("reset", self._seeds[group_slice]))
+    self.reset_infos = [info for remote in self.remotes for info in remote.recv()]
+    # Seeds are only used once
+    self._reset_seeds()
+    return self.obs.copy()
+
+  def close(self):
+    if self.closed:
+      return
+    if self.waiting:
+      for remote in self.remotes:
+        remote.recv()
+    for remote in self.remotes:
+      remote.send(("close", None))
+    for process in self.processes:
+      if process is not None:
+        process.join()
+    if self.template is not None:
+      self.listener.close()
+    self.obs = self.rewards = self.dones = self.actions = None
+    for shm in self.shms:
+      shm.close()
+      shm.unlink()
+    self.closed = True
+
+  def get_images(self) -> Sequence[Optional[np.ndarray]]:
+    for remote in self.remotes:
+      remote.send(("render", None))
+    return [image for remote in self.remotes for image in remote.recv()]
+
+  def _call_groups(self, cmd: str, make_data: Callable, indices) -> List[Any]:
+    """
+    Send cmd to every group holding one of indices, with make_data(local
+    indices) as payload, and return the results in the order of indices.
+    """
+    indices = list(self._get_indices(indices))
+    by_group: Dict[int, List[int]] = {}
+    for i in indices:
+      group, local = self.locations[i]
+      by_group.setdefault(group, []).append(local)
+    for group, local_indices in by_group.items():
+      self.remotes[group].send((cmd, make_data(local_indices)))
+    results = {}
+    for group, local_indices in by_group.items():
+      for local, result in zip(local_indices, self.remotes[group].recv()):
+        results[(group, local)] = result
+    return [results[self.locations[i]] for i in indices]
+
+  def get_attr(self, attr_name: str, indices=None) -> List[Any]:
+    return self._call_groups("get_attr", lambda local: (attr_name, local), indices)
+
+  def set_attr(self, attr_name: str, value: Any, indices=None):
+    indices = list(self._get_indices(indices))
+    groups = {self.locations[i][0] for i in indices}
+    for group in groups:
+      local = [self.locations[i][1] for i in indices if self.locations[i][0] == group]
+      self.remotes[group].send(("set_attr", (attr_name, value, local)))
+    for group in groups:
+      self.remotes[group].recv()
+
+  def env_method(self, method_name: str, *method_args, indices=None, **method_kwargs):
+    return self._call_groups(
+      "env_method",
+      lambda local: (method_name, local, method_args, method_kwargs),
+      indices,
+    )
+
+  def env_is_wrapped(self, wrapper_class, indices=None) -> List[bool]:
+    return self._call_groups(
+      "is_wrapped", lambda local: (wrapper_class, local), indices
+    )
@@ -0,0 +1,350 @@
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+import json
+import multiprocessing
+import time
+from typing import Dict, Optional, Sequence
+import numpy as np
+
+# Kinds of ring slots
+FRAME = 0
+# Holds the episode's output path and overlay names as JSON
+START = 1
+END = 2
+# The producer is gone, the ring can be released
+CLOSE = 3
+
+TEXT_BYTES = 1024
+MAX_OVERLAY_VALUES = 16
+
+
+class VideoRing(object):
+  """
+  Single producer, single consumer ring of frames in shared memory. The
+  producer only writes head and the consumer only writes tail, so neither
+  takes a lock. The producer never waits while recording: a frame that doesn't
+  fit is dropped. One slot stays free for the END of the open episode, and an
+  episode only starts if there is room for its START and END. Closing waits up
+  to timeout_s for room for the END and CLOSE.
+  """
+
+  def __init__(
+    self, slots: int, frame_shape: Sequence[int], name: Optional[str] = None
+  ):
+    self.slots = slots
+    self.frame_shape = tuple(frame_shape)
+    layout = [
+      ("counters", (2,), np.int64),
+      ("kinds", (slots,), np.uint8),
+      ("values", (slots, MAX_OVERLAY_VALUES), np.float32),
+      ("text", (slots, TEXT_BYTES), np.uint8),
+      ("frames", (slots,) + self.frame_shape, np.uint8),
+    ]
+    size = sum(
+      int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in layout
+    )
+    self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+    self.owner = name is None
+    offset = 0
+    for field, shape, dtype in layout:
+      array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+      setattr(self, field, array)
+      offset += array.nbytes
+    self.episode_open = False
+    self.dropped = 0
+
+  @property
+  def name(self) -> str:
+    return self.shm.name
+
+  def free(self) -> int:
+    head, tail = self.counters
+    return self.slots - int(head - tail)
+
+  def push(self, kind: int, frame=None, values=(), text: bytes = b""):
+    slot = self.counters[0] % self.slots
+    self.kinds[slot] = kind
+    if frame is not None:
+      self.frames[slot] = frame
+    self.values[slot, : len(values)] = values
+    self.text[slot, : len(text)] = np.frombuffer(text, dtype=np.uint8)
+    self.text[slot, len(text) :] = 0
+    # publish the slot only once it is written
+    self.counters[0] += 1
+
+  def start_episode(self, path: str, overlay_names: Sequence[str]) -> bool:
+    if self.free() < 2:
+      return False
+    text = json.dumps({"path": path, "names": list(overlay_names)}).encode()
+    assert len(text) <= TEXT_BYTES, "Video path and overlay names too long"
+    self.push(START, text=text)
+    self.episode_open = True
+    return True
+
+  def add_frame(self, frame: np.ndarray, values=()) -> bool:
+    if not self.episode_open:
+      return False
+    if self.free() < 2:
+      self.dropped += 1
+      return False
+    self.push(FRAME, frame=frame, values=values[:MAX_OVERLAY_VALUES])
+    return True
+
+  def end_episode(self):
+    if self.episode_open:
+      self.push(END)
+      self.episode_open = False
+
+  def wait_free(self, slots: int, timeout_s: float) -> bool:
+    """
+    Wait up to timeout_s for the consumer to free slots slots.
+    """
+    deadline = time.monotonic() + timeout_s
+    while self.free() < slots:
+      if time.monotonic() > deadline:
+        return False
+      time.sleep(0.001)
+    return True
+
+  def close(self, timeout_s=5.0):
+    if self.owner:
+      # the consumer unlinks the memory once it has read everything, or the
+      # producer when the consumer is too slow or gone to make room for CLOSE
+      if self.wait_free(int(self.episode_open) + 1, timeout_s):
+        self.end_episode()
+        self.push(CLOSE)
+      else:
+        print(f"video encoder not draining {self.name}, releasing it")
+        self.shm.unlink()
+    for field in ("counters", "kinds", "values", "text", "frames"):
+      setattr(self, field, None)
+    self.shm.close()
+
+  def pop(self):
+    """
+    Consumer side: return (kind, frame, values, text) of the oldest slot, or
+    None. The frame is a view that stays valid until release().
+    """
+    head, tail = self.counters
+    if tail == head:
+      return None
+    slot = tail % self.slots
+    text = self.text[slot].tobytes().rstrip(b"\0")
+    return self.kinds[slot], self.frames[slot], self.values[slot], text
+
+  def release(self):
+    self.counters[1] += 1
+
+
+def overlay(frame: np.ndarray, names: Sequence[str], values: np.ndarray):
+  """
+  Frame with a band below it listing the reward components.
+  """
+  from PIL import Image, ImageDraw
+
+  line_height = 10
+  image = Image.new(
+    "RGB", (frame.shape[1], frame.shape[0] + line_height * len(names) + 2)
+  )
+  image.paste(Image.fromarray(frame), (0, 0))
+  draw = ImageDraw.Draw(image)
+  for i, (name, value) in enumerate(zip(names, values)):
+    draw.text(
+      (2, frame.shape[0] + i * line_height),
+      f"{name}: {value:.2f}",
+      fill=(255, 255, 255),
+    )
+  return np.asarray(image)
+
+
+class VideoWriter(object):
+  """
+  MP4 through OpenCV or GIF through imageio, chosen by the path's suffix.
+  """
+
+  def __init__(self, path: Path, fps: int):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    self.path = path
+    self.fps = fps
+    self.writer = None
+
+  def append(self, frame: np.ndarray):
+    if self.path.suffix == ".gif":
+      import imageio
+
+      if self.writer is None:
+        self.writer = imageio.get_writer(self.path, mode="I", duration=1000 / self.fps)
+      self.writer.append_data(frame)
+    else:
+      import cv2
+
+      if self.writer is None:
+        self.writer = cv2.VideoWriter(
+          str(self.path),
+          cv2.VideoWriter_fourcc(*"mp4v"),
+          self.fps,
+          (frame.shape[1], frame.shape[0]),
+        )
+      self.writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+
+  def close(self):
+    if self.writer is None:
+      return
+    if self.path.suffix == ".gif":
+      self.writer.close()
+    else:
+      self.writer.release()
+    self.writer = None
+
+
+class VideoEncoderServer(object):
+  """
+  Encodes the episodes of every worker. Workers announce their VideoRing on a
+  ZeroMQ PULL socket, the server then drains all rings in turn.
+  """
+
+  def __init__(self, address: str, fps=30, idle_sleep_s=0.005):
+    self.address = address
+    self.fps = fps
+    self.idle_sleep_s = idle_sleep_s
+    self.rings: Dict[str, VideoRing] = {}
+    self.episodes: Dict[str, tuple] = {}
+    self.encoded_frames = 0
+    self.videos = 0
+
+  def drain(self, name: str, ring: VideoRing) -> int:
+    handled = 0
+    while True:
+      item = ring.pop()
+      if item is None:
+        return handled
+      kind, frame, values, text = item
+      if kind == START:
+        start = json.loads(text)
+        self.episodes[name] = (
+          VideoWriter(Path(start["path"]), self.fps),
+          start["names"],
+        )
+      elif kind == FRAME and name in self.episodes:
+        writer, names = self.episodes[name]
+        writer.append(overlay(frame, names, values) if names else frame)
+        self.encoded_frames += 1
+      elif kind == END and name in self.episodes:
+        self.episodes.pop(name)[0].close()
+        self.videos += 1
+      elif kind == CLOSE:
+        if name in self.episodes:
+          self.episodes.pop(name)[0].close()
+        ring.release()
+        ring.close()
+        ring.shm.unlink()
+        del self.rings[name]
+        return handled
+      ring.release()
+      handled += 1
+
+  def serve(self):
+    import zmq
+
+    socket = zmq.Context.instance().socket(zmq.PULL)
+    socket.bind(self.address)
+    while True:
+      while True:
+        try:
+          name, slots, frame_shape = json.loads(socket.recv(zmq.NOBLOCK))
+        except zmq.Again:
+          break
+        self.rings[name] = VideoRing(slots, frame_shape, name=name)
+      handled = sum(self.drain(name, ring) for name, ring in list(self.rings.items()))
+      if handled == 0:
+        time.sleep(self.idle_sleep_s)
+
+
+def run_video_encoder(address, fps):
+  VideoEncoderServer(address, fps).serve()
+
+
+def start_video_encoder(config) -> multiprocessing.Process:
+  """
+  Start the encoder for config["video_server"] in a daemon process.
+  """
+  # The encoder unlinks the workers' rings, so all of them must share one
+  # resource tracker, which a forked child only inherits if it already runs
+  resource_tracker.ensure_running()
+  encoder = multiprocessing.Process(
+    target=run_video_encoder,
+    args=(config["video_server"], config.get("video_fps", 30)),
+    daemon=True,
+  )
+  encoder.start()
+  return encoder
+
+
+class VideoRecorder(object):
+  """
+  Worker side: records 1 of every video_every_k_episodes episodes into a
+  VideoRing and lets the encoder at video_server write them to
+  session/videos.
+  """
+
+  def __init__(self, config, frame_shape: Sequence[int]):
+    self.address = config["video_server"]
+    self.directory = Path(config["session_path"]) / Path("videos")
+    self.every_k = config.get("video_every_k_episodes", 10)
+    self.overlay = config.get("video_overlay", True)
+    self.format = config.get("video_format", "mp4")
+    self.slots = config.get("video_ring_slots", 128)
+    self.close_timeout_s = config.get("video_close_timeout_s", 5.0)
+    self.frame_shape = tuple(frame_shape)
+    # Created on first use, so the recorder can be built before forking
+    self.ring = None
+    self.socket = None
+    self.pending = None
+
+  def connect(self):
+    # Only import zmq in workers that record videos
+    import zmq
+
+    self.ring = VideoRing(self.slots, self.frame_shape)
+    self.socket = zmq.Context.instance().socket(zmq.PUSH)
+    self.socket.setsockopt(zmq.LINGER, 1000)
+    self.socket.connect(self.address)
+    self.socket.send(
+      json.dumps([self.ring.name, self.slots, self.frame_shape]).encode()
+    )
+
+  def start_episode(self, info):
+    if self.ring is None:
+      self.connect()
+    self.ring.end_episode()
+    self.pending = None
+    if (info["reset_count"] - 1) % self.every_k == 0:
+      # started on the first frame, when the reward components are known
+      self.pending = self.directory / Path(
+        f"{info['instance_id']}_{info['reset_count']}.{self.format}"
+      )
+
+  def add_frame(self, frame: np.ndarray, info):
+    if self.ring is None:
+      return
+    if self.pending is not None:
+      names = list(info["reward_components"]) if self.overlay else []
+      self.ring.start_episode(str(self.pending.resolve()), names)
+      self.pending = None
+    if self.ring.episode_open:
+      values = list(info["reward_components"].values()) if self.overlay else ()
+      self.ring.add_frame(frame, values)
+
+  def end_episode(self):
+    self.pending = None
+    if self.ring is not None:
+      self.ring.end_episode()
+
+  def dropped(self) -> int:
+    return 0 if self.ring is None else self.ring.dropped
+
+  def close(self):
+    if self.ring is not None:
+      self.ring.close(self.close_timeout_s)
+      self.socket.close()
+      self.ring = None
@@ -1,6 +1,39 @@
 import numpy as np
-import skimage
 
 
 def compress(original, output_shape):
+  # skimage is slow to import and only needed for this method
+  import skimage.transform
+
   return (255 * skimage.transform.resize(original, output_shape)).astype(np.uint8)
+
+
+def block_downscale(original, output_shape):
+  """
+  Downscale (..., h, w, c) frames by an integer factor by averaging each
+  factor x factor block. Works on a single frame or a batch of frames.
+  """
+  h, w = original.shape[-3:-1]
+  out_h, out_w = output_shape[:2]
+  fh, fw = h // out_h, w // out_w
+  assert fh * out_h == h and fw * out_w == w, "Not an integer factor"
+  # Strided adds are much faster than a sum over reshaped block axes
+  frames = original.astype(np.uint16)
+  rows = frames[..., 0::fh, :, :].copy()
+  for i in range(1, fh):
+    rows += frames[..., i::fh, :, :]
+  total = rows[..., 0::fw, :].copy()
+  for j in range(1, fw):
+    total += rows[..., j::fw, :]
+  total += fh * fw // 2
+  total //= fh * fw
+  return total.astype(np.uint8)
+
+
+def downscale(original, output_shape, method="block"):
+  if method == "skimage":
+    if original.ndim > 3:
+      return np.stack([downscale(f, output_shape, method) for f in original])
+    return compress(original, output_shape)
+  assert method == "block", "Invalid downscale method"
+  return block_downscale(original, output_shape)
@@ -0,0 +1,115 @@
+from multiprocessing.connection import Client, Connection
+import multiprocessing as mp
+import os
+import signal
+import sys
+import time
+import traceback
+from typing import Callable, Dict, List, Tuple, Type
+import cloudpickle
+
+from emulator import Emulator
+from game_env import create_game_state
+from game_state import GameStateManager
+
+# Game states built in the template before forking, by emulator type and config.
+# Every forked worker has its own copy of them.
+_prototypes: Dict[Tuple[str, str], List[GameStateManager]] = {}
+
+
+def _config_key(config, emulator: Type[Emulator]) -> Tuple[str, str]:
+  return emulator.__name__, repr(sorted(config.items()))
+
+
+def warm_game_states(config, emulator: Type[Emulator], count: int):
+  """
+  Build count game states for config in the template, for take_game_state in the
+  workers forked from it.
+  """
+  _prototypes.setdefault(_config_key(config, emulator), []).extend(
+    create_game_state(config, emulator) for _ in range(count)
+  )
+
+
+def take_game_state(config, emulator: Type[Emulator]) -> GameStateManager:
+  """
+  A game state for config warmed up by the template this worker was forked
+  from, or a new one when there is none left.
+  """
+  prototypes = _prototypes.get(_config_key(config, emulator))
+  if prototypes:
+    return prototypes.pop()
+  return create_game_state(config, emulator)
+
+
+def _template_main(remote, warm_fn: bytes):
+  # Workers are not waited for, the kernel reaps them
+  signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+  cloudpickle.loads(warm_fn)()
+  remote.send(None)
+  while True:
+    try:
+      cmd, data = remote.recv()
+    except EOFError:
+      break
+    if cmd == "fork":
+      address, authkey, worker = data
+      pid = os.fork()
+      if pid == 0:
+        remote.close()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        code = 0
+        try:
+          cloudpickle.loads(worker)(Client(address, authkey=authkey))
+        except Exception:
+          traceback.print_exc()
+          code = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # skip the template's exit handlers
+        os._exit(code)
+      remote.send(pid)
+    elif cmd == "close":
+      break
+    else:
+      raise NotImplementedError(f"`{cmd}` is not implemented in the template")
+
+
+class WorkerTemplate(object):
+  """
+  A process that pays the start up cost of workers once: warm_fn runs in it to
+  import what the workers need and build their emulators (see
+  warm_game_states), then every worker is forked from it ready to step. Forking
+  is only done from this clean process, never from the trainer.
+
+  Only state that survives a fork belongs in warm_fn: no threads, no windows and
+  nothing that already ran a thread pool, e.g. a queried hnswlib index.
+  """
+
+  def __init__(self, warm_fn: Callable[[], None]):
+    beg = time.perf_counter()
+    ctx = mp.get_context("spawn")
+    self.remote, work_remote = ctx.Pipe()
+    self.process = ctx.Process(
+      target=_template_main,
+      # cloudpickled rather than in SB3's CloudpickleWrapper, importing SB3
+      # imports torch
+      args=(work_remote, cloudpickle.dumps(warm_fn)),
+      daemon=True,
+    )
+    self.process.start()
+    work_remote.close()
+    self.remote.recv()
+    self.startup_s = time.perf_counter() - beg
+
+  def fork(self, worker: Callable[[Connection], None], address, authkey: bytes) -> int:
+    """
+    Fork a worker that connects to the Listener at address and runs
+    worker(connection). Return its pid.
+    """
+    self.remote.send(("fork", (address, authkey, cloudpickle.dumps(worker))))
+    return self.remote.recv()
+
+  def close(self):
+    self.remote.send(("close", None))
+    self.process.join()
@@ -0,0 +1,5 @@
+from pathlib import Path
+import sys
+
+# The modules in src import each other as top level modules
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / Path("src")))
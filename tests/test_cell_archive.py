@@ -0,0 +1,45 @@
+from cell_archive import CellArchive
+
+
+class FakeEmulator(object):
+  def __init__(self):
+    self.snapshots = 0
+
+  def save_snapshot(self):
+    self.snapshots += 1
+    return bytes(1024)
+
+
+class FakeGameState(object):
+  def __init__(self):
+    self.values = {"map_id": 0, "x": 0, "y": 0, "badges": 0}
+
+  def get(self, name):
+    return self.values[name]
+
+
+def make_archive(tmp_path, **kwargs):
+  game_state = FakeGameState()
+  archive = CellArchive(FakeEmulator(), game_state, tmp_path, reset_prob=1.0, **kwargs)
+  return archive, game_state
+
+
+def test_keeps_fewest_steps_from_game_start(tmp_path):
+  archive, game_state = make_archive(tmp_path)
+  game_state.values["x"] = 1
+  archive.update(score=1.0, steps=10)
+  # reached again 5 steps into an episode started from a cell 20 steps in
+  archive.start_episode()
+  archive.update(score=1.0, steps=20 + 5)
+  name, snapshot, steps = archive.choose()
+  assert steps == 10
+
+
+def test_spills_beyond_memory_budget(tmp_path):
+  archive, game_state = make_archive(tmp_path, max_memory_mb=4 / 1024)
+  for x in range(8):
+    game_state.values["x"] = x
+    archive.update(score=0.0, steps=x)
+  assert archive.memory <= 4 * 1024
+  assert archive.spilled == 4
+  assert len(list(tmp_path.iterdir())) == 4
@@ -0,0 +1,84 @@
+from pathlib import Path
+import numpy as np
+
+from emulator import Emulator
+from game_state import GameStateManager
+
+GAME_STATE = Path(__file__).resolve().parent.parent / Path("game_config/game_state.yml")
+
+
+class RamEmulator(Emulator):
+  """
+  Emulator that only has memory, for game state tests.
+  """
+
+  def __init__(self):
+    self.memory = np.zeros(0x10000, dtype=np.uint8)
+
+  def action_len(self):
+    return 0
+
+  def get_action(self, action):
+    raise NotImplementedError
+
+  def reset(self):
+    self.memory[:] = 0
+
+  def current_frame(self):
+    raise NotImplementedError
+
+  def emulate(self, action):
+    raise NotImplementedError
+
+  def emulate_idle(self):
+    raise NotImplementedError
+
+  def record_frame(self, downscaled=None):
+    raise NotImplementedError
+
+  def get_last_n_frames(self, n=3, out=None):
+    raise NotImplementedError
+
+  def current_downscaled_frame(self):
+    raise NotImplementedError
+
+  def get_last_n_downscaled_frames(self, n=3, out=None):
+    raise NotImplementedError
+
+  def save_snapshot(self):
+    return self.memory.tobytes()
+
+  def restore_snapshot(self, snapshot):
+    self.memory[:] = np.frombuffer(snapshot, dtype=np.uint8)
+
+  def read_one_byte(self, address):
+    return int(self.memory[address])
+
+
+def load_game_state():
+  game_state_manager = GameStateManager(RamEmulator())
+  game_state_manager.load_config(str(GAME_STATE))
+  return game_state_manager
+
+
+def test_load_shipped_config():
+  game_state_manager = load_game_state()
+  assert "event_flags" in game_state_manager.states
+  assert "joy_ignore" in game_state_manager.states
+  game_state_manager.update()
+  assert game_state_manager.get("joy_ignore") == 0
+
+
+def test_is_idle():
+  game_state_manager = load_game_state()
+  memory = game_state_manager.emulator.memory
+  joy_ignore = game_state_manager.states["joy_ignore"].addr
+  status_flags5 = game_state_manager.states["status_flags5"].addr
+  assert not game_state_manager.is_idle()
+  memory[joy_ignore] = 0xFF
+  assert game_state_manager.is_idle()
+  memory[joy_ignore] = 0
+  memory[status_flags5] = 0x20
+  assert game_state_manager.is_idle()
+  memory[status_flags5] = 0x01
+  assert not game_state_manager.is_idle()